@@ -0,0 +1,105 @@
+"""
+Regression check of the title cleaning in src/normalize.py against the implementation it replaced (matching._clean_title).
+Every title in normalize_corpus.json is cleaned with both, and the results must equal the cleaned title stored in the corpus,
+which was made with the old implementation. Optionally, many more random titles are generated and compared as well.
+
+Run from the root of the repository, e.g.:
+    python -m benchmarks.check_normalize --generated 300000
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import unicodedata
+
+from src.normalize import clean_title, normalize_many
+
+CORPUS_FILE = os.path.join(os.path.dirname(__file__), "normalize_corpus.json")
+# Parts of generated titles: words the cleaning looks for, brackets, dashes, dots, accents and compatibility characters.
+TOKENS = ["Here", "Comes", "the", "Sun", "Remastered", "2009", "Remaster", "Live", "live at", "Version", "version", "Mix", "Edit",
+          "Deluxe", "Edition", "from", "From", "(", ")", "[", "]", "-", " - ", "—", "..", "...", ".", "Bonus", "Track", "feat.", "Radio",
+          "Single", "LP", "Mono", "Stereo", "Take", "Alt", "Acoustic", "Reissue", "Beyoncé", "Ĳ", "ﬁ", "ſ", "K", "İ", "  ", "\t", '"', "_",
+          "Café", "Mötley", "Crüe", "№", "½", "album", "Album", "x", "version)", "(from", "(Live)", "(Remastered 2011)", "mix", "a", "é"]
+# Shown per kind of mismatch at most.
+MAX_SHOWN = 10
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description = "Compare the title cleaning with the implementation it replaced.")
+    parser.add_argument("--generated", type = int, default = 0, help = "number of random titles to compare as well")
+    parser.add_argument("--seed", type = int, default = 1, help = "seed of the random titles")
+    args = parser.parse_args(argv)
+
+    with open(CORPUS_FILE, encoding = "utf-8") as fh:
+        corpus = json.load(fh)
+    mismatches = 0
+    for title, expected in corpus:
+        mismatches += _compare(title, expected)
+    if normalize_many(title for title, _ in corpus) != [expected for _, expected in corpus]:
+        print("normalize_many differs from the corpus.")
+        mismatches += 1
+    print(f"{len(corpus)} corpus titles compared.")
+
+    generator = random.Random(args.seed)
+    for _ in range(args.generated):
+        title = "".join(generator.choice(TOKENS) + generator.choice(["", " ", "  ", "-", "("]) for _ in range(generator.randint(0, 10)))
+        mismatches += _compare(title, reference_clean_title(title))
+    if args.generated:
+        print(f"{args.generated} generated titles compared.")
+
+    print(f"{mismatches} mismatches.")
+    return 1 if mismatches else 0
+
+def _compare(title: str, expected: str) -> int:
+    cleaned = clean_title(title)
+    reference = reference_clean_title(title)
+    if cleaned == expected == reference:
+        return 0
+    print(f"{title!r}: cleaned {cleaned!r}, old implementation {reference!r}, corpus {expected!r}")
+    return 1
+
+def reference_clean_title(title: str) -> str:
+    """Clean Spotify or Plex track/album titles for matching; the implementation of matching._clean_title before src/normalize.py."""
+    if not isinstance(title, str):
+        return ""
+    # Normalize Unicode (accents, dashes, etc.)
+    title = unicodedata.normalize("NFKD", title)
+
+    # Lowercase for consistency
+    title = title.lower()
+
+    # Remove common suffixes after a dash, like " - remastered 2008", " - edit", " - mono lp version"
+    title = re.sub(
+        r"\s*-\s*.*?(remaster(ed)?(\s*\d{4})?|mono|stereo|single|album|radio|"
+        r"bonus|lp|version|mix|edit|take|alt|acoustic|live|reissue)\b.*",
+        "",
+        title,
+        flags=re.IGNORECASE,
+    )
+
+    # Remove parenthetical metadata like "(Remastered)", "(Deluxe Edition)", "(Bonus Track)", "(Single Version)"
+    title = re.sub(
+        r"\s*\(([^)]*(remaster|deluxe|bonus|version|mix|edit|take|acoustic|mono|stereo|live|album|radio)[^)]*)\)",
+        "",
+        title,
+        flags=re.IGNORECASE,
+    )
+
+    # Remove trailing album references like "(from ...)" or "(...) version"
+    title = re.sub(r"\s*\(from [^)]*\)", "", title, flags=re.IGNORECASE)
+    title = re.sub(r"\s*\(.*?version\)", "", title, flags=re.IGNORECASE)
+
+    # Remove redundant punctuation and multiple spaces
+    title = re.sub(r'[\[\]\(\)"]', "", title)
+    # Replace multiple dots with a space to avoid issues with URLs
+    title = re.sub(r'\.{2,}', ' ', title)
+    title = re.sub(r"\s{2,}", " ", title)
+
+    # Strip punctuation at ends
+    title = title.strip(" -_.")
+
+    return title.strip()
+
+if __name__ == "__main__":
+    sys.exit(main())
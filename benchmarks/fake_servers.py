@@ -0,0 +1,232 @@
+"""
+This module contains a local stand-in for the Plex HTTP API and the Spotify playlist API, for benchmarks.
+It serves a synthetic library and synthetic playlists over real HTTP, so the clients, the shared session and all request counts are the real ones.
+"""
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from xml.etree.ElementTree import Element, SubElement, tostring
+import json
+import re
+import threading
+import time
+
+import spotipy
+
+import src.plex
+import src.spotify
+from src import http_session
+
+MACHINE_IDENTIFIER = "benchmark"
+SECTION_KEY = "1"
+# Number of results of a hub search, like plex.
+SEARCH_LIMIT = 10
+
+_ID_SEGMENT = re.compile(r"^([\d,]+|[0-9A-Za-z]{22})$")
+_WORD = re.compile(r"\w+")
+
+class FakeServers:
+    '''
+    Plex server with one music library holding the given tracks (attributes of track elements, see synthetic_library),
+    and spotify with the given playlists (playlist id -> items, see synthetic_playlist). Plex playlists are kept in memory.
+    Every request waits latency seconds before it is answered, to simulate the network, and is counted per endpoint in requests.
+    Use as a context manager, and connect() the clients of this project to it.
+    '''
+    def __init__(self, library: list[dict[str, str]], playlists: dict[str, list[dict]], latency: float = 0.0, library_name: str = "Music"):
+        self.library_name = library_name
+        self.latency = latency
+        self.spotify_playlists = playlists
+        self.tracks = {track['ratingKey']: track for track in library}
+        self.albums = {} # type: dict[str, list[str]]
+        self.words = {} # type: dict[str, set[str]]
+        for track in library:
+            self.albums.setdefault(track['parentRatingKey'], []).append(track['ratingKey'])
+            for word in _WORD.findall(f"{track['title']} {track['grandparentTitle']} {track['parentTitle']}".lower()):
+                self.words.setdefault(word, set()).add(track['ratingKey'])
+        self.playlists = {} # type: dict[str, dict]
+        self.requests = Counter() # type: Counter[str]
+        self._lock = threading.Lock()
+        self._next_id = 10_000_000
+        handler = type("Handler", (_Handler,), {'fake': self})
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target = self.httpd.serve_forever, daemon = True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def connect(self):
+        '''
+        Point the plex and spotify clients of this project at the fake servers, through the shared HTTP session.
+        '''
+        src.plex.plex_credentials = lambda: {'baseurl': self.url, 'token': "benchmark"} # type: ignore
+        src.plex.plex_server.cache_clear() # type: ignore
+        src.plex.plex_library.cache_clear() # type: ignore
+        client = spotipy.Spotify(auth = "benchmark", requests_session = http_session.shared_session(), requests_timeout = http_session.TIMEOUT)
+        client.prefix = f"{self.url}/v1/"
+        src.spotify.spotify_client = lambda: client # type: ignore
+
+    def total_requests(self) -> int:
+        return sum(self.requests.values())
+
+    def new_id(self) -> int:
+        with self._lock:
+            self._next_id += 1
+            return self._next_id
+
+class _Handler(BaseHTTPRequestHandler):
+    fake = None # type: FakeServers | None
+    protocol_version = "HTTP/1.1"
+    # Answers are written in parts; without this, delayed acknowledgements add tens of milliseconds to every request.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def _handle(self, method: str):
+        fake = self.fake
+        assert fake is not None
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        segments = [segment for segment in url.path.split("/") if segment]
+        with fake._lock:
+            fake.requests[f"{method} /" + "/".join("{id}" if _ID_SEGMENT.match(segment) else segment for segment in segments)] += 1
+        if fake.latency:
+            time.sleep(fake.latency)
+        if segments[:1] == ["v1"]:
+            status, body, content_type = _spotify(fake, method, segments[1:], params)
+        else:
+            start = int(self.headers.get('X-Plex-Container-Start') or params.get('X-Plex-Container-Start') or 0)
+            size = self.headers.get('X-Plex-Container-Size') or params.get('X-Plex-Container-Size')
+            status, body, content_type = _plex(fake, method, segments, params, start, None if size is None else int(size))
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def _spotify(fake: FakeServers, method: str, segments: list[str], params: dict[str, str]) -> tuple[int, bytes, str]:
+    result = None # type: dict | None
+    if method == "GET" and segments[0] == "playlists" and segments[1] in fake.spotify_playlists:
+        items = fake.spotify_playlists[segments[1]]
+        if len(segments) == 2:
+            result = {'id': segments[1], 'name': f"Playlist {segments[1]}", 'snapshot_id': f"{segments[1]}-{len(items)}"}
+        elif segments[2] in ("tracks", "items"):
+            offset, limit = int(params.get('offset', 0)), int(params.get('limit', 100))
+            result = {'items': items[offset:offset + limit], 'total': len(items), 'offset': offset, 'limit': limit}
+    elif method == "GET" and segments[0] == "users" and segments[2:] == ["playlists"]:
+        result = {'items': [{'id': playlist_id} for playlist_id in fake.spotify_playlists], 'next': None}
+    if result is None:
+        return 404, b'{"error": {"status": 404}}', "application/json"
+    return 200, json.dumps(result).encode(), "application/json"
+
+def _plex(fake: FakeServers, method: str, segments: list[str], params: dict[str, str], start: int, size: int | None) -> tuple[int, bytes, str]:
+    container = Element("MediaContainer")
+    items = None # type: list[Element] | None
+    if method == "GET" and not segments:
+        container.attrib.update(machineIdentifier = MACHINE_IDENTIFIER, friendlyName = "Benchmark", version = "1.40.0.0")
+    elif method == "GET" and segments == ["library"]:
+        pass
+    elif method == "GET" and segments == ["library", "sections"]:
+        SubElement(container, "Directory", key = SECTION_KEY, type = "artist", title = fake.library_name, uuid = "benchmark-library",
+                   agent = "tv.plex.agents.music", scanner = "Plex Music", language = "en")
+    elif method == "GET" and segments == ["library", "sections", SECTION_KEY, "all"]:
+        if params.get('type') == "9":
+            items = [Element("Directory", type = "album", ratingKey = key, leafCount = str(len(track_keys)))
+                     for key, track_keys in fake.albums.items()]
+        else:
+            tracks = list(fake.tracks.values())
+            if params.get('sort'):
+                attribute = params['sort'].split(":")[0]
+                tracks.sort(key = lambda track: -int(track.get(attribute, 0)))
+            items = [_track_element(track) for track in tracks]
+    elif method == "GET" and segments[:2] == ["library", "metadata"] and segments[3:] == ["children"]:
+        items = [_track_element(fake.tracks[key]) for key in fake.albums.get(segments[2], [])]
+    elif method == "GET" and segments[:2] == ["library", "metadata"] and len(segments) == 3:
+        items = []
+        for key in segments[2].split(","):
+            if key in fake.tracks:
+                items.append(_track_element(fake.tracks[key]))
+            elif key in fake.playlists:
+                items.append(_playlist_element(fake.playlists[key]))
+    elif method == "GET" and segments == ["hubs", "search"]:
+        words = _WORD.findall(params.get('query', "").lower())
+        found = set.intersection(*(fake.words.get(word, set()) for word in words)) if words else set()
+        hub = SubElement(container, "Hub", type = "track", hubIdentifier = "track", size = str(min(len(found), SEARCH_LIMIT)))
+        for key in sorted(found, key = int)[:SEARCH_LIMIT]:
+            hub.append(_track_element(fake.tracks[key]))
+    elif segments == ["playlists"]:
+        if method == "POST":
+            playlist = {'ratingKey': str(fake.new_id()), 'title': params.get('title', ""), 'items': []}
+            _add_playlist_items(fake, playlist, params.get('uri', ""))
+            fake.playlists[playlist['ratingKey']] = playlist
+            container.append(_playlist_element(playlist))
+        else:
+            items = [_playlist_element(playlist) for playlist in fake.playlists.values()
+                     if 'title' not in params or playlist['title'] == params['title']]
+    elif segments[:1] == ["playlists"] and segments[1] in fake.playlists:
+        playlist = fake.playlists[segments[1]]
+        if method == "GET" and len(segments) == 2:
+            container.append(_playlist_element(playlist))
+        elif method == "GET" and segments[2:] == ["items"]:
+            items = []
+            for item_id, key in playlist['items']:
+                element = _track_element(fake.tracks[key])
+                element.set('playlistItemID', str(item_id))
+                items.append(element)
+        elif method == "PUT" and segments[2:] == ["items"]:
+            container.set('leafCountAdded', str(_add_playlist_items(fake, playlist, params.get('uri', ""))))
+        elif method == "DELETE" and len(segments) == 4:
+            playlist['items'] = [item for item in playlist['items'] if str(item[0]) != segments[3]]
+        elif method == "PUT" and segments[4:] == ["move"]:
+            item = next(item for item in playlist['items'] if str(item[0]) == segments[3])
+            playlist['items'].remove(item)
+            position = 0
+            if params.get('after'):
+                position = 1 + next(index for index, (item_id, _) in enumerate(playlist['items']) if str(item_id) == params['after'])
+            playlist['items'].insert(position, item)
+        else:
+            return 404, b"", "text/xml"
+    else:
+        return 404, b"", "text/xml"
+
+    if items is not None:
+        container.set('totalSize', str(len(items)))
+        container.set('offset', str(start))
+        items = items[start:] if size is None else items[start:start + size]
+        container.set('size', str(len(items)))
+        container.extend(items)
+    return 200, tostring(container), "text/xml"
+
+def _add_playlist_items(fake: FakeServers, playlist: dict, uri: str) -> int:
+    keys = [key for key in uri.rsplit("/", 1)[-1].split(",") if key in fake.tracks]
+    playlist['items'].extend((fake.new_id(), key) for key in keys)
+    return len(keys)
+
+def _track_element(track: dict[str, str]) -> Element:
+    attributes = {key: value for key, value in track.items() if key != 'isrc'}
+    element = Element("Track", type = "track", key = f"/library/metadata/{track['ratingKey']}", librarySectionID = SECTION_KEY, **attributes)
+    if track.get('isrc'):
+        SubElement(element, "Guid", id = f"isrc://{track['isrc']}")
+    return element
+
+def _playlist_element(playlist: dict) -> Element:
+    return Element("Playlist", type = "playlist", ratingKey = playlist['ratingKey'], key = f"/playlists/{playlist['ratingKey']}/items",
+                   title = playlist['title'], playlistType = "audio", smart = "0", leafCount = str(len(playlist['items'])))
@@ -0,0 +1,221 @@
+"""
+Offline benchmarks of matching and syncing, against a local stand-in for the Plex and Spotify APIs with synthetic libraries.
+Reports throughput, per-track latency (p50/p99), request counts, accuracy and optionally peak memory,
+for building the library index, for every matching strategy and for every sync mode.
+
+Run from the root of the repository, e.g.:
+    python -m benchmarks.run --library-sizes 1000 100000 --playlist-size 1000 --output results/benchmark.json
+and compare a later run with it, which fails if throughput dropped or more requests were needed:
+    python -m benchmarks.run --library-sizes 1000 100000 --playlist-size 1000 --baseline results/benchmark.json
+"""
+from contextlib import redirect_stdout
+from typing import Callable
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.fake_servers import FakeServers
+from benchmarks.synthetic import synthetic_library, synthetic_playlist
+from src.library import LibraryIndex
+from src.matching import match_track, MATCHING_STRATEGIES
+from src.plex import plex_library
+from src.scoring import configure_scoring
+from src.spotify import SpotifyTrack
+from src.sync import SYNC_MODES
+import src.sync
+
+LIBRARY_NAME = "Music"
+PLAYLIST_ID = "benchmark"
+# Fraction by which throughput may drop, compared to the baseline, before it counts as a regression.
+TOLERANCE = 0.2
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description = "Offline benchmarks of matching and syncing against fake Plex and Spotify servers.")
+    parser.add_argument("--library-sizes", type = int, nargs = "+", default = [1000, 10000], help = "numbers of tracks of the synthetic libraries")
+    parser.add_argument("--playlist-size", type = int, default = 500, help = "number of tracks of the synthetic spotify playlist")
+    parser.add_argument("--strategies", nargs = "*", default = list(MATCHING_STRATEGIES), help = "matching strategies to benchmark")
+    parser.add_argument("--sync-modes", nargs = "*", default = list(SYNC_MODES), help = "sync modes to benchmark, end to end")
+    parser.add_argument("--matching-pattern", default = "descending", help = "matching pattern of the sync benchmarks")
+    parser.add_argument("--matching-workers", type = int, default = 1)
+    parser.add_argument("--matching-processes", type = int, default = 1, help = "number of matching processes of the sync benchmarks")
+    parser.add_argument("--duration-tolerance", type = float, help = "duration tolerance in seconds of the matching, see README")
+    parser.add_argument("--latency-ms", type = float, default = 0.0, help = "simulated network latency of every request")
+    parser.add_argument("--memory", action = "store_true", help = "measure peak memory with tracemalloc (slows everything down)")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "write the report as JSON to this file")
+    parser.add_argument("--baseline", help = "compare with the JSON report of an earlier run, and fail on regressions")
+    parser.add_argument("--tolerance", type = float, default = TOLERANCE)
+    parser.add_argument("--verbose", action = "store_true", help = "show the output of the syncs")
+    args = parser.parse_args(argv)
+    configure_scoring(duration_tolerance = args.duration_tolerance)
+
+    results = []
+    for library_size in args.library_sizes:
+        library = synthetic_library(library_size, seed = args.seed)
+        playlist = synthetic_playlist(library, args.playlist_size, seed = args.seed)
+        with FakeServers(library, {PLAYLIST_ID: playlist}, latency = args.latency_ms/1000, library_name = LIBRARY_NAME) as fake:
+            fake.connect()
+            library_index, result = _measure(fake, lambda: LibraryIndex.build(plex_library(LIBRARY_NAME)), args.memory)
+            results.append(dict(scenario = "index", library_size = library_size, **result, **_throughput(library_size, result['seconds'])))
+            for strategy in args.strategies:
+                results.append(dict(scenario = f"strategy:{strategy}", library_size = library_size,
+                                    **_benchmark_strategy(fake, library_index, playlist, strategy, args.memory)))
+            for sync_mode in args.sync_modes:
+                results.append(dict(scenario = f"sync:{sync_mode}", library_size = library_size,
+                                    **_benchmark_sync(fake, playlist, sync_mode, args)))
+
+    report = {'python': platform.python_version(),
+              'platform': platform.platform(),
+              'arguments': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'verbose')},
+              'results': results}
+    _print_results(results)
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        with open(args.output, "w", encoding = "utf-8") as fh:
+            json.dump(report, fh, indent = 2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding = "utf-8") as fh:
+            regressions = _regressions(json.load(fh)['results'], results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+def _benchmark_strategy(fake: FakeServers, library_index: LibraryIndex, playlist: list[dict], strategy: str, trace_memory: bool) -> dict:
+    '''
+    Match every playlist track with a single strategy, and time every track.
+    '''
+    latencies = [] # type: list[float]
+    spotify_tracks = [SpotifyTrack.from_item(item) for item in playlist]
+    def match_all():
+        matches = []
+        for spotify_track in spotify_tracks:
+            start = time.perf_counter()
+            plex_track, _ = match_track(library_index, spotify_track, None, None, strategy)
+            latencies.append(time.perf_counter() - start)
+            matches.append(plex_track)
+        return matches
+    matches, result = _measure(fake, match_all, trace_memory)
+    return dict(**result, **_throughput(len(playlist), result['seconds']), **_latency(latencies), **_accuracy(playlist, matches))
+
+def _benchmark_sync(fake: FakeServers, playlist: list[dict], sync_mode: str, args: argparse.Namespace) -> dict:
+    '''
+    Run a whole sync of the playlist, including loading the library index and writing the plex playlist.
+    The matching of every track is timed by wrapping match_track.
+    '''
+    settings = {'playlist_id': PLAYLIST_ID,
+                'plex_library_name': LIBRARY_NAME,
+                'plex_playlist_name': "Benchmark",
+                'sync_mode': sync_mode,
+                'dry_run': False,
+                'matching_pattern': args.matching_pattern,
+                'matching_workers': args.matching_workers,
+                'matching_processes': args.matching_processes,
+                'duration_tolerance': args.duration_tolerance,
+                'print_matching_status': False,
+                'mapping_dict': {},
+                'skip_list': frozenset(),
+                'print_unmatched_to_file': False,
+                'print_matched_to_file': False,
+                'create_hardcoded_mapping': False}
+    latencies = [] # type: list[float]
+    def timed_match_track(*match_args, **match_kwargs):
+        start = time.perf_counter()
+        try:
+            return match_track(*match_args, **match_kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    src.sync.match_track = timed_match_track # type: ignore
+    try:
+        output = None if args.verbose else io.StringIO()
+        # The playlist writes are recorded in a resume file, like with the example settings.
+        with redirect_stdout(output) if output else _no_redirect(), tempfile.TemporaryDirectory() as directory:
+            settings['playlist_resume_file'] = os.path.join(directory, "playlist_resume.json")
+            counts, result = _measure(fake, lambda: src.sync.sync(settings), args.memory)
+    finally:
+        src.sync.match_track = match_track # type: ignore
+    nr_matched, nr_unmatched, nr_skipped = counts
+    return dict(**result, **_throughput(len(playlist), result['seconds']), **_latency(latencies),
+                matched = nr_matched, unmatched = nr_unmatched, skipped = nr_skipped)
+
+def _measure(fake: FakeServers, run: Callable, trace_memory: bool) -> tuple:
+    '''
+    Run a benchmark, and return its result with the wall time, the number of requests per endpoint and optionally the peak memory.
+    '''
+    fake.requests.clear()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = run()
+    seconds = time.perf_counter() - start
+    peak_memory = None
+    if trace_memory:
+        peak_memory = round(tracemalloc.get_traced_memory()[1]/2**20, 1)
+        tracemalloc.stop()
+    return result, {'seconds': round(seconds, 4),
+                    'requests': fake.total_requests(),
+                    'requests_per_endpoint': dict(fake.requests),
+                    'peak_memory_mb': peak_memory}
+
+def _throughput(nr_items: int, seconds: float) -> dict:
+    return {'items': nr_items, 'items_per_second': round(nr_items/seconds, 1) if seconds else None}
+
+def _latency(latencies: list[float]) -> dict:
+    if len(latencies) < 2:
+        return {'p50_ms': None, 'p99_ms': None}
+    percentiles = statistics.quantiles(latencies, n = 100)
+    return {'p50_ms': round(percentiles[49]*1000, 3), 'p99_ms': round(percentiles[98]*1000, 3)}
+
+def _accuracy(playlist: list[dict], matches: list) -> dict:
+    '''
+    Count the matched tracks, and how many of them are the library track the playlist track was made from.
+    '''
+    matched = [(element, plex_track) for element, plex_track in zip(playlist, matches) if plex_track]
+    correct = sum(plex_track.ratingKey == element['expected_ratingKey'] for element, plex_track in matched)
+    findable = sum(element['expected_ratingKey'] is not None for element in playlist)
+    return {'matched': len(matched), 'correct': correct,
+            'precision': round(correct/len(matched), 3) if matched else None,
+            'recall': round(correct/findable, 3) if findable else None}
+
+def _regressions(baseline: list[dict], results: list[dict], tolerance: float) -> list[str]:
+    '''
+    Compare the results with a baseline: a scenario regressed if its throughput dropped by more than tolerance, or if it needed more requests.
+    '''
+    regressions = []
+    previous = {(result['library_size'], result['scenario']): result for result in baseline}
+    for result in results:
+        before = previous.get((result['library_size'], result['scenario']))
+        if before is None:
+            continue
+        name = f"{result['scenario']} ({result['library_size']} tracks)"
+        if before['items_per_second'] and result['items_per_second'] and result['items_per_second'] < before['items_per_second']*(1 - tolerance):
+            regressions.append(f"{name}: {result['items_per_second']} items/s, was {before['items_per_second']}")
+        if result['requests'] > before['requests']:
+            regressions.append(f"{name}: {result['requests']} requests, was {before['requests']}")
+    return regressions
+
+def _print_results(results: list[dict]):
+    columns = ["library_size", "scenario", "items_per_second", "p50_ms", "p99_ms", "requests", "matched", "precision", "peak_memory_mb"]
+    print("\t".join(columns))
+    for result in results:
+        print("\t".join(str(result.get(column, "")) for column in columns))
+
+class _no_redirect:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return None
+
+if __name__ == "__main__":
+    sys.exit(main())
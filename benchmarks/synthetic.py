@@ -0,0 +1,112 @@
+"""
+This module generates synthetic Plex libraries and Spotify playlists for benchmarks.
+Names are random but reproducible for a seed, and carry the kinds of noise real libraries have:
+remaster and live suffixes, featured artists, deluxe editions, accents and other unicode, and differences in case and punctuation.
+"""
+import random
+import zlib
+
+_SYLLABLES = ["ka", "lo", "mi", "ra", "to", "ve", "sun", "nor", "bel", "dra", "qui", "zé", "ön", "ña", "lø", "ki", "ma", "ro", "sa", "ty"]
+_WORDS = ["love", "night", "city", "dream", "fire", "heart", "river", "light", "road", "gold", "ghost", "summer", "blue", "wild",
+          "home", "rain", "star", "electric", "silver", "dance", "échos", "niño", "straße", "café", "hôtel", "über"]
+_TITLE_SUFFIXES = [" - Remastered", " - 2011 Remaster", " - Remastered 2009", " (Live)", " - Live at Wembley", " - Radio Edit",
+                   " - Single Version", " (Acoustic)", " - Mono", " (Bonus Track)"]
+_ALBUM_SUFFIXES = [" (Deluxe Edition)", " (Remastered)", " (Expanded Edition)", " (Live)"]
+
+def synthetic_library(nr_tracks: int, seed: int = 0, tracks_per_album: int = 12, albums_per_artist: int = 4) -> list[dict[str, str]]:
+    '''
+    Generate a music library of nr_tracks tracks, as the attributes of the track elements of a plex library listing.
+    Artist, album and track ratingKeys don't overlap. Like in real libraries, only part of the tracks have an ISRC (under 'isrc', served as a guid).
+    '''
+    rng = random.Random(seed)
+    tracks = []
+    nr_albums = -(-nr_tracks//tracks_per_album)
+    nr_artists = -(-nr_albums//albums_per_artist)
+    artists = [(1_000_000 + nr, _artist_name(rng)) for nr in range(nr_artists)]
+    for album_nr in range(nr_albums):
+        artist_key, artist = artists[album_nr//albums_per_artist]
+        album = _phrase(rng, 1, 3).title()
+        if rng.random() < 0.15:
+            album += rng.choice(_ALBUM_SUFFIXES)
+        for index in range(1, tracks_per_album + 1):
+            if len(tracks) == nr_tracks:
+                break
+            title = _phrase(rng, 1, 4).capitalize()
+            if rng.random() < 0.1:
+                title += f" (feat. {_artist_name(rng)})"
+            if rng.random() < 0.1:
+                title += rng.choice(_TITLE_SUFFIXES)
+            added_at = 1_500_000_000 + len(tracks)*60
+            tracks.append({'ratingKey': str(len(tracks) + 1),
+                           'title': title,
+                           'grandparentTitle': artist,
+                           'parentTitle': album,
+                           'grandparentRatingKey': str(artist_key),
+                           'parentRatingKey': str(2_000_000 + album_nr),
+                           'index': str(index),
+                           'duration': str(rng.randint(90, 420)*1000),
+                           'addedAt': str(added_at),
+                           'updatedAt': str(added_at),
+                           'isrc': _isrc(rng) if rng.random() < 0.5 else ""})
+    return tracks
+
+def synthetic_playlist(library: list[dict[str, str]], nr_tracks: int, seed: int = 0, missing_fraction: float = 0.1) -> list[dict]:
+    '''
+    Generate the items of a spotify playlist of nr_tracks tracks.
+    Most tracks are picked from the library and then named the way spotify would: with other suffixes, featured artists and casing.
+    A missing_fraction of the tracks are not in the library at all.
+    Every item has the ratingKey of the library track it was made from under 'expected_ratingKey' (None for missing tracks), to check the matches.
+    '''
+    rng = random.Random(seed + 1)
+    items = []
+    for nr in range(nr_tracks):
+        if library and rng.random() >= missing_fraction:
+            track = rng.choice(library)
+            title, artist, album = track['title'], track['grandparentTitle'], track['parentTitle']
+            expected = int(track['ratingKey'])
+            isrc = track['isrc'] or (_isrc(rng) if rng.random() < 0.5 else "")
+            duration_ms = int(track['duration']) + rng.randint(-1500, 1500)
+        else:
+            title, artist, album = _phrase(rng, 2, 4).capitalize(), _artist_name(rng), _phrase(rng, 1, 3).title()
+            expected = None
+            isrc = _isrc(rng) if rng.random() < 0.8 else ""
+            duration_ms = rng.randint(90, 420)*1000
+        title, artist, album = _spotify_variant(rng, title, artist, album)
+        items.append({'added_at': f"2024-01-01T00:00:{nr%60:02d}Z",
+                      'expected_ratingKey': expected,
+                      'track': {'id': f"{nr:022d}",
+                                'name': title,
+                                'duration_ms': duration_ms,
+                                'external_ids': {'isrc': isrc} if isrc else {},
+                                'artists': [{'name': artist}],
+                                'album': {'id': f"{zlib.crc32(album.encode()):022d}", 'name': album}}})
+    return items
+
+def _spotify_variant(rng: random.Random, title: str, artist: str, album: str) -> tuple[str, str, str]:
+    '''
+    Return the names as spotify might have them for the same recording.
+    '''
+    roll = rng.random()
+    if roll < 0.1:
+        title += rng.choice(_TITLE_SUFFIXES)
+    elif roll < 0.15 and " - " in title:
+        title = title.split(" - ")[0]
+    elif roll < 0.2:
+        title = title.upper()
+    if rng.random() < 0.05:
+        artist = artist.replace(" & ", " and ")
+    if rng.random() < 0.1:
+        album += rng.choice(_ALBUM_SUFFIXES)
+    return title, artist, album
+
+def _isrc(rng: random.Random) -> str:
+    return f"{rng.choice(['US', 'GB', 'DE', 'NL'])}{rng.randrange(36**3):05X}{rng.randint(0, 99):02d}{rng.randrange(10**5):05d}"
+
+def _phrase(rng: random.Random, minimum: int, maximum: int) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(rng.randint(minimum, maximum)))
+
+def _artist_name(rng: random.Random) -> str:
+    name = " ".join("".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 3))).capitalize() for _ in range(rng.randint(1, 2)))
+    if rng.random() < 0.05:
+        name += " & " + _phrase(rng, 1, 2).title()
+    return name
@@ -1,15 +1,31 @@
 """
 This module loads .yaml configurations as dictionaries.
 """
+from functools import cache
+
 import yaml
 
+# The C loader of libyaml is much faster; it is only available if pyyaml was built with it.
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 def load_configuration(path: str):
     """
     Load a .yaml configuration from file as a docstring.
     """
     with open(path, "r", encoding = "utf-8") as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader = SafeLoader)
 
 
-spotify = load_configuration("./credentials/spotify.yaml")
-plex = load_configuration("./credentials/plex.yaml")
+@cache
+def spotify_credentials() -> dict:
+    """
+    Load the spotify credentials, on first use.
+    """
+    return load_configuration("./credentials/spotify.yaml")
+
+@cache
+def plex_credentials() -> dict:
+    """
+    Load the plex credentials, on first use.
+    """
+    return load_configuration("./credentials/plex.yaml")
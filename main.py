@@ -1,12 +1,28 @@
 #%%
-from settings import settings
-from src.sync import sync
+from settings import load_settings
+from src.sync import sync, sync_many, merge_sync_results
 from src.save import handle_savetodisk
+from src.http_session import latency_metrics
+from src.instrumentation import start_instrumentation, stage, profiled
 
 #%%
-matched, unmatched, plex_tracks, skipped = sync(settings)
+# Guarded, because the worker processes of matching_processes import this module again.
+if __name__ == '__main__':
+    settings = load_settings()
+    report = start_instrumentation() if settings.get('instrumentation_file') else None
+    with profiled(settings.get('profiler'), settings.get('profile_file')):
+        if settings.get('playlist_ids') or settings.get('spotify_user'):
+            matched, unmatched, plex_tracks, skipped = merge_sync_results(sync_many(settings))
+            print(f"\t{len(matched)} matched, {len(unmatched)} unmatched and {len(skipped)} skipped tracks.")
+            with stage('save'):
+                handle_savetodisk(unmatched, matched, plex_tracks, settings)
+        else:
+            # sync writes the matched & unmatched tracks to file while it runs.
+            nr_matched, nr_unmatched, nr_skipped = sync(settings)
+            print(f"\t{nr_matched} matched, {nr_unmatched} unmatched and {nr_skipped} skipped tracks.")
 
-
-print(f"\t{len(matched)} matched, {len(unmatched)} unmatched and {len(skipped)} skipped tracks.")
-
-handle_savetodisk(unmatched, matched, plex_tracks, settings)
+    if settings.get('print_http_metrics'):
+        latency_metrics.print_summary()
+    if report:
+        report.print_summary()
+        report.save(settings['instrumentation_file'])
@@ -1,13 +1,25 @@
 """
 This module loads settings.yaml as a dictionary.
 """
+import os
+
 from credentials.credentials import load_configuration
+from src.hardcoded_matches import load_mapping, load_skip_list
 
-settings = load_configuration('./settings.yaml')
-settings['mapping_dict'] = None
-settings['skip_list'] = None
-# Add the mapping dictionary and the skip list to the settings if it exists.
-if settings['mapping_file']:
-    settings['mapping_dict'] = load_configuration(settings['mapping_file'])
-if settings['skip_file']:
-    settings['skip_list'] = load_configuration(settings['skip_file'])['skips']
+def load_settings(path: str = './settings.yaml') -> dict:
+    '''
+    Load the settings, with the mapping dictionary and the skip list if they are set.
+    The loaded mapping and skip list are kept next to the library cache or the match cache, if one of them is set.
+    Nothing is read before this is called, so importing the modules of this project doesn't need any configuration.
+    '''
+    settings = load_configuration(path)
+    settings['mapping_dict'] = {}
+    settings['skip_list'] = frozenset()
+    cache_file = settings.get('library_cache_file') or settings.get('match_cache_file')
+    cache_directory = (os.path.dirname(cache_file) or '.') if cache_file else None
+    # Add the mapping dictionary and the skip list to the settings if it exists.
+    if settings['mapping_file']:
+        settings['mapping_dict'] = load_mapping(settings['mapping_file'], cache_directory)
+    if settings['skip_file']:
+        settings['skip_list'] = load_skip_list(settings['skip_file'], cache_directory)
+    return settings
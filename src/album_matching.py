@@ -0,0 +1,170 @@
+"""
+This module matches the spotify tracks of the same album together: the plex album is resolved once per album,
+and its tracks are assigned to all the spotify tracks of that album in one step.
+Only the tracks that the strategies before the album strategies leave without a match are grouped by album.
+"""
+from itertools import islice
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, TypeVar
+
+import numpy as np
+from rapidfuzz import fuzz, process
+
+from src import scoring
+from src.instrumentation import stage
+from src.matching import find_album, expand_matching_pattern, ALBUM_STRATEGIES
+from src.normalize import clean_title
+from src.pool import ordered_map
+
+if TYPE_CHECKING:
+    from src.library import LibraryIndex, TrackRecord
+    from src.spotify import SpotifyTrack
+
+# Number of spotify tracks that are grouped by album at a time when the tracks stream in, like a page of a spotify playlist.
+BATCH_SIZE = 100
+
+R = TypeVar('R')
+
+def match_with_album_assignments(library_index: "LibraryIndex",
+                                 spotify_tracks: Iterable["SpotifyTrack"],
+                                 matching_pattern: str | list[str],
+                                 match: Callable[["SpotifyTrack", list[str], dict[tuple[str, str], "TrackRecord | None"] | None], R],
+                                 workers: int = 1,
+                                 batch_size: int = BATCH_SIZE,
+                                 ) -> Iterator[tuple["SpotifyTrack", R]]:
+    '''
+    Match every spotify track with match(spotify_track, strategies, album_assignments), like match_track, and yield it with the result, in order.
+    The tracks are matched by ordered_map with the given number of workers. If the matching pattern has no album strategy, they are matched as they come in.
+    Otherwise they are read batch_size at a time, and matched in two rounds: first with the strategies before the first album strategy,
+    and then the tracks that are still without a match (the result is falsy) with the other strategies and the album assignments of just those tracks.
+    '''
+    strategies = expand_matching_pattern(matching_pattern)
+    first_album = next((nr for nr, strategy in enumerate(strategies) if strategy in ALBUM_STRATEGIES), None)
+    if first_album is None:
+        yield from ordered_map(lambda spotify_track: (spotify_track, match(spotify_track, strategies, None)), spotify_tracks, workers = workers)
+        return
+
+    album_strategies = [strategy for strategy in strategies if strategy in ALBUM_STRATEGIES]
+    spotify_tracks = iter(spotify_tracks)
+    while batch := list(islice(spotify_tracks, batch_size)):
+        results = list(ordered_map(lambda spotify_track: match(spotify_track, strategies[:first_album], None), batch, workers = workers))
+        unmatched = [nr for nr, result in enumerate(results) if not result[0]]
+        with stage('album_assignment'):
+            album_assignments = assign_albums(library_index, [batch[nr] for nr in unmatched], album_strategies)
+        later_results = ordered_map(lambda nr: match(batch[nr], strategies[first_album:], album_assignments), unmatched, workers = workers)
+        for nr, result in zip(unmatched, later_results):
+            results[nr] = result
+        yield from zip(batch, results)
+
+def assign_albums(library_index: "LibraryIndex",
+                  spotify_tracks: list["SpotifyTrack"],
+                  strategies: Iterable[str] = ALBUM_STRATEGIES,
+                  ) -> dict[tuple[str, str], "TrackRecord | None"]:
+    '''
+    Match the spotify tracks that share their album (and first artist) with at least one other track, for every album strategy.
+    Every plex album is resolved once per group, and its tracks are assigned to the tracks of the group with the highest total title score,
+    so that no two spotify tracks get the same plex track.
+    Returns the match (or None) per (strategy, spotify track id); tracks that are alone in their group are left to the normal search.
+    '''
+    groups = {} # type: dict[tuple[str, str], list[SpotifyTrack]]
+    for spotify_track in spotify_tracks:
+        if spotify_track.id:
+            key = (spotify_track.album_id or spotify_track.album, clean_title(spotify_track.artist))
+            groups.setdefault(key, []).append(spotify_track)
+
+    album_assignments = {} # type: dict[tuple[str, str], TrackRecord | None]
+    for group in groups.values():
+        # A track that is in the batch twice is matched once.
+        group = list({spotify_track.id: spotify_track for spotify_track in group}.values())
+        if len(group) < 2:
+            continue
+        for strategy in strategies:
+            plex_album = find_album(library_index, group[0], strategy)
+            assigned = assign_album_tracks(library_index.album_tracks(plex_album.ratingKey), group) if plex_album else [None]*len(group)
+            for spotify_track, plex_track in zip(group, assigned):
+                album_assignments[(strategy, spotify_track.id)] = plex_track
+    return album_assignments
+
+def assign_album_tracks(album_tracks: list["TrackRecord"], spotify_tracks: list["SpotifyTrack"]) -> list["TrackRecord | None"]:
+    '''
+    Assign the tracks of a plex album to spotify tracks, maximizing the total title score, with every plex track assigned at most once.
+    A pair only counts if its title scores above the cutoff and its duration is within the tolerance; on equal scores the closest duration wins.
+    Returns the assigned plex track (or None) for every spotify track.
+    '''
+    if not album_tracks:
+        return [None]*len(spotify_tracks)
+    titles = [clean_title(spotify_track.name) for spotify_track in spotify_tracks]
+    scores = process.cdist(titles, [plex_track.clean_title for plex_track in album_tracks],
+                           scorer = fuzz.partial_ratio, processor = None, workers = scoring.WORKERS).astype(np.float64)
+    scores[~scoring.above_cutoff(scores)] = 0
+    durations = np.fromiter((plex_track.duration for plex_track in album_tracks), dtype = np.float64, count = len(album_tracks))
+    spotify_durations = np.fromiter((spotify_track.duration_ms or 0 for spotify_track in spotify_tracks),
+                                    dtype = np.float64, count = len(spotify_tracks))
+    distances = np.abs(spotify_durations[:, None] - durations[None, :])
+    known = (spotify_durations[:, None] > 0) & (durations[None, :] > 0)
+    if scoring.DURATION_TOLERANCE is not None:
+        scores[known & (distances > scoring.DURATION_TOLERANCE)] = 0
+    # Far below the differences between title scores: this only decides between equal scores.
+    nudged = known & (scores > 0)
+    scores[nudged] -= 1e-9*distances[nudged]
+
+    assigned = [None]*len(spotify_tracks) # type: list[TrackRecord | None]
+    for row, column in enumerate(_max_score_assignment(scores)):
+        if column >= 0 and scores[row, column] > 0:
+            assigned[row] = album_tracks[column]
+    return assigned
+
+def _max_score_assignment(scores: np.ndarray) -> list[int]:
+    '''
+    Return for every row the column assigned to it, such that the sum of the scores of the assigned pairs is as high as possible
+    and every column is assigned at most once; -1 for rows without a column (if there are more rows than columns).
+    This is the Hungarian algorithm, in O(rows^2 columns), with the inner loop vectorized.
+    '''
+    nr_rows, nr_columns = scores.shape
+    # Usually every row has its own best column, and then that is the best assignment.
+    best_columns = np.argmax(scores, axis = 1)
+    if len(set(best_columns.tolist())) == nr_rows:
+        return best_columns.tolist()
+    if nr_rows > nr_columns:
+        assignment = [-1]*nr_rows
+        for column, row in enumerate(_max_score_assignment(scores.T)):
+            assignment[row] = column
+        return assignment
+
+    cost = scores.max() - scores
+    # Potentials of the rows and columns, and the row matched to every column; index 0 is a dummy column and row 0 means unmatched.
+    u = np.zeros(nr_rows + 1)
+    v = np.zeros(nr_columns + 1)
+    matched_row = np.zeros(nr_columns + 1, dtype = np.int64)
+    previous_column = np.zeros(nr_columns + 1, dtype = np.int64)
+    for row in range(1, nr_rows + 1):
+        matched_row[0] = row
+        column = 0
+        min_slack = np.full(nr_columns + 1, np.inf)
+        used = np.zeros(nr_columns + 1, dtype = bool)
+        while matched_row[column] != 0:
+            used[column] = True
+            current_row = matched_row[column]
+            slack = cost[current_row - 1] - u[current_row] - v[1:]
+            free = ~used[1:]
+            lower = free & (slack < min_slack[1:])
+            min_slack[1:][lower] = slack[lower]
+            previous_column[1:][lower] = column
+            free_slack = np.where(free, min_slack[1:], np.inf)
+            next_column = int(np.argmin(free_slack)) + 1
+            delta = free_slack[next_column - 1]
+            used_columns = np.flatnonzero(used)
+            u[matched_row[used_columns]] += delta
+            v[used_columns] -= delta
+            min_slack[1:][free] -= delta
+            column = next_column
+        # Augment along the alternating path back to the dummy column.
+        while column != 0:
+            previous = previous_column[column]
+            matched_row[column] = matched_row[previous]
+            column = previous
+
+    assignment = [-1]*nr_rows
+    for column in range(1, nr_columns + 1):
+        if matched_row[column]:
+            assignment[matched_row[column] - 1] = column - 1
+    return assignment
@@ -0,0 +1,167 @@
+"""
+This module narrows a Plex library down to a few dozen plausible candidates for a Spotify track, using a trigram index over cleaned titles and artists.
+Substring searches over the keys of a library index (titles and names) are narrowed down the same way, see KeyIndex.
+"""
+from typing import Iterable, Sequence
+
+import numpy as np
+
+# Number of candidates (distinct cleaned title and artist pairs) returned per search.
+CANDIDATES = 50
+# Most postings read per search: the rarest trigrams of the query are used first, until this many postings are read.
+POSTINGS_BUDGET = 20000
+# Number of trigrams of the query that are always used, however common they are.
+MIN_TRIGRAMS = 3
+# Numpy type of the trigrams: three characters, with the marker of artist trigrams.
+TRIGRAM_DTYPE = '<U4'
+# Numpy type of the trigrams of keys (see KeyIndex), which are not padded or marked.
+KEY_TRIGRAM_DTYPE = '<U3'
+
+class CandidateIndex:
+    '''
+    Trigram inverted index over the cleaned title and artist of tracks.
+    Tracks with the same cleaned title and artist are one entry. A search ranks the entries by the number of trigrams
+    they share with the cleaned title and artist of the spotify track, reading the postings of rare trigrams first,
+    so the cost of a search is bounded by POSTINGS_BUDGET instead of the size of the library.
+    The index is a handful of flat numpy arrays (see arrays), so it can be shared with other processes as is.
+    '''
+    def __init__(self, tracks: Iterable[tuple[int, str, str]]):
+        '''
+        Index (ratingKey, clean_title, clean_artist) tuples.
+        '''
+        entries = {} # type: dict[tuple[str, str], list[int]]
+        for rating_key, clean_title, clean_artist in tracks:
+            entries.setdefault((clean_title, clean_artist), []).append(rating_key)
+        postings = {} # type: dict[str, list[int]]
+        for entry, (clean_title, clean_artist) in enumerate(entries):
+            for trigram in _trigrams(clean_title, clean_artist):
+                postings.setdefault(trigram, []).append(entry)
+        trigrams = sorted(postings)
+        self.trigrams = np.array(trigrams, dtype = TRIGRAM_DTYPE)
+        # The postings of trigram nr i are postings[starts[i]:starts[i + 1]], and likewise for the ratingKeys of every entry.
+        self.starts = offsets(len(postings[trigram]) for trigram in trigrams)
+        self.postings = np.fromiter((entry for trigram in trigrams for entry in postings[trigram]), dtype = np.int32, count = self.starts[-1])
+        self.entry_starts = offsets(len(rating_keys) for rating_keys in entries.values())
+        self.rating_keys = np.fromiter((key for rating_keys in entries.values() for key in rating_keys), dtype = np.int64, count = self.entry_starts[-1])
+
+    @classmethod
+    def from_arrays(cls, arrays: dict[str, np.ndarray]) -> "CandidateIndex":
+        '''
+        Use the arrays of an index (see arrays), e.g. views on shared memory, without copying them.
+        '''
+        index = cls.__new__(cls)
+        for name, array in arrays.items():
+            setattr(index, name, array)
+        return index
+
+    def arrays(self) -> dict[str, np.ndarray]:
+        '''
+        Return the arrays that make up the index, by name.
+        '''
+        return {'trigrams': self.trigrams, 'starts': self.starts, 'postings': self.postings,
+                'entry_starts': self.entry_starts, 'rating_keys': self.rating_keys}
+
+    def search(self, clean_title: str, clean_artist: str, limit: int = CANDIDATES) -> list[int]:
+        '''
+        Return the ratingKeys of the tracks of the limit entries that share the most trigrams with the given cleaned title and artist,
+        best first. Entries that share fewer than a third of the trigrams that were read are left out.
+        '''
+        query = np.array(sorted(_trigrams(clean_title, clean_artist)), dtype = TRIGRAM_DTYPE)
+        positions = np.minimum(np.searchsorted(self.trigrams, query), len(self.trigrams) - 1)
+        found = positions[self.trigrams[positions] == query] if len(self.trigrams) else positions[:0]
+        lengths = self.starts[found + 1] - self.starts[found]
+        # Rarest first; ties are broken on the trigram itself, so the result does not depend on the (per process) order of sets.
+        found = found[np.lexsort((found, lengths))]
+        used, nr_postings = 0, 0
+        for length in np.sort(lengths).tolist():
+            if used >= MIN_TRIGRAMS and nr_postings + length > POSTINGS_BUDGET:
+                break
+            used += 1
+            nr_postings += length
+        if not used:
+            return []
+
+        entries, counts = np.unique(np.concatenate([self.postings[self.starts[nr]:self.starts[nr + 1]] for nr in found[:used].tolist()]),
+                                    return_counts = True)
+        keep = counts*3 >= used
+        entries, counts = entries[keep], counts[keep]
+        # Best first; on equal counts the entry that was indexed first wins, also for the last places within the limit.
+        order = np.lexsort((entries, -counts))[:limit]
+        return [rating_key for entry in entries[order].tolist()
+                for rating_key in self.rating_keys[self.entry_starts[entry]:self.entry_starts[entry + 1]].tolist()]
+
+class KeyIndex:
+    '''
+    Trigram index over the keys of a keyed dictionary of a library index (like tracks_by_title), for substring searches.
+    A key that contains a value contains every trigram of it, so only the keys with the rarest trigram of the value are checked.
+    Like CandidateIndex, the index is a few flat numpy arrays (see arrays); the keys themselves are kept apart from them.
+    '''
+    def __init__(self, keys: Iterable[str]):
+        '''
+        Index the keys, numbered in order.
+        '''
+        self.keys = list(keys) # type: Sequence[str]
+        postings = {} # type: dict[str, list[int]]
+        for nr, key in enumerate(self.keys):
+            for trigram in _substrings(key):
+                postings.setdefault(trigram, []).append(nr)
+        trigrams = sorted(postings)
+        self.trigrams = np.array(trigrams, dtype = KEY_TRIGRAM_DTYPE)
+        # The numbers of the keys with trigram nr i are postings[starts[i]:starts[i + 1]], in order.
+        self.starts = offsets(len(postings[trigram]) for trigram in trigrams)
+        self.postings = np.fromiter((nr for trigram in trigrams for nr in postings[trigram]), dtype = np.int32, count = self.starts[-1])
+
+    @classmethod
+    def from_arrays(cls, arrays: dict[str, np.ndarray], keys: Sequence[str]) -> "KeyIndex":
+        '''
+        Use the arrays of an index (see arrays), e.g. views on shared memory, without copying them, with the keys it was made from.
+        '''
+        index = cls.__new__(cls)
+        for name, array in arrays.items():
+            setattr(index, name, array)
+        index.keys = keys
+        return index
+
+    def arrays(self) -> dict[str, np.ndarray]:
+        '''
+        Return the arrays that make up the index, by name.
+        '''
+        return {'trigrams': self.trigrams, 'starts': self.starts, 'postings': self.postings}
+
+    def containing(self, value: str) -> list[int]:
+        '''
+        Return the numbers of the keys that contain value, in order.
+        Values shorter than a trigram are looked for in every key.
+        '''
+        if len(value) < 3:
+            return [nr for nr in range(len(self.keys)) if value in self.keys[nr]]
+        if not len(self.trigrams):
+            return []
+        query = np.array(list(_substrings(value)), dtype = KEY_TRIGRAM_DTYPE)
+        positions = np.minimum(np.searchsorted(self.trigrams, query), len(self.trigrams) - 1)
+        if not np.all(self.trigrams[positions] == query):
+            return []
+        rarest = positions[np.argmin(self.starts[positions + 1] - self.starts[positions])]
+        return [nr for nr in self.postings[self.starts[rarest]:self.starts[rarest + 1]].tolist() if value in self.keys[nr]]
+
+def offsets(lengths: Iterable[int]) -> np.ndarray:
+    '''
+    Return the start of every part, and the total length at the end, of parts with the given lengths laid out one after the other.
+    '''
+    return np.concatenate(([0], np.cumsum(np.fromiter(lengths, dtype = np.int64)))).astype(np.int64)
+
+def _trigrams(clean_title: str, clean_artist: str) -> set[str]:
+    '''
+    Return the trigrams of the padded title and artist. Artist trigrams are marked, so they only match artist trigrams.
+    '''
+    title = f"  {clean_title} "
+    artist = f"  {clean_artist} "
+    trigrams = {title[start:start + 3] for start in range(len(title) - 2)}
+    trigrams.update("@" + artist[start:start + 3] for start in range(len(artist) - 2))
+    return trigrams
+
+def _substrings(key: str) -> set[str]:
+    '''
+    Return the trigrams of a key, without padding, so that a value inside a key has trigrams of the key only.
+    '''
+    return {key[start:start + 3] for start in range(len(key) - 2)}
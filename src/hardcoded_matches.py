@@ -0,0 +1,66 @@
+"""
+This module loads the hardcoded mapping and skip files into lookup structures.
+"""
+import hashlib
+import os
+import pickle
+
+from credentials.credentials import load_configuration
+
+def load_mapping(path: str, cache_directory: str | None = None) -> dict[str, int]:
+    '''
+    Load a mapping file of spotify track ids to plex ratingKeys as a dictionary. Raises ValueError if a ratingKey is not an int.
+    If a cache directory is given, the loaded mapping is kept there for later runs (see _load_compiled).
+    '''
+    return _load_compiled(path, _compile_mapping, cache_directory)
+
+def load_skip_list(path: str, cache_directory: str | None = None) -> frozenset[str]:
+    '''
+    Load the spotify track ids under 'skips' in a skip file as a frozenset, so that checking a track is a hash lookup.
+    If a cache directory is given, the loaded skip list is kept there for later runs (see _load_compiled).
+    '''
+    return _load_compiled(path, _compile_skip_list, cache_directory)
+
+def _compile_mapping(path: str) -> dict[str, int]:
+    mapping = {}
+    for spotify_track_id, rating_key in (load_configuration(path) or {}).items():
+        try:
+            mapping[str(spotify_track_id)] = int(rating_key)
+        except (TypeError, ValueError) as exc:
+            raise ValueError(f"Can't parse the id {rating_key} of spotify track {spotify_track_id} in {path} to an int.") from exc
+    return mapping
+
+def _compile_skip_list(path: str) -> frozenset[str]:
+    return frozenset(str(spotify_track_id) for spotify_track_id in (load_configuration(path) or {}).get('skips') or [])
+
+def _load_compiled(path: str, compile_file, cache_directory: str | None):
+    '''
+    Return the compiled contents of a file, from a pickled copy in the cache directory if the file did not change since it was compiled.
+    The copy is named after the file and a hash of its absolute path, and keyed on that path and the modification time and size of the file;
+    if it is missing, stale or unreadable, the file is compiled again. Without a cache directory, the file is compiled on every run.
+    '''
+    if cache_directory is None:
+        return compile_file(path)
+    source_path = os.path.abspath(path)
+    stat = os.stat(source_path)
+    key = (source_path, stat.st_mtime_ns, stat.st_size)
+    path_hash = hashlib.sha1(source_path.encode('utf-8')).hexdigest()[:12]
+    compiled_path = os.path.join(cache_directory, f"{os.path.basename(source_path)}.{path_hash}.compiled")
+    try:
+        with open(compiled_path, "rb") as fh:
+            compiled_key, compiled = pickle.load(fh)
+        if compiled_key == key:
+            return compiled
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError):
+        pass
+
+    compiled = compile_file(path)
+    try:
+        os.makedirs(cache_directory, exist_ok = True)
+        with open(compiled_path + ".tmp", "wb") as fh:
+            pickle.dump((key, compiled), fh, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(compiled_path + ".tmp", compiled_path)
+    except OSError:
+        # Without a writable cache directory, the file is compiled on every run.
+        pass
+    return compiled
@@ -0,0 +1,130 @@
+"""
+This module contains the HTTP session that the Plex and Spotify clients share, and the latency metrics of its requests.
+"""
+from urllib.parse import urlparse
+import random
+import re
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from src.pool import cached_factory
+
+# Number of connections kept open per host; should be at least the number of threads that make requests.
+POOL_SIZE = 8
+# Seconds to wait for a connection and for a response, before a request fails.
+TIMEOUT = 30
+# Number of times a failed request is retried, and the base of the exponential backoff in seconds.
+RETRIES = 3
+BACKOFF = 0.5
+# Responses that are retried: rate limited, and temporary server errors.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Path segments that are ids (plex ratingKeys, comma separated lists of them, or spotify ids) are grouped into one endpoint.
+_ID_SEGMENT = re.compile(r"^([\d,]+|[0-9A-Za-z]{22})$")
+
+def configure_http(pool_size: int | None = None, timeout: float | None = None, retries: int | None = None, backoff: float | None = None):
+    '''
+    Set the pool size, timeout and retry policy of the shared session. Values that are None keep their default.
+    This only affects clients that are created afterwards.
+    '''
+    global POOL_SIZE, TIMEOUT, RETRIES, BACKOFF
+    POOL_SIZE = pool_size or POOL_SIZE
+    TIMEOUT = timeout or TIMEOUT
+    RETRIES = RETRIES if retries is None else retries
+    BACKOFF = BACKOFF if backoff is None else backoff
+    shared_session.cache_clear() # type: ignore
+
+@cached_factory
+def shared_session() -> requests.Session:
+    '''
+    Return the session shared by the plex and spotify clients.
+    Connections are kept alive and pooled per host. Failed connections, rate limited responses and temporary server errors
+    are retried with exponential backoff and jitter, and a Retry-After header is honored.
+    Only reading requests are retried on a response, since a write that timed out may still have been carried out.
+    Every request is timed in latency_metrics.
+    '''
+    retry = _JitteredRetry(total = RETRIES,
+                           backoff_factor = BACKOFF,
+                           status_forcelist = RETRY_STATUSES,
+                           allowed_methods = frozenset({'GET', 'HEAD', 'OPTIONS'}),
+                           respect_retry_after_header = True,
+                           # The clients raise their own errors for the final response.
+                           raise_on_status = False)
+    adapter = HTTPAdapter(pool_connections = 4, pool_maxsize = POOL_SIZE, max_retries = retry)
+    session = _TimeoutSession()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.hooks['response'].append(_record_latency)
+    return session
+
+class _TimeoutSession(requests.Session):
+    '''
+    Session that applies the configured timeout to requests that don't set one.
+    '''
+    def request(self, method, url, *args, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = TIMEOUT
+        return super().request(method, url, *args, **kwargs)
+
+class _JitteredRetry(Retry):
+    '''
+    Retry policy that waits a random time between zero and the exponential backoff ("full jitter"),
+    so that concurrent requests that failed together don't retry together.
+    '''
+    def get_backoff_time(self) -> float:
+        return random.uniform(0, super().get_backoff_time())
+
+class LatencyMetrics:
+    '''
+    Number of requests, total and maximum latency, and number of error responses per endpoint (method, host and path without ids).
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {} # type: dict[tuple[str, str, str], list]
+
+    def record(self, method: str, url: str, seconds: float, status: int):
+        '''
+        Record one request.
+        '''
+        parsed = urlparse(url)
+        path = "/".join("{id}" if _ID_SEGMENT.match(segment) else segment for segment in parsed.path.split("/"))
+        with self._lock:
+            metrics = self.endpoints.setdefault((method, parsed.netloc, path), [0, 0.0, 0.0, 0])
+            metrics[0] += 1
+            metrics[1] += seconds
+            metrics[2] = max(metrics[2], seconds)
+            metrics[3] += status >= 400
+
+    def summary(self) -> list[dict]:
+        '''
+        Return the metrics per endpoint, the endpoint with the most total time first.
+        '''
+        with self._lock:
+            return [{'method': method, 'host': host, 'endpoint': path, 'requests': count,
+                     'total_seconds': round(total, 3), 'mean_seconds': round(total/count, 3), 'max_seconds': round(maximum, 3), 'errors': errors}
+                    for (method, host, path), (count, total, maximum, errors)
+                    in sorted(self.endpoints.items(), key = lambda item: -item[1][1])]
+
+    def print_summary(self):
+        '''
+        Print the metrics per endpoint.
+        '''
+        for metrics in self.summary():
+            print(f"\t{metrics['method']} {metrics['host']}{metrics['endpoint']}: {metrics['requests']} requests, "
+                  f"{metrics['total_seconds']}s total, {metrics['mean_seconds']}s mean, {metrics['max_seconds']}s max, {metrics['errors']} errors")
+
+latency_metrics = LatencyMetrics()
+_thread_requests = threading.local()
+
+def requests_in_thread() -> int:
+    '''
+    Return the number of requests the current thread made through the shared session, to attribute requests to the work that made them.
+    '''
+    return getattr(_thread_requests, 'count', 0)
+
+def _record_latency(response: requests.Response, *args, **kwargs):
+    latency_metrics.record(response.request.method or "", response.url, response.elapsed.total_seconds(), response.status_code)
+    _thread_requests.count = getattr(_thread_requests, 'count', 0) + 1
@@ -0,0 +1,199 @@
+"""
+This module contains the instrumentation of a sync: the time spent per stage, and the wall time, HTTP requests,
+scored candidates and hits per matching strategy. It also contains the hook for running a sync under a profiler.
+"""
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Iterable, Iterator, TypeVar
+import json
+import os
+import threading
+import time
+
+from src import http_session
+
+T = TypeVar('T')
+
+PROFILERS = ('cprofile', 'pyinstrument')
+# Number of functions printed for a cProfile run without a profile file.
+PROFILE_LINES = 30
+
+_report = None # type: SyncReport | None
+_local = threading.local()
+_NO_STAGE = nullcontext()
+
+class SyncReport:
+    '''
+    Totals of an instrumented run. Stages are recorded as number of calls and seconds; stages can overlap,
+    e.g. the spotify playlist is fetched while the tracks are matched, and the playlist is written while the next tracks are matched.
+    Strategies are recorded as attempts, hits, seconds, HTTP requests and scored candidates (the plex records a strategy compared).
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.stages = {} # type: dict[str, list]
+        self.strategies = {} # type: dict[str, list]
+
+    def record_stage(self, stage: str, seconds: float):
+        with self._lock:
+            totals = self.stages.setdefault(stage, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    def record_strategy(self, strategy: str, seconds: float, http_requests: int, candidates: int, hit: bool):
+        with self._lock:
+            totals = self.strategies.setdefault(strategy, [0, 0, 0.0, 0, 0])
+            totals[0] += 1
+            totals[1] += hit
+            totals[2] += seconds
+            totals[3] += http_requests
+            totals[4] += candidates
+
+    def to_dict(self) -> dict:
+        '''
+        Return the report as a dictionary that can be saved as JSON, including the HTTP metrics per endpoint.
+        Strategies are ordered by the time they took.
+        '''
+        with self._lock:
+            stages = {stage: {'calls': calls, 'seconds': round(seconds, 3)} for stage, (calls, seconds) in self.stages.items()}
+            strategies = {strategy: {'attempts': attempts,
+                                     'hits': hits,
+                                     'hit_rate': round(hits/attempts, 3),
+                                     'seconds': round(seconds, 3),
+                                     'mean_ms': round(1000*seconds/attempts, 3),
+                                     'ms_per_hit': round(1000*seconds/hits, 3) if hits else None,
+                                     'http_requests': http_requests,
+                                     'candidates': candidates,
+                                     'candidates_per_attempt': round(candidates/attempts, 1)}
+                          for strategy, (attempts, hits, seconds, http_requests, candidates)
+                          in sorted(self.strategies.items(), key = lambda item: -item[1][2])}
+        return {'total_seconds': round(time.perf_counter() - self.started, 3),
+                'stages': stages,
+                'strategies': strategies,
+                'http': http_session.latency_metrics.summary()}
+
+    def save(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        with open(path, "w", encoding = "utf-8") as fh:
+            json.dump(self.to_dict(), fh, indent = 2)
+
+    def print_summary(self):
+        report = self.to_dict()
+        for stage, totals in report['stages'].items():
+            print(f"\t{stage}: {totals['seconds']}s")
+        for strategy, totals in report['strategies'].items():
+            print(f"\t{strategy}: {totals['hits']}/{totals['attempts']} hits, {totals['seconds']}s, "
+                  f"{totals['http_requests']} requests, {totals['candidates_per_attempt']} candidates per track")
+
+def start_instrumentation() -> SyncReport:
+    '''
+    Start recording stages and strategies in a new report, and return it.
+    Until this is called, the instrumentation does nothing.
+    '''
+    global _report
+    _report = SyncReport()
+    return _report
+
+def stage(name: str):
+    '''
+    Context manager that adds the time spent in it to the given stage.
+    '''
+    if _report is None:
+        return _NO_STAGE
+    return _timed_stage(_report, name)
+
+@contextmanager
+def _timed_stage(report: SyncReport, name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        report.record_stage(name, time.perf_counter() - start)
+
+def timed_iter(name: str, items: Iterable[T]) -> Iterator[T]:
+    '''
+    Iterate over items, adding the time spent waiting for every next item to the given stage.
+    This is how the time of lazily fetched or lazily matched tracks ends up in their stage.
+    '''
+    report = _report
+    if report is None:
+        yield from items
+        return
+    iterator = iter(items)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            report.record_stage(name, time.perf_counter() - start)
+        yield item
+
+def timed_strategy(strategy: str, search: Callable[[], T]) -> T:
+    '''
+    Run the search of a single matching strategy, and record its time, requests, scored candidates and whether it found a track.
+    '''
+    report = _report
+    if report is None:
+        return search()
+    _local.candidates = 0
+    requests_before = http_session.requests_in_thread()
+    start = time.perf_counter()
+    found = search()
+    report.record_strategy(strategy,
+                           seconds = time.perf_counter() - start,
+                           http_requests = http_session.requests_in_thread() - requests_before,
+                           candidates = _local.candidates,
+                           hit = found is not None)
+    return found
+
+def count_candidates(nr_candidates: int):
+    '''
+    Count plex records that the current strategy compared with the spotify track.
+    '''
+    if _report is not None:
+        _local.candidates = getattr(_local, 'candidates', 0) + nr_candidates
+
+@contextmanager
+def profiled(profiler: str | None, profile_file: str | None = None):
+    '''
+    Run the code in the context under the given profiler ('cprofile' or 'pyinstrument'), or without one if it is None.
+    The profile is saved to profile_file if it is set (cProfile stats, or html for pyinstrument), and printed otherwise.
+    '''
+    if not profiler:
+        yield
+        return
+    if profiler not in PROFILERS:
+        raise ValueError(f"Profiler {profiler} is not known, valid options are {', '.join(PROFILERS)}. Please check settings.yaml.")
+
+    if profiler == 'cprofile':
+        import cProfile
+        import pstats
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+        try:
+            yield
+        finally:
+            cprofiler.disable()
+            if profile_file:
+                cprofiler.dump_stats(profile_file)
+            else:
+                pstats.Stats(cprofiler).sort_stats('cumulative').print_stats(PROFILE_LINES)
+    else:
+        try:
+            from pyinstrument import Profiler
+        except ImportError as exc:
+            raise ImportError("The pyinstrument profiler is not installed, install it with `pip install pyinstrument`.") from exc
+        sampler = Profiler()
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            if profile_file:
+                with open(profile_file, "w", encoding = "utf-8") as fh:
+                    fh.write(sampler.output_html())
+            else:
+                print(sampler.output_text())
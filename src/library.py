@@ -0,0 +1,324 @@
+"""
+This module holds a local, in-memory index of a Plex music library, so that matching does not need to search the server per track.
+"""
+from itertools import islice
+from typing import NamedTuple, Iterable, Iterator
+import threading
+from xml.etree.ElementTree import Element
+
+from plexapi.library import MusicSection
+from plexapi.audio import Track
+
+from src.candidates import CandidateIndex, KeyIndex
+from src.normalize import normalize_many
+
+# Number of items requested per page when pulling the library from the server.
+PAGE_SIZE = 2000
+# Number of ratingKeys per request when fetching full Track objects for the playlist write.
+FETCH_SIZE = 200
+# Kinds of external ids (plex guids like isrc://... and mbid://...) that are indexed for matching.
+EXTERNAL_ID_SCHEMES = ('isrc', 'mbid')
+
+class TrackRecord(NamedTuple):
+    '''
+    Compact record of a Plex track.
+    Attribute names mirror plexapi's Track, so a record can be used wherever only these attributes are read.
+    '''
+    ratingKey: int
+    title: str
+    grandparentTitle: str
+    parentTitle: str
+    grandparentRatingKey: int
+    parentRatingKey: int
+    clean_title: str
+    clean_artist: str
+    clean_album: str
+    # Space separated external ids of the track, like 'isrc:USRC17607839 mbid:...'; see external_id.
+    external_ids: str
+    # Length of the track in milliseconds, 0 if unknown.
+    duration: int
+
+class AlbumRecord(NamedTuple):
+    '''
+    Compact record of a Plex album.
+    '''
+    ratingKey: int
+    title: str
+    parentTitle: str
+    parentRatingKey: int
+    clean_title: str
+    clean_artist: str
+
+class ArtistRecord(NamedTuple):
+    '''
+    Compact record of a Plex artist.
+    '''
+    ratingKey: int
+    title: str
+    clean_title: str
+
+class LibraryIndex:
+    '''
+    In-memory index of all tracks, albums and artists in a Plex music library.
+    Records are keyed by ratingKey, and looked up through the cleaned track title, album title and artist name.
+    The only network access is pulling the library once (build) and fetching the final Track objects (fetch_tracks).
+    '''
+    def __init__(self, plexlibrary: MusicSection | None = None):
+        self.plexlibrary = plexlibrary
+        self.tracks = {} # type: dict[int, TrackRecord]
+        self.albums = {} # type: dict[int, AlbumRecord]
+        self.artists = {} # type: dict[int, ArtistRecord]
+        self.tracks_by_title = {} # type: dict[str, list[int]]
+        self.albums_by_title = {} # type: dict[str, list[int]]
+        self.artists_by_name = {} # type: dict[str, list[int]]
+        self.tracks_by_album = {} # type: dict[int, list[int]]
+        self.tracks_by_artist = {} # type: dict[int, list[int]]
+        self.tracks_by_external_id = {} # type: dict[str, int]
+        # Results of the substring searches, shared by all strategies and all tracks of a run.
+        self._search_cache = {} # type: dict[tuple[str, str], list[int]]
+        # Trigram index for fuzzy candidate search, built on first use.
+        self._candidate_index = None # type: CandidateIndex | None
+        self._candidate_lock = threading.Lock()
+        # Trigram indexes of the keys of the keyed dictionaries, for the substring searches, built on first use.
+        self._key_indexes = {} # type: dict[str, KeyIndex]
+        self._key_lock = threading.Lock()
+
+    @classmethod
+    def build(cls, plexlibrary: MusicSection, page_size: int = PAGE_SIZE) -> "LibraryIndex":
+        '''
+        Pull all tracks of the plex music library in pages and index them.
+        Albums and artists are derived from the parent attributes of the tracks, so they cost no extra requests.
+        '''
+        index = cls(plexlibrary)
+        for record in _track_records_from_elements(_iter_elements(plexlibrary, page_size)):
+            index.add_track(record)
+        return index
+
+    def add_track(self, record: TrackRecord):
+        '''
+        Add a track record to the index, together with its album and artist.
+        '''
+        self._search_cache.clear()
+        self._candidate_index = None
+        self._key_indexes = {}
+        self.tracks[record.ratingKey] = record
+        self.tracks_by_title.setdefault(record.clean_title, []).append(record.ratingKey)
+        self.tracks_by_album.setdefault(record.parentRatingKey, []).append(record.ratingKey)
+        self.tracks_by_artist.setdefault(record.grandparentRatingKey, []).append(record.ratingKey)
+        for external_id in record.external_ids.split():
+            self.tracks_by_external_id.setdefault(external_id, record.ratingKey)
+
+        if record.parentRatingKey not in self.albums:
+            self.albums[record.parentRatingKey] = AlbumRecord(
+                ratingKey = record.parentRatingKey,
+                title = record.parentTitle,
+                parentTitle = record.grandparentTitle,
+                parentRatingKey = record.grandparentRatingKey,
+                clean_title = record.clean_album,
+                clean_artist = record.clean_artist,
+            )
+            self.albums_by_title.setdefault(record.clean_album, []).append(record.parentRatingKey)
+
+        if record.grandparentRatingKey not in self.artists:
+            self.artists[record.grandparentRatingKey] = ArtistRecord(
+                ratingKey = record.grandparentRatingKey,
+                title = record.grandparentTitle,
+                clean_title = record.clean_artist,
+            )
+            self.artists_by_name.setdefault(record.clean_artist, []).append(record.grandparentRatingKey)
+
+    def search_tracks(self, title: str) -> list[TrackRecord]:
+        '''
+        Return all tracks whose cleaned title contains the given cleaned title.
+        '''
+        return self._records(self.tracks, self._search('tracks_by_title', title))
+
+    def search_albums(self, title: str, artist: str | None = None) -> list[AlbumRecord]:
+        '''
+        Return all albums whose cleaned title contains the given cleaned title.
+        If an artist is given, the cleaned album artist must contain it as well.
+        '''
+        albums = self._records(self.albums, self._search('albums_by_title', title))
+        if artist is not None:
+            albums = [album for album in albums if artist in album.clean_artist]
+        return albums
+
+    def search_artists(self, name: str) -> list[ArtistRecord]:
+        '''
+        Return all artists whose cleaned name contains the given cleaned name.
+        '''
+        return self._records(self.artists, self._search('artists_by_name', name))
+
+    def track_by_external_id(self, scheme: str, value: str) -> TrackRecord | None:
+        '''
+        Return the track with the given external id (e.g. 'isrc' and 'USRC17607839'), if the library has one.
+        '''
+        rating_key = self.tracks_by_external_id.get(external_id(scheme, value))
+        return self.tracks[rating_key] if rating_key is not None else None
+
+    def candidate_tracks(self, title: str, artist: str) -> list[TrackRecord]:
+        '''
+        Return the tracks whose cleaned title and artist look most like the given cleaned title and artist, best first (see CandidateIndex).
+        Unlike search_tracks, this also finds tracks with a misspelled or differently worded title.
+        '''
+        return self._records(self.tracks, self.candidate_index().search(title, artist))
+
+    def candidate_index(self) -> CandidateIndex:
+        '''
+        Return the trigram index of the tracks, building it on first use.
+        '''
+        if self._candidate_index is None:
+            with self._candidate_lock:
+                if self._candidate_index is None:
+                    self._candidate_index = CandidateIndex((record.ratingKey, record.clean_title, record.clean_artist)
+                                                           for record in self.tracks.values())
+        return self._candidate_index
+
+    def key_index(self, keyed_name: str) -> KeyIndex:
+        '''
+        Return the trigram index of the keys of the given keyed dictionary (e.g. 'tracks_by_title'), building it on first use.
+        '''
+        if keyed_name not in self._key_indexes:
+            with self._key_lock:
+                if keyed_name not in self._key_indexes:
+                    self._key_indexes[keyed_name] = KeyIndex(getattr(self, keyed_name))
+        return self._key_indexes[keyed_name]
+
+    def _search(self, keyed_name: str, value: str) -> list[int]:
+        '''
+        Return the ratingKeys of the entries in the given keyed dictionary whose key contains value.
+        Results are memoized, so strategies that search for the same album, artist or title only look the keys up once.
+        '''
+        cache_key = (keyed_name, value)
+        if cache_key not in self._search_cache:
+            self._search_cache[cache_key] = _search_keys(getattr(self, keyed_name), self.key_index(keyed_name), value)
+        return self._search_cache[cache_key]
+
+    def _records(self, table: dict, rating_keys: list[int]) -> list:
+        '''
+        Return the records with the given ratingKeys from one of the tables of records (tracks, albums or artists).
+        '''
+        return [table[key] for key in rating_keys]
+
+    def album_tracks(self, album_key: int) -> list[TrackRecord]:
+        '''
+        Return all tracks on the album with the given ratingKey.
+        '''
+        return self._records(self.tracks, self.tracks_by_album.get(album_key, []))
+
+    def artist_tracks(self, artist_key: int) -> list[TrackRecord]:
+        '''
+        Return all tracks of the artist with the given ratingKey.
+        '''
+        return self._records(self.tracks, self.tracks_by_artist.get(artist_key, []))
+
+    def fetch_tracks(self, records: list[TrackRecord], fetch_size: int = FETCH_SIZE) -> list[Track]:
+        '''
+        Fetch the full plex Track objects for the given records, in the same order.
+        Tracks are requested in bulk by ratingKey, fetch_size at a time.
+        '''
+        assert self.plexlibrary is not None
+        unique_keys = list(dict.fromkeys(record.ratingKey for record in records))
+        fetched = {} # type: dict[int, Track]
+        for start in range(0, len(unique_keys), fetch_size):
+            for track in self.plexlibrary.fetchItems(unique_keys[start:start + fetch_size]):
+                fetched[track.ratingKey] = track
+        missing = [key for key in unique_keys if key not in fetched]
+        if missing:
+            raise ValueError(f"Plex tracks with IDs {missing} are no longer in the library, please rerun the sync.")
+        return [fetched[record.ratingKey] for record in records]
+
+def _search_keys(keyed: dict[str, list[int]], key_index: KeyIndex, value: str) -> list[int]:
+    '''
+    Return the ratingKeys of all entries whose key contains value, with exact key matches first.
+    The keys that contain value are found through the trigram index of the keys, in the order of the dictionary.
+    '''
+    found = list(keyed.get(value, []))
+    if not value:
+        return found
+    for nr in key_index.containing(value):
+        key = key_index.keys[nr]
+        if key != value:
+            found.extend(keyed[key])
+    return found
+
+def _iter_elements(plexlibrary: MusicSection, page_size: int, libtype: int = 10, sort: str | None = None) -> Iterator[Element]:
+    '''
+    Iterate over the raw XML elements of all items of the given type (10 for tracks, 9 for albums) in the library, requesting page_size items at a time.
+    The raw elements are used instead of plexapi objects, which are much more expensive to build.
+    Optionally the items are sorted server-side, e.g. 'updatedAt:desc'.
+    '''
+    params = {'type': libtype, 'includeGuids': 1} # type: dict[str, int | str]
+    if sort:
+        params['sort'] = sort
+    start = 0
+    while True:
+        data = plexlibrary._server.query(f"/library/sections/{plexlibrary.key}/all",
+                                         params = params,
+                                         headers = {'X-Plex-Container-Start': str(start),
+                                                    'X-Plex-Container-Size': str(page_size)},
+                                         )
+        elements = list(data) if data is not None else []
+        yield from elements
+        start += len(elements)
+        if len(elements) < page_size:
+            return
+
+def _library_size(plexlibrary: MusicSection, libtype: int = 10) -> int:
+    '''
+    Return the number of items of the given type in the library, without fetching any of them.
+    '''
+    data = plexlibrary._server.query(f"/library/sections/{plexlibrary.key}/all",
+                                     params = {'type': libtype},
+                                     headers = {'X-Plex-Container-Start': '0',
+                                                'X-Plex-Container-Size': '0'},
+                                     )
+    return int(data.get('totalSize', 0)) if data is not None else 0
+
+def _track_records_from_elements(elements: Iterable[Element], batch_size: int = PAGE_SIZE) -> Iterator[TrackRecord]:
+    '''
+    Build track records from raw track elements of a library listing.
+    The titles, artists and albums are cleaned in one pass per batch of batch_size elements.
+    '''
+    elements = iter(elements)
+    while batch := list(islice(elements, batch_size)):
+        titles = [element.get('title', '') for element in batch]
+        artists = [element.get('grandparentTitle', '') for element in batch]
+        albums = [element.get('parentTitle', '') for element in batch]
+        for element, title, artist, album, clean_title, clean_artist, clean_album in zip(
+                batch, titles, artists, albums, normalize_many(titles), normalize_many(artists), normalize_many(albums)):
+            yield TrackRecord(
+                ratingKey = int(element.get('ratingKey', 0)),
+                title = title,
+                grandparentTitle = artist,
+                parentTitle = album,
+                grandparentRatingKey = int(element.get('grandparentRatingKey', 0)),
+                parentRatingKey = int(element.get('parentRatingKey', 0)),
+                clean_title = clean_title,
+                clean_artist = clean_artist,
+                clean_album = clean_album,
+                external_ids = _external_ids(element),
+                duration = int(element.get('duration') or 0),
+            )
+
+def external_id(scheme: str, value: str) -> str:
+    '''
+    Return the normalized form of an external id under which tracks are indexed, e.g. 'isrc:USRC17607839'.
+    ISRCs are compared without case and hyphens, other ids without case.
+    '''
+    scheme = scheme.lower()
+    value = value.strip()
+    if scheme == 'isrc':
+        return f"isrc:{value.replace('-', '').upper()}"
+    return f"{scheme}:{value.lower()}"
+
+def _external_ids(element: Element) -> str:
+    '''
+    Return the indexed external ids of a raw track element, from its Guid children (listed with includeGuids).
+    '''
+    external_ids = []
+    for guid in element.iter('Guid'):
+        scheme, _, value = guid.get('id', '').partition('://')
+        if value and scheme.lower() in EXTERNAL_ID_SCHEMES:
+            external_ids.append(external_id(scheme, value))
+    return ' '.join(external_ids)
@@ -0,0 +1,131 @@
+"""
+This module persists the Plex library index to a local SQLite file, and refreshes it incrementally on every run.
+"""
+from contextlib import closing
+from itertools import tee
+from typing import Iterable, Iterator
+from xml.etree.ElementTree import Element
+import os
+import sqlite3
+
+from plexapi.library import MusicSection
+
+from src.library import LibraryIndex, TrackRecord, PAGE_SIZE, _iter_elements, _library_size, _track_records_from_elements
+
+# Bump this whenever TrackRecord or the title cleaning changes, so that stale caches are rebuilt.
+SCHEMA_VERSION = 3
+
+TRACK_COLUMNS = TrackRecord._fields + ('updatedAt', 'addedAt')
+
+def load_library_index(plexlibrary: MusicSection, cache_path: str, page_size: int = PAGE_SIZE) -> LibraryIndex:
+    '''
+    Load the library index from the cache file and bring it up to date with the plex library.
+    Only tracks added or updated since the last snapshot are fetched, and deleted tracks are only searched for if the track count changed.
+    Without a usable cache file the whole library is fetched once, and the cache file is created.
+    '''
+    directory = os.path.dirname(cache_path)
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+
+    with closing(sqlite3.connect(cache_path)) as connection:
+        with connection:
+            snapshot = _prepare_cache(connection, plexlibrary)
+            if snapshot:
+                _fetch_changed_tracks(connection, plexlibrary, snapshot, page_size)
+            else:
+                _store_tracks(connection, _iter_elements(plexlibrary, page_size))
+
+            nr_cached = connection.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+            if snapshot and nr_cached != _library_size(plexlibrary):
+                _remove_deleted_tracks(connection, plexlibrary, page_size)
+
+            new_snapshot = connection.execute("SELECT MAX(MAX(updatedAt, addedAt)) FROM tracks").fetchone()[0]
+            _set_meta(connection, 'snapshot', new_snapshot or 0)
+
+        index = LibraryIndex(plexlibrary)
+        columns = ', '.join(TrackRecord._fields)
+        for row in connection.execute(f"SELECT {columns} FROM tracks"):
+            index.add_track(TrackRecord(*row))
+    return index
+
+def _prepare_cache(connection: sqlite3.Connection, plexlibrary: MusicSection) -> int:
+    '''
+    Create the cache tables if needed and return the timestamp of the last snapshot.
+    Returns 0 (and recreates the empty tracks table) if the cache was made for another library or with another schema version.
+    '''
+    connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    meta = dict(connection.execute("SELECT key, value FROM meta").fetchall())
+    if meta.get('schema_version') == str(SCHEMA_VERSION) and meta.get('library') == str(plexlibrary.uuid):
+        return int(meta.get('snapshot', 0))
+
+    # The columns may have changed with the schema version.
+    connection.execute("DROP TABLE IF EXISTS tracks")
+    connection.execute("""CREATE TABLE tracks (
+                            ratingKey INTEGER PRIMARY KEY, title TEXT, grandparentTitle TEXT, parentTitle TEXT,
+                            grandparentRatingKey INTEGER, parentRatingKey INTEGER,
+                            clean_title TEXT, clean_artist TEXT, clean_album TEXT, external_ids TEXT, duration INTEGER,
+                            updatedAt INTEGER, addedAt INTEGER)""")
+    connection.execute("CREATE INDEX tracks_album ON tracks (parentRatingKey)")
+    _set_meta(connection, 'schema_version', SCHEMA_VERSION)
+    _set_meta(connection, 'library', plexlibrary.uuid)
+    _set_meta(connection, 'snapshot', 0)
+    return 0
+
+def _set_meta(connection: sqlite3.Connection, key: str, value: str | int):
+    '''
+    Store a value in the meta table of the cache.
+    '''
+    connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+def _store_tracks(connection: sqlite3.Connection, elements: Iterable[Element]):
+    '''
+    Insert or update the tracks of the given raw track elements in the cache.
+    '''
+    placeholders = ', '.join('?' for _ in TRACK_COLUMNS)
+    connection.executemany(f"INSERT OR REPLACE INTO tracks ({', '.join(TRACK_COLUMNS)}) VALUES ({placeholders})",
+                           _track_rows_from_elements(elements))
+
+def _track_rows_from_elements(elements: Iterable[Element]) -> Iterator[tuple]:
+    '''
+    Build cache rows from raw track elements: the track record plus its updatedAt and addedAt timestamps.
+    '''
+    elements, timestamps = tee(elements)
+    for record, element in zip(_track_records_from_elements(elements), timestamps):
+        yield (*record, int(element.get('updatedAt', 0)), int(element.get('addedAt', 0)))
+
+def _fetch_changed_tracks(connection: sqlite3.Connection, plexlibrary: MusicSection, snapshot: int, page_size: int):
+    '''
+    Fetch the tracks that were added or updated since the snapshot, newest first, and stop at the first older track.
+    '''
+    for field in ('addedAt', 'updatedAt'):
+        elements = _iter_elements(plexlibrary, page_size, sort = f"{field}:desc")
+        _store_tracks(connection, _take_while_newer(elements, field, snapshot))
+
+def _take_while_newer(elements, field: str, snapshot: int):
+    '''
+    Yield elements while their timestamp field is not older than the snapshot.
+    Stopping here stops the paged request of the underlying iterator as well.
+    '''
+    for element in elements:
+        if int(element.get(field, 0)) < snapshot:
+            return
+        yield element
+
+def _remove_deleted_tracks(connection: sqlite3.Connection, plexlibrary: MusicSection, page_size: int):
+    '''
+    Remove deleted tracks from the cache.
+    The track counts per album are compared with the cache, and only the albums whose count differs are refetched.
+    '''
+    server_counts = {int(element.get('ratingKey', 0)): int(element.get('leafCount', 0))
+                     for element in _iter_elements(plexlibrary, page_size, libtype = 9)}
+    cached_counts = dict(connection.execute("SELECT parentRatingKey, COUNT(*) FROM tracks GROUP BY parentRatingKey").fetchall())
+
+    for album_key, cached_count in cached_counts.items():
+        if album_key not in server_counts:
+            connection.execute("DELETE FROM tracks WHERE parentRatingKey = ?", (album_key,))
+        elif server_counts[album_key] != cached_count:
+            elements = list(plexlibrary._server.query(f"/library/metadata/{album_key}/children", params = {'includeGuids': 1}) or [])
+            current_keys = [int(element.get('ratingKey', 0)) for element in elements]
+            connection.execute(f"DELETE FROM tracks WHERE parentRatingKey = ? AND ratingKey NOT IN ({', '.join('?' for _ in current_keys)})",
+                               (album_key, *current_keys))
+            _store_tracks(connection, elements)
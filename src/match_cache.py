@@ -0,0 +1,78 @@
+"""
+This module keeps an append-only SQLite cache of earlier Spotify -> Plex matches, so that repeat syncs don't need to search again.
+"""
+from contextlib import closing
+from typing import TYPE_CHECKING
+import json
+import os
+import sqlite3
+import time
+
+from src.library import LibraryIndex, TrackRecord
+from src.matching import expand_matching_pattern
+from src.normalize import clean_title
+from src import scoring
+
+if TYPE_CHECKING:
+    from src.spotify import SpotifyTrack
+
+class MatchCache:
+    '''
+    Cache of spotify track id -> plex ratingKey matches, with the strategy, score and time of every match.
+    Rows are only ever appended; the latest row per spotify track counts.
+    A cached match is only used if it was made with the current matching settings and its plex track is still in the library index.
+    '''
+    def __init__(self, cache_path: str, library_index: LibraryIndex, matching_pattern: str | list[str]):
+        self.cache_path = cache_path
+        self.library_index = library_index
+        self.config = json.dumps([expand_matching_pattern(matching_pattern), scoring.SCORE_CUTOFF, scoring.DURATION_TOLERANCE])
+        self.matches = {} # type: dict[str, TrackRecord]
+        self._new_rows = [] # type: list[tuple[str, int, str, float, str, int]]
+
+        directory = os.path.dirname(cache_path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        with closing(sqlite3.connect(cache_path)) as connection, connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS matches (
+                                    spotify_id TEXT, ratingKey INTEGER, strategy TEXT, score REAL, config TEXT, matched_at INTEGER)""")
+            rows = connection.execute("""SELECT spotify_id, ratingKey FROM matches
+                                         WHERE rowid IN (SELECT MAX(rowid) FROM matches GROUP BY spotify_id) AND config = ?""",
+                                      (self.config,)).fetchall()
+        # Validating is a lookup in the library index, so deleted plex tracks drop out without any request.
+        for spotify_id, rating_key in rows:
+            if rating_key in library_index.tracks:
+                self.matches[spotify_id] = library_index.tracks[rating_key]
+
+    def get(self, spotify_track_id: str) -> TrackRecord | None:
+        '''
+        Return the cached plex track for a spotify track id, or None.
+        '''
+        return self.matches.get(spotify_track_id)
+
+    def add(self, spotify_track: "SpotifyTrack", plex_track: TrackRecord, strategy: str):
+        '''
+        Remember a match found by a matching strategy. It is written to file on save().
+        '''
+        if not spotify_track.id or self.matches.get(spotify_track.id) == plex_track:
+            return
+        self.matches[spotify_track.id] = plex_track
+        self._new_rows.append((spotify_track.id, plex_track.ratingKey, strategy,
+                               _match_score(spotify_track, plex_track), self.config, int(time.time())))
+
+    def save(self):
+        '''
+        Append the new matches to the cache file.
+        '''
+        if not self._new_rows:
+            return
+        with closing(sqlite3.connect(self.cache_path)) as connection, connection:
+            connection.executemany("INSERT INTO matches VALUES (?, ?, ?, ?, ?, ?)", self._new_rows)
+        self._new_rows = []
+
+def _match_score(spotify_track: "SpotifyTrack", plex_track: TrackRecord) -> float:
+    '''
+    Score (0-100) of how well a match fits: the mean fuzzy score of the cleaned title and artist.
+    '''
+    title_score = scoring.score_choices(clean_title(spotify_track.name), [plex_track.clean_title])[0]
+    artist_score = scoring.score_choices(clean_title(spotify_track.artist), [plex_track.clean_artist])[0]
+    return float(title_score + artist_score)/2
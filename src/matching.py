@@ -1,353 +1,340 @@
 """
 This module handles Spotify -> Plex track matching.
 """
-from typing import cast, Sequence
-import re
-import unicodedata
+from functools import partial
+from typing import TYPE_CHECKING, Collection
 
 from rapidfuzz import fuzz
 
-from plexapi.library import MusicSection
-from plexapi.server import PlexServer
-from plexapi.audio import Track, Album
-from plexapi.exceptions import NotFound
+from src.instrumentation import timed_strategy, count_candidates
+from src.normalize import clean_title
+from src.scoring import score_choices, best_index, best_choice, above_cutoff, within_duration, duration_distances
 
-def match_track(plexlibrary: MusicSection,
-                spotify_track: dict[str,str],
-                skip_list: list[str] | None,
-                mapping_dict: dict[str,str] | None,
+if TYPE_CHECKING:
+    from src.library import LibraryIndex, TrackRecord, AlbumRecord
+    from src.match_cache import MatchCache
+    from src.spotify import SpotifyTrack
+
+def match_track(library_index: "LibraryIndex",
+                spotify_track: "SpotifyTrack",
+                skip_list: Collection[str] | None,
+                mapping_dict: dict[str,int] | None,
                 matching_strength: str | list[str],
-                plexserver: PlexServer | None = None,
-                ) -> Track | None | str:
+                match_cache: "MatchCache | None" = None,
+                album_assignments: "dict[tuple[str, str], TrackRecord | None] | None" = None,
+                ) -> "tuple[TrackRecord | None | str, str | None]":
     '''
     Try to link a spotify track to a plex track. Returns None if no track is found.
-    First checks if track is in the skip list.
-    Then tries to retrieve the track from the mapping.
+    First checks if track is in the skip list (best a set, see src.hardcoded_matches).
+    Then tries to retrieve the track from the mapping, and then from the cache of earlier matches.
     If that doesn't results in a track, a search is performed.
+    For the album strategies, the search uses the assignments of album_assignments if it has one for the track (see src.album_matching).
+    The second return value tells how the track was linked: 'skip', 'mapping', 'cache', the name of the matching strategy, or None.
     '''
     plex_track = None
     if skip_list:
-        if spotify_track['id'] in skip_list:
-            return "Skipped"
+        if spotify_track.id in skip_list:
+            return "Skipped", 'skip'
 
     if mapping_dict:
         plex_track = retrieve_track_from_mapping(
-                            plexlibrary = plexlibrary,
-                            spotify_track_id = spotify_track['id'],
+                            library_index = library_index,
+                            spotify_track_id = spotify_track.id,
                             mapping_dict = mapping_dict,
         )
-    if not plex_track:
-        plex_track = search_track(
-            plexlibrary=plexlibrary,
-            spotify_track = spotify_track, # type: ignore
-            matching_strength = matching_strength,
-            plexserver = plexserver,
-        )
-    return plex_track 
+        if plex_track:
+            return plex_track, 'mapping'
+    if match_cache:
+        plex_track = match_cache.get(spotify_track.id)
+        if plex_track:
+            return plex_track, 'cache'
+    return search_track_with_strategy(
+        library_index = library_index,
+        spotify_track = spotify_track, # type: ignore
+        matching_strength = matching_strength,
+        album_assignments = album_assignments,
+    )
 
-def retrieve_track_from_mapping(plexlibrary: MusicSection,
+def retrieve_track_from_mapping(library_index: "LibraryIndex",
                                 spotify_track_id: str,
-                                mapping_dict: dict[str,str]
-                                ) -> Track | None:
+                                mapping_dict: dict[str,int]
+                                ) -> "TrackRecord | None":
     '''
     Try to retrieve the track from the plex music library using the mapping dictionary.
     The mapping dictionary maps spotify track ids to plex track ids.
     '''
     try:
-        return plexlibrary.fetchItem(int(mapping_dict[spotify_track_id]))
+        plex_track = library_index.tracks.get(int(mapping_dict[spotify_track_id]))
     except ValueError as exc:
         raise ValueError(f"\tCan't parse the id {mapping_dict[spotify_track_id]} to an int.") from exc
-    except NotFound:
-        print(f"\tCan't find Plex track with ID {mapping_dict[spotify_track_id]}")
-        return None
     except KeyError:
         return None
+    if plex_track is None:
+        print(f"\tCan't find Plex track with ID {mapping_dict[spotify_track_id]}")
+    return plex_track
 
-def search_track(plexlibrary: MusicSection,
-                 spotify_track: dict[str,str|dict|list],
-                 matching_strength: str | list[str],
-                 plexserver: PlexServer | None = None,
-                 ) -> Track | None:
+# Strategies that first look up the album; tracks of the same album can be matched together, see src.album_matching.
+ALBUM_STRATEGIES = ('album', 'albumartist')
+MATCHING_STRATEGIES = ('isrc', 'exact', 'strict', 'loose', 'artist', 'artistfuzzy', 'album', 'albumartist', 'hubsearch')
+DESCENDING_PATTERN = ['isrc', 'exact', 'strict', 'albumartist', 'album', 'artist', 'loose']
+
+def search_track_with_strategy(library_index: "LibraryIndex",
+                               spotify_track: "SpotifyTrack",
+                               matching_strength: str | list[str],
+                                              album_assignments: "dict[tuple[str, str], TrackRecord | None] | None" = None,
+                               ) -> "tuple[TrackRecord | None, str | None]":
+    '''
+    Search for a match with the given spotify track in the plex library index, and return it with the name of the strategy that found it.
+    For a list of strategies (or 'descending'), the strategies are tried in order and the search stops at the first match.
+    Returns (None, None) if no strategy finds a match.
+    Every strategy is timed in the instrumentation report, if one is started.
+    '''
+    for strength in expand_matching_pattern(matching_strength):
+        found_track = timed_strategy(strength, partial(_search_track_single, library_index, spotify_track, strength, album_assignments))
+        if found_track:
+            return found_track, strength
+    return None, None
+
+def expand_matching_pattern(matching_strength: str | list[str]) -> list[str]:
     '''
-    Search for a match with the given spotify track in the plex library.
-    The settings determine how strict the matching is, or what method is used.
+    Expand a matching setting to the ordered list of strategies it stands for.
+    Raises ValueError for unknown strategies.
     '''
     if isinstance(matching_strength, list):
-        found_track = None
-        for strength in matching_strength:
-            found_track = search_track(plexlibrary = plexlibrary,
-                                       spotify_track = spotify_track,
-                                       matching_strength = strength,
-                                       plexserver = plexserver,
-                                       )
-        return found_track
-    if matching_strength == 'exact':
-        return _search_track_exact(plexlibrary, spotify_track)
+        return [strength for item in matching_strength for strength in expand_matching_pattern(item)]
+    if matching_strength == 'descending':
+        return list(DESCENDING_PATTERN)
+    if matching_strength not in MATCHING_STRATEGIES:
+        raise ValueError(f"Matching setting {matching_strength} is unknown, available values are:\n\t isrc, exact, strict, loose, album, artist, artistfuzzy, albumartist, hubsearch, descending")
+    return [matching_strength]
+
+def _search_track_single(library_index: "LibraryIndex",
+                         spotify_track: "SpotifyTrack",
+                         matching_strength: str,
+                                  album_assignments: "dict[tuple[str, str], TrackRecord | None] | None" = None,
+                         ) -> "TrackRecord | None":
+    '''
+    Search for a match with the given spotify track using a single strategy.
+    '''
+    if album_assignments and (matching_strength, spotify_track.id) in album_assignments:
+        return album_assignments[(matching_strength, spotify_track.id)]
+    if matching_strength == 'isrc':
+        return _search_track_by_external_id(library_index, spotify_track)
+    elif matching_strength == 'exact':
+        return _search_track_exact(library_index, spotify_track)
     elif matching_strength == 'strict':
-        return _search_track_strict(plexlibrary, spotify_track)
+        return _search_track_strict(library_index, spotify_track)
     elif matching_strength == 'loose':
-        return _search_track_loose(plexlibrary, spotify_track)
+        return _search_track_loose(library_index, spotify_track)
     elif matching_strength == 'artist':
-        return _search_track_by_artist(plexlibrary, spotify_track)
+        return _search_track_by_artist(library_index, spotify_track)
     elif matching_strength == 'artistfuzzy':
-        return _search_track_by_artist(plexlibrary, spotify_track, fuzzymatch = True)
+        return _search_track_by_artist(library_index, spotify_track, fuzzymatch = True)
     elif matching_strength == 'album':
-        return _search_track_by_album(plexlibrary, spotify_track)
+        return _search_track_by_album(library_index, spotify_track)
     elif matching_strength == 'albumartist':
-        return _search_track_by_album_and_artist(plexlibrary, spotify_track)
+        return _search_track_by_album_and_artist(library_index, spotify_track)
     elif matching_strength == 'hubsearch':
-        if not plexserver:
-            raise ValueError("For hubsearch-based mapping, please provide a plexserver instance.")
-        return _search_track_by_hubsearch(plexserver, spotify_track)
-    elif matching_strength == 'descending':
-        return search_track(plexlibrary = plexlibrary,
-                            spotify_track = spotify_track,
-                            matching_strength = [
-                                'exact',
-                                'strict',
-                                'albumartist',
-                                'album',
-                                'artist',
-                                'loose',
-                                ],
-                                plexserver = plexserver,
-                            )
+        return _search_track_by_hubsearch(library_index, spotify_track)
     else:
-        raise ValueError(f"Matching setting {matching_strength} is unknown, available values are:\n\t exact, strict, loose, album, artist, albumartist, descending")
-
-def _clean_title(title: str) -> str:
-    """Clean Spotify or Plex track/album titles for matching."""
-    if not isinstance(title, str):
-        return ""   
-    # Normalize Unicode (accents, dashes, etc.)
-    title = unicodedata.normalize("NFKD", title)
-
-    # Lowercase for consistency
-    title = title.lower()
-
-    # Remove common suffixes after a dash, like " - remastered 2008", " - edit", " - mono lp version"
-    title = re.sub(
-        r"\s*-\s*.*?(remaster(ed)?(\s*\d{4})?|mono|stereo|single|album|radio|"
-        r"bonus|lp|version|mix|edit|take|alt|acoustic|live|reissue)\b.*",
-        "",
-        title,
-        flags=re.IGNORECASE,
-    )
-
-    # Remove parenthetical metadata like "(Remastered)", "(Deluxe Edition)", "(Bonus Track)", "(Single Version)"
-    title = re.sub(
-        r"\s*\(([^)]*(remaster|deluxe|bonus|version|mix|edit|take|acoustic|mono|stereo|live|album|radio)[^)]*)\)",
-        "",
-        title,
-        flags=re.IGNORECASE,
-    )
-
-    # Remove trailing album references like "(from ...)" or "(...) version"
-    title = re.sub(r"\s*\(from [^)]*\)", "", title, flags=re.IGNORECASE)
-    title = re.sub(r"\s*\(.*?version\)", "", title, flags=re.IGNORECASE)
-
-    # Remove redundant punctuation and multiple spaces
-    title = re.sub(r'[\[\]\(\)"]', "", title)
-    # Replace multiple dots with a space to avoid issues with URLs
-    title = re.sub(r'\.{2,}', ' ', title)
-    title = re.sub(r"\s{2,}", " ", title)
-
-    # Strip punctuation at ends
-    title = title.strip(" -_.")
+        raise ValueError(f"Matching setting {matching_strength} is unknown, available values are:\n\t isrc, exact, strict, loose, album, artist, artistfuzzy, albumartist, hubsearch, descending")
 
-    return title.strip()
+def _search_track_by_external_id(library_index: "LibraryIndex", spotify_track: "SpotifyTrack") -> "TrackRecord | None":
+    '''
+    Look up the plex track by the external ids of the spotify track (its ISRC), in the external id index of the library.
+    This is a single hash lookup, and only finds tracks whose plex guids carry the same id.
+    '''
+    if not spotify_track.isrc:
+        return None
+    found = library_index.track_by_external_id('isrc', spotify_track.isrc)
+    if found:
+        count_candidates(1)
+    return found
 
-def _search_track_exact(plexlibrary: MusicSection, spotify_track:  dict) -> Track | None:
+def _search_track_exact(library_index: "LibraryIndex", spotify_track: "SpotifyTrack") -> "TrackRecord | None":
     '''
     Search the plex library for a given track based on the exact song title, artist name and album title.
     This includes titles with e.g. 'Remastered edition' etc., so the overlap has to be exact.
     '''
-    track_name = spotify_track['name']
+    track_name = spotify_track.name.lower()
 
-    artists = spotify_track['artists']
-    artist_name = artists[0]['name']
+    artist_name = spotify_track.artist.lower()
 
-    spotify_album_name = spotify_track['album']['name']
+    spotify_album_name = spotify_track.album.lower()
 
-    filters = {
-        "artist.title": artist_name,
-        "album.title": spotify_album_name,
-               }
-
-    found_tracks = plexlibrary.searchTracks(title = track_name,
-                                        filters = filters,
-                         )
-    if found_tracks:
-        return found_tracks[0]
-    else:
-        return None
+    found_tracks = library_index.search_tracks(clean_title(track_name))
+    count_candidates(len(found_tracks))
+    for found in found_tracks:
+        if (track_name in found.title.lower()
+                and artist_name in found.grandparentTitle.lower()
+                and spotify_album_name in found.parentTitle.lower()
+                and within_duration(spotify_track.duration_ms, [found])):
+            return found
+    return None
 
-def _search_track_strict(plexlibrary: MusicSection, spotify_track: dict) -> Track | None:
+def _search_track_strict(library_index: "LibraryIndex", spotify_track: "SpotifyTrack") -> "TrackRecord | None":
     '''
     Search the plex library for a given track based on the song title and artist name.
     Returns a track if the album title also aligns, otherwise returns None.
     '''
-    track_name = _clean_title(spotify_track['name'])
+    track_name = clean_title(spotify_track.name)
 
-    artists = spotify_track['artists']
-    artist_name = _clean_title(artists[0]['name'])
+    artist_name = clean_title(spotify_track.artist)
 
-    spotify_album_name = _clean_title(spotify_track['album']['name'])
+    spotify_album_name = clean_title(spotify_track.album)
 
-    filters = {
-        "artist.title": artist_name,
-        "album.title": spotify_album_name,
-               }
-
-    found_tracks = plexlibrary.searchTracks(title = track_name,
-                                        filters = filters,
-                         )
+    candidates = library_index.search_tracks(track_name)
+    count_candidates(len(candidates))
+    found_tracks = within_duration(spotify_track.duration_ms,
+                                   [found for found in candidates if artist_name in found.clean_artist and spotify_album_name in found.clean_album])
 
     for found in found_tracks:
-        if fuzz.partial_ratio(spotify_album_name, _clean_title(found.album().title)) > 0.8:
+        if fuzz.partial_ratio(spotify_album_name, found.clean_album) > 0.8:
             return found
     
     return None
 
-def _search_track_by_artist(plexlibrary: MusicSection, spotify_track: dict, fuzzymatch = False) -> Track | None:
+def _search_track_by_artist(library_index: "LibraryIndex", spotify_track: "SpotifyTrack", fuzzymatch = False) -> "TrackRecord | None":
     '''
     Search the plex library for a given track by first searching for the artist.
     If an artist is found, returns a track if the artist has a track that aligns with the track name (either with fuzzy logic or not). Otherwise returns None.
 
     '''
-    spotify_track_name = _clean_title(spotify_track['name'])
+    spotify_track_name = clean_title(spotify_track.name)
 
-    artists = spotify_track['artists']
-    spotify_artist_name = _clean_title(artists[0]['name'])
+    spotify_artist_name = clean_title(spotify_track.artist)
 
-    found_artists = plexlibrary.searchArtists(title = spotify_artist_name)
+    found_artists = library_index.search_artists(spotify_artist_name)
+    count_candidates(len(found_artists))
 
     matched_artist = None
-    for found_artist in found_artists:
-        if fuzzymatch:
-            if fuzz.partial_ratio(spotify_artist_name, _clean_title(found_artist.title)) > 80:
-                matched_artist = found_artist
-                continue
-        else:
-            if spotify_artist_name == _clean_title(found_artist.title):
+    if fuzzymatch:
+        artist_index = best_choice(spotify_artist_name, [found_artist.clean_title for found_artist in found_artists])
+        if artist_index is not None:
+            matched_artist = found_artists[artist_index]
+    else:
+        for found_artist in found_artists:
+            if spotify_artist_name == found_artist.clean_title:
                 matched_artist = found_artist
-                continue
     
     if matched_artist:
-        for plex_track in matched_artist.tracks():
-            if fuzzymatch:
-                if fuzz.partial_ratio(spotify_track_name, _clean_title(plex_track.title)) > 80:
-                    return plex_track
-            else:
-                if spotify_track_name == _clean_title(plex_track.title):
+        artist_tracks = within_duration(spotify_track.duration_ms, library_index.artist_tracks(matched_artist.ratingKey))
+        count_candidates(len(artist_tracks))
+        if fuzzymatch:
+            track_index = best_choice(spotify_track_name, [plex_track.clean_title for plex_track in artist_tracks],
+                                      tie_breaker = duration_distances(spotify_track.duration_ms, artist_tracks))
+            if track_index is not None:
+                return artist_tracks[track_index]
+        else:
+            for plex_track in artist_tracks:
+                if spotify_track_name == plex_track.clean_title:
                     return plex_track
 
     return None
 
-def _search_track_by_album_and_artist(plexlibrary: MusicSection, spotify_track: dict) -> Track | None:
+def _search_track_by_album_and_artist(library_index: "LibraryIndex", spotify_track: "SpotifyTrack") -> "TrackRecord | None":
     '''
     Search the plex library for a given track by first searching for its album & artist.
     Uses fuzzy logic to find best match when multiple albums are found.
     Returns the track if the album can be found and if there is a song that aligns.
     '''
-    track_name = _clean_title(spotify_track['name'])
-    artist_name = _clean_title(spotify_track['artists'][0]['name'])
-    album_name = _clean_title(spotify_track['album']['name'])
-
-    found_albums = plexlibrary.searchAlbums(title = album_name, filters = {'artist.title': artist_name}) # type: list[Album]
-
-    found_album, score = None, 0
-    for plex_album in found_albums:
-        match_score = fuzz.partial_ratio(plex_album.title, album_name)
-        if match_score > score:
-            score = match_score
-            found_album = plex_album # type: Album | None
+    plex_album = find_album(library_index, spotify_track, 'albumartist')
     
     # If an album is found, search for the song.
-    if found_album:
-        album_tracks = cast(Sequence[Track], found_album.tracks())
-        for plex_track in album_tracks:
-            assert isinstance(plex_track, Track)
-            if fuzz.partial_ratio(_clean_title(plex_track.title), track_name) > 80:
-                return plex_track
+    if plex_album is not None:
+        return _best_album_track(library_index, plex_album, clean_title(spotify_track.name), spotify_track.duration_ms)
     
     return None
 
-def _search_track_by_album(plexlibrary: MusicSection, spotify_track: dict) -> Track | None:
+def _search_track_by_album(library_index: "LibraryIndex", spotify_track: "SpotifyTrack") -> "TrackRecord | None":
     '''
     Search the plex library for a given track by first searching for its album.
     Uses fuzzy logic to find best match when multiple albums are found.
     Returns the track if the album can be found and if there is a song that aligns.
     '''
-    track_name = _clean_title(spotify_track['name'])
-    artist_name = _clean_title(spotify_track['artists'][0]['name'])
-    album_name = _clean_title(spotify_track['album']['name'])
-
-    found_albums = plexlibrary.searchAlbums(title = album_name) # type: list[Album]
-
-    found_album, score = None, 0
-    for plex_album in found_albums:
-        plex_artist = plex_album.artist()
-        assert plex_artist
-        plex_artist_name = plex_artist.title # type: str
-        match_score = fuzz.partial_ratio(_clean_title(plex_album.title), album_name) + fuzz.partial_ratio(_clean_title(plex_artist_name), artist_name)
-        if match_score > score:
-            score = match_score
-            found_album = plex_album # type: Album | None
+    plex_album = find_album(library_index, spotify_track, 'album')
     
     # If an album is found, search for the song.
-    if found_album:
-        album_tracks = cast(Sequence[Track], found_album.tracks())
-        for plex_track in album_tracks:
-            assert isinstance(plex_track, Track)
-            if fuzz.partial_ratio(_clean_title(plex_track.title), track_name) > 80:
-                return plex_track
+    if plex_album is not None:
+        return _best_album_track(library_index, plex_album, clean_title(spotify_track.name), spotify_track.duration_ms)
     
     return None
 
-def _search_track_loose(plexlibrary: MusicSection, spotify_track: dict) -> Track | None:
+def find_album(library_index: "LibraryIndex", spotify_track: "SpotifyTrack", strategy: str) -> "AlbumRecord | None":
+    '''
+    Return the plex album of the spotify track as the album strategies find it:
+    for 'albumartist' the best scoring album title among the albums of the artist, for 'album' the best scoring album title and artist among all albums.
+    '''
+    artist_name = clean_title(spotify_track.artist)
+    album_name = clean_title(spotify_track.album)
+
+    if strategy == 'albumartist':
+        found_albums = library_index.search_albums(album_name, artist = artist_name)
+        count_candidates(len(found_albums))
+        album_scores = score_choices(album_name, [plex_album.clean_title for plex_album in found_albums])
+    else:
+        found_albums = library_index.search_albums(album_name)
+        count_candidates(len(found_albums))
+        album_scores = score_choices(album_name, [plex_album.clean_title for plex_album in found_albums])
+        album_scores += score_choices(artist_name, [plex_album.clean_artist for plex_album in found_albums])
+
+    album_index = best_index(album_scores)
+    return found_albums[album_index] if album_index is not None else None
+
+def _best_album_track(library_index: "LibraryIndex", plex_album: "AlbumRecord", track_name: str, duration_ms: int | None = None) -> "TrackRecord | None":
+    '''
+    Return the track on the given album whose cleaned title best matches the cleaned track name, if it scores above the cutoff.
+    Tracks outside the duration tolerance are not considered, and on equal scores the track closest in duration wins.
+    '''
+    album_tracks = within_duration(duration_ms, library_index.album_tracks(plex_album.ratingKey))
+    count_candidates(len(album_tracks))
+    track_index = best_choice(track_name, [plex_track.clean_title for plex_track in album_tracks],
+                              tie_breaker = duration_distances(duration_ms, album_tracks))
+    return album_tracks[track_index] if track_index is not None else None
+
+def _search_track_loose(library_index: "LibraryIndex", spotify_track: "SpotifyTrack") -> "TrackRecord | None":
     '''
     Search the plex library for a given track based on the song title.
-    If multiple tracks are found, returns the one with the highest fuzzy logic score.
-    Returns a track if the album title also align, otherwise returns None.
+    The candidates come from the trigram index of the library, so titles that are worded or spelled a bit differently are found too.
+    Candidates whose title scores above the cutoff are kept, and the one with the highest weighted fuzzy logic score
+    for artist name (weight 1) and album name (weight 0.2) is returned.
     '''
-    track_name = _clean_title(spotify_track['name'])
+    track_name = clean_title(spotify_track.name)
 
-    artists = spotify_track['artists']
-    spotify_artist_name = _clean_title(artists[0]['name'])
+    spotify_artist_name = clean_title(spotify_track.artist)
 
-    spotify_album_name = _clean_title(spotify_track['album']['name'])
+    spotify_album_name = clean_title(spotify_track.album)
 
-    found_tracks = plexlibrary.searchTracks(title = track_name,
-                         )
+    duration_ms = spotify_track.duration_ms
+    candidates = within_duration(duration_ms, library_index.candidate_tracks(track_name, spotify_artist_name))
+    count_candidates(len(candidates))
+    title_scores = score_choices(track_name, [candidate.clean_title for candidate in candidates])
+    found_tracks = [candidate for candidate, passed in zip(candidates, above_cutoff(title_scores)) if passed]
+    # Exact titles first and then the closest durations, so they win ties with titles that merely contain the track name.
+    distances = duration_distances(duration_ms, found_tracks)
+    order = sorted(range(len(found_tracks)), key = lambda nr: (found_tracks[nr].clean_title != track_name, distances[nr]))
+    found_tracks = [found_tracks[nr] for nr in order]
 
-    score = 0
-    plex_track = None
-    for found_track in found_tracks:
-        match_score = fuzz.partial_ratio(spotify_artist_name, _clean_title(found_track.artist().title))
-        match_score += 0.2*fuzz.partial_ratio(spotify_album_name, _clean_title(found_track.album().title))
-        if match_score > score:
-            score = match_score
-            plex_track = found_track
+    match_scores = score_choices(spotify_artist_name, [found_track.clean_artist for found_track in found_tracks])
+    match_scores += 0.2*score_choices(spotify_album_name, [found_track.clean_album for found_track in found_tracks])
+    track_index = best_index(match_scores)
     
-    return plex_track
+    return found_tracks[track_index] if track_index is not None else None
 
-def _search_track_by_hubsearch(plexserver: PlexServer, spotify_track: dict) -> Track | None:
+def _search_track_by_hubsearch(library_index: "LibraryIndex", spotify_track: "SpotifyTrack") -> "TrackRecord | None":
     '''
-    Search the plex server for a given track using the hub search method.
-    If multiple tracks are found, returns the first result.
-    The hub search method is like the search bar in the web ui.
+    Search the library index for a given track like the hub search of the plex server (the search bar in the web ui) does:
+    of the candidate tracks for the title and artist, returns the one whose title and artist score best, if it is above zero.
+    Unlike loose, the title is not held to a cutoff of its own, so a poor title can be made up for by a good artist.
     '''
-    track_name = _clean_title(spotify_track['name'])
-
-    artists = spotify_track['artists']
-    spotify_artist_name = _clean_title(artists[0]['name'])
+    track_name = clean_title(spotify_track.name)
 
-    spotify_album_name = _clean_title(spotify_track['album']['name'])
-    
-    found_tracks = plexserver.search(query = track_name + ' ' + spotify_artist_name + ' ' + spotify_album_name, mediatype = 'track')
+    spotify_artist_name = clean_title(spotify_track.artist)
 
-    if not found_tracks:
-        found_tracks = plexserver.search(query = track_name + ' '+ spotify_artist_name, mediatype = 'track')
+    found_records = within_duration(spotify_track.duration_ms, library_index.candidate_tracks(track_name, spotify_artist_name))
+    count_candidates(len(found_records))
+    match_scores = score_choices(track_name, [found_record.clean_title for found_record in found_records])
+    match_scores += score_choices(spotify_artist_name, [found_record.clean_artist for found_record in found_records])
+    track_index = best_index(match_scores, tie_breaker = duration_distances(spotify_track.duration_ms, found_records))
 
-    return found_tracks[0] if found_tracks else None
+    return found_records[track_index] if track_index is not None else None
@@ -0,0 +1,65 @@
+"""
+This module resolves the artist and album names of Plex tracks without fetching every artist and album separately.
+"""
+from typing import NamedTuple, Sequence
+
+from plexapi.audio import Track
+
+from src.library import TrackRecord, FETCH_SIZE
+
+class TrackMetadata(NamedTuple):
+    '''
+    The names of a Plex track, its artist and its album.
+    '''
+    ratingKey: int
+    title: str
+    artist: str
+    album: str
+
+def track_metadata(plex_tracks: Sequence[Track | TrackRecord], fetch_size: int = FETCH_SIZE) -> list[TrackMetadata]:
+    '''
+    Return the metadata of the given tracks, in the same order.
+    The artist and album names are read from the grandparentTitle and parentTitle attributes that search results and library listings already carry.
+    Only if those are missing, the artists and albums are fetched by ratingKey, in bulk and once per artist or album.
+    '''
+    missing_keys = {} # type: dict[int, Track]
+    for plex_track in plex_tracks:
+        if not isinstance(plex_track, Track):
+            continue
+        for title_attribute, key_attribute in (('grandparentTitle', 'grandparentRatingKey'), ('parentTitle', 'parentRatingKey')):
+            key = _loaded_attribute(plex_track, key_attribute)
+            if not _loaded_attribute(plex_track, title_attribute) and key:
+                missing_keys.setdefault(int(key), plex_track)
+
+    parent_titles = {} # type: dict[int, str]
+    if missing_keys:
+        server = next(iter(missing_keys.values()))._server
+        keys = list(missing_keys)
+        for start in range(0, len(keys), fetch_size):
+            for parent in server.fetchItems(keys[start:start + fetch_size]):
+                parent_titles[int(parent.ratingKey)] = parent.title
+
+    return [TrackMetadata(ratingKey = _loaded_attribute(plex_track, 'ratingKey'),
+                          title = _loaded_attribute(plex_track, 'title'),
+                          artist = _parent_title(plex_track, 'grandparentTitle', 'grandparentRatingKey', parent_titles),
+                          album = _parent_title(plex_track, 'parentTitle', 'parentRatingKey', parent_titles),
+                          )
+            for plex_track in plex_tracks]
+
+def _loaded_attribute(plex_track: Track | TrackRecord, attribute: str):
+    '''
+    Read an attribute of a track without triggering plexapi's automatic reload of partial objects, which is a request per track.
+    '''
+    if isinstance(plex_track, Track):
+        return vars(plex_track).get(attribute)
+    return getattr(plex_track, attribute)
+
+def _parent_title(plex_track: Track | TrackRecord, title_attribute: str, key_attribute: str, parent_titles: dict[int, str]) -> str:
+    '''
+    Return the artist or album title of a track, from the track itself or else from the fetched parents.
+    '''
+    title = _loaded_attribute(plex_track, title_attribute)
+    if title:
+        return title
+    key = _loaded_attribute(plex_track, key_attribute)
+    return parent_titles.get(int(key), "") if key else ""
@@ -0,0 +1,64 @@
+"""
+This module cleans Spotify and Plex titles and names for matching.
+"""
+from functools import lru_cache
+from typing import Iterable
+import re
+import sys
+import unicodedata
+
+# Number of cleaned titles kept in memory; titles, artists and albums repeat a lot across tracks and strategies.
+CACHE_SIZE = 2**16
+
+# Common suffixes after a dash, like " - remastered 2008", " - edit", " - mono lp version"
+_DASH_SUFFIX = re.compile(
+    r"\s*-\s*.*?(remaster(ed)?(\s*\d{4})?|mono|stereo|single|album|radio|"
+    r"bonus|lp|version|mix|edit|take|alt|acoustic|live|reissue)\b.*",
+    flags=re.IGNORECASE,
+)
+# Parenthetical metadata like "(Remastered)", "(Deluxe Edition)", "(Bonus Track)", "(Single Version)"
+_PARENTHETICAL_METADATA = re.compile(
+    r"\s*\(([^)]*(remaster|deluxe|bonus|version|mix|edit|take|acoustic|mono|stereo|live|album|radio)[^)]*)\)",
+    flags=re.IGNORECASE,
+)
+# Trailing album references like "(from ...)" or "(...) version"; merged into one pass, the "from" branch is tried first.
+_PARENTHETICAL_REFERENCE = re.compile(r"\s*\(from [^)]*\)|\s*\(.*?version\)", flags=re.IGNORECASE)
+# Redundant punctuation
+_PUNCTUATION = str.maketrans('', '', '[]()"')
+# Multiple dots are replaced with a space to avoid issues with URLs
+_DOTS = re.compile(r'\.{2,}')
+_SPACES = re.compile(r"\s{2,}")
+
+@lru_cache(maxsize = CACHE_SIZE)
+def clean_title(title: str) -> str:
+    """Clean Spotify or Plex track/album titles for matching."""
+    if not isinstance(title, str):
+        return ""
+    # Normalize Unicode (accents, dashes, etc.) and lowercase for consistency
+    title = unicodedata.normalize("NFKD", title).lower()
+
+    if '-' in title:
+        title = _DASH_SUFFIX.sub("", title)
+    if '(' in title:
+        title = _PARENTHETICAL_METADATA.sub("", title)
+        title = _PARENTHETICAL_REFERENCE.sub("", title)
+
+    title = title.translate(_PUNCTUATION)
+    if '..' in title:
+        title = _DOTS.sub(' ', title)
+    title = _SPACES.sub(" ", title)
+
+    # Strip punctuation at ends
+    return sys.intern(title.strip(" -_.").strip())
+
+def normalize_many(titles: Iterable[str]) -> list[str]:
+    '''
+    Clean many titles in one pass, e.g. a whole page of the library. Every distinct title is only cleaned once.
+    '''
+    cleaned = {} # type: dict[str, str]
+    result = []
+    for title in titles:
+        if title not in cleaned:
+            cleaned[title] = clean_title(title)
+        result.append(cleaned[title])
+    return result
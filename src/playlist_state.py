@@ -0,0 +1,63 @@
+"""
+This module stores what was synced from each Spotify playlist, so that the next run only needs to handle what changed.
+It also stores the resume records of interrupted playlist writes.
+"""
+import json
+import os
+
+from src.spotify import SpotifyTrack
+
+def load_playlist_state(path: str) -> dict[str, dict]:
+    '''
+    Load the stored state of all synced playlists, keyed by spotify playlist id. Returns an empty dictionary if there is no state file yet.
+    Per playlist, the state holds the snapshot_id, the playlist tracks at that snapshot and the keys of the tracks that were unmatched or skipped:
+    the track id, or for local files the name, artist and album (see _spotify_track_key in src.sync).
+    '''
+    state = _load_json(path)
+    for playlist_state in state.values():
+        playlist_state['items'] = [_spotify_track(item) for item in playlist_state['items']]
+        # JSON has no tuples, so the keys of local files come back as lists.
+        playlist_state['retry'] = [tuple(key) if isinstance(key, list) else key for key in playlist_state['retry']]
+    return state
+
+def save_playlist_state(path: str, state: dict[str, dict]):
+    '''
+    Save the state of all synced playlists. The file is replaced in one step, so an interrupted run keeps the previous state.
+    '''
+    _save_json(path, {playlist_id: {**playlist_state, 'items': [spotify_track._asdict() for spotify_track in playlist_state['items']]}
+                      for playlist_id, playlist_state in state.items()})
+
+def load_resume_records(path: str) -> dict[str, dict]:
+    '''
+    Load the resume records of interrupted playlist writes, keyed by sync mode and playlist name (see PlaylistWriter in src.sync).
+    Returns an empty dictionary if there is no resume file yet.
+    '''
+    return _load_json(path)
+
+def save_resume_records(path: str, records: dict[str, dict]):
+    '''
+    Save the resume records of interrupted playlist writes. The file is replaced in one step, like the playlist state.
+    '''
+    _save_json(path, records)
+
+def _load_json(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding = "utf-8") as fh:
+        return json.load(fh)
+
+def _save_json(path: str, data: dict):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+    with open(path + ".tmp", "w", encoding = "utf-8") as fh:
+        json.dump(data, fh)
+    os.replace(path + ".tmp", path)
+
+def _spotify_track(item: dict) -> SpotifyTrack:
+    '''
+    Read a stored playlist track. State files of earlier versions hold the playlist items of the spotify API instead.
+    '''
+    if 'track' in item:
+        return SpotifyTrack.from_item(item)
+    return SpotifyTrack(**item)
@@ -1,27 +1,43 @@
 """
 This module handles all Plex API interactions.
+The server connection and the library section are made on first use, and then reused.
 """
 from plexapi.server import PlexServer
+from plexapi.library import MusicSection
 from plexapi.exceptions import NotFound, Unauthorized
 
+from src import http_session
+from src.pool import cached_factory
 from src.spotify import get_spotify_playlist_name
-from credentials.credentials import plex as plcredentials
-from settings import settings
+from credentials.credentials import plex_credentials
 
-try:
-    server = PlexServer(plcredentials["baseurl"], plcredentials["token"])
-except NotFound as exc:
-    raise ValueError(f"Could not find plex server at {plcredentials["baseurl"]}, please check the settings.") from exc
-except Unauthorized as exc:
-    raise ValueError(f"Could not access plex server with token {plcredentials["token"]}, please check the settings.") from exc
+@cached_factory
+def plex_server() -> PlexServer:
+    '''
+    Connect to the plex server in the credentials, through the shared HTTP session.
+    '''
+    plcredentials = plex_credentials()
+    try:
+        return PlexServer(plcredentials["baseurl"], plcredentials["token"],
+                          session = http_session.shared_session(), timeout = http_session.TIMEOUT)
+    except NotFound as exc:
+        raise ValueError(f"Could not find plex server at {plcredentials["baseurl"]}, please check the settings.") from exc
+    except Unauthorized as exc:
+        raise ValueError(f"Could not access plex server with token {plcredentials["token"]}, please check the settings.") from exc
 
-try:
-    library = server.library.section(settings["plex_library_name"])
-except NotFound as exc:
-    available_libraries = [library.title for library in server.library.sections() if library.TYPE == "artist"]
-    raise NotFound(f"Could not find the library {settings["plex_library_name"]}. Available libraries:" + "\n\t".join(available_libraries)) from exc
+@cached_factory
+def plex_library(library_name: str) -> MusicSection:
+    '''
+    Get the music library with the given name from the plex server.
+    '''
+    server = plex_server()
+    try:
+        return server.library.section(library_name)
+    except NotFound as exc:
+        available_libraries = [library.title for library in server.library.sections() if library.TYPE == "artist"]
+        raise NotFound(f"Could not find the library {library_name}. Available libraries:" + "\n\t".join(available_libraries)) from exc
 
-def get_plex_playlist_name() -> str:
+def get_plex_playlist_name(settings: dict) -> str:
     '''
     Get the name for the plex playlist. This is retrieved from the settings.
     '''
@@ -30,4 +46,4 @@ def get_plex_playlist_name() -> str:
         playlist_name = get_spotify_playlist_name(settings["playlist_id"])
     
     assert playlist_name is not None
-    return playlist_name
\ No newline at end of file
+    return playlist_name
@@ -0,0 +1,65 @@
+"""
+This module contains helpers for running work concurrently.
+"""
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import Executor, ThreadPoolExecutor, Future
+from functools import wraps
+from typing import Callable, Iterable, Iterator, TypeVar
+import threading
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+def ordered_map(func: Callable[[T], R],
+                items: Iterable[T],
+                workers: int = 1,
+                max_in_flight: int | None = None,
+                executor: Executor | None = None,
+                ) -> Iterator[R]:
+    '''
+    Apply func to all items using a pool of worker threads, and yield the results in the order of the items.
+    At most max_in_flight items (default twice the number of workers) are submitted but not yet yielded,
+    so a slow consumer or a slow server holds back new submissions instead of queueing up the whole input.
+    With a single worker, func is simply applied in the calling thread.
+    If an executor with that many workers is given, like a process pool, func runs on it instead; the caller shuts it down.
+    '''
+    if executor is None and workers <= 1:
+        yield from map(func, items)
+        return
+
+    max_in_flight = max(max_in_flight or 2*workers, workers)
+    with ThreadPoolExecutor(max_workers = workers) if executor is None else nullcontext(executor) as executor:
+        pending = deque() # type: deque[Future[R]]
+        for item in items:
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, item))
+        while pending:
+            yield pending.popleft().result()
+
+def in_background(func: Callable[..., R], *args) -> "Future[R]":
+    '''
+    Start func(*args) in a separate thread, and return the future of its result; e.g. to connect to a server while doing something else.
+    '''
+    executor = ThreadPoolExecutor(max_workers = 1)
+    future = executor.submit(func, *args)
+    executor.shutdown(wait = False)
+    return future
+
+def cached_factory(factory: Callable[..., R]) -> Callable[..., R]:
+    '''
+    Decorate a function that builds an expensive object, like a client, so that the object is only built on the first call, once per arguments.
+    Calls from other threads wait for that first call instead of building the object again.
+    '''
+    cache = {} # type: dict[tuple, R]
+    lock = threading.Lock()
+
+    @wraps(factory)
+    def cached(*args):
+        with lock:
+            if args not in cache:
+                cache[args] = factory(*args)
+            return cache[args]
+    cached.cache_clear = cache.clear # type: ignore
+    return cached
@@ -0,0 +1,108 @@
+"""
+This module matches spotify tracks in a pool of worker processes, for large batches where matching threads are held back by the GIL.
+The library index is laid out once in a shared memory block (see shared_library), which every worker process reads in place,
+so the library is neither pickled per task nor copied or rebuilt per worker.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing import get_context
+from typing import Collection, Iterable, Iterator
+
+from src import scoring
+from src.album_matching import match_with_album_assignments, BATCH_SIZE
+from src.library import LibraryIndex, TrackRecord
+from src.match_cache import MatchCache
+from src.matching import match_track, expand_matching_pattern
+from src.pool import ordered_map
+from src.scoring import configure_scoring
+from src.shared_library import SharedLibrary, Layout, attach_library
+from src.spotify import SpotifyTrack
+
+# Number of spotify tracks sent to a worker process at a time. The tracks of an album are matched together per chunk, like per batch in a thread.
+CHUNK_SIZE = BATCH_SIZE
+
+# State of a worker process, set once by _init_worker: the library index and matching settings.
+_worker = {} # type: dict
+
+def match_in_processes(library_index: LibraryIndex,
+                       spotify_tracks: Iterable[SpotifyTrack],
+                       matching_pattern: str | list[str],
+                       processes: int,
+                       skip_list: Collection[str] | None = None,
+                       mapping_dict: dict[str,int] | None = None,
+                       match_cache: MatchCache | None = None,
+                       chunk_size: int = CHUNK_SIZE,
+                       ) -> Iterator[tuple[SpotifyTrack, tuple[TrackRecord | None | str, str | None]]]:
+    '''
+    Match the spotify tracks with match_track in the given number of worker processes, and yield every track with its result, in order.
+    Tracks are sent chunk_size at a time, and at most two chunks per process are in flight, so an iterator of tracks is matched as it comes in.
+    The workers get the skip list, the mapping and the cached matches once, when they start.
+    Workers only return ratingKeys, which are looked up in library_index, so the results are the records of this process.
+    '''
+    strategies = expand_matching_pattern(matching_pattern)
+    worker_settings = {
+        'matching_pattern': matching_pattern,
+        'skip_list': frozenset(skip_list or ()),
+        'mapping_dict': mapping_dict,
+        'cached_matches': {spotify_id: plex_track.ratingKey for spotify_id, plex_track in match_cache.matches.items()} if match_cache else {},
+        'score_cutoff': scoring.SCORE_CUTOFF,
+        'duration_tolerance': scoring.DURATION_TOLERANCE/1000 if scoring.DURATION_TOLERANCE is not None else None,
+    }
+    spotify_tracks = iter(spotify_tracks)
+    chunks = deque() # type: deque[list[SpotifyTrack]]
+
+    def read_chunks() -> Iterator[list[SpotifyTrack]]:
+        while chunk := list(islice(spotify_tracks, chunk_size)):
+            chunks.append(chunk)
+            yield chunk
+
+    # Spawned instead of forked: the parent runs other threads (spotify pages, playlist writes) that a fork would copy mid-flight.
+    # The candidate index is only shared if loose or hubsearch matching uses it; it is built once, here.
+    with SharedLibrary(library_index, with_candidates = 'loose' in strategies or 'hubsearch' in strategies) as shared_library, \
+         ProcessPoolExecutor(max_workers = processes,
+                             mp_context = get_context('spawn'),
+                             initializer = _init_worker,
+                             initargs = (shared_library.name, shared_library.layout, worker_settings)) as executor:
+        for results in ordered_map(_match_chunk, read_chunks(), workers = processes, executor = executor):
+            for spotify_track, (rating_key, strategy) in zip(chunks.popleft(), results):
+                plex_track = library_index.tracks[rating_key] if isinstance(rating_key, int) else rating_key
+                yield spotify_track, (plex_track, strategy)
+
+def _init_worker(library_name: str, library_layout: Layout, worker_settings: dict):
+    '''
+    Set up a worker process: open the shared library, and apply the matching settings of the parent process.
+    '''
+    configure_scoring(score_cutoff = worker_settings['score_cutoff'], workers = 1, duration_tolerance = worker_settings['duration_tolerance'])
+    library_index = attach_library(library_name, library_layout)
+    _worker['library_index'] = library_index
+    _worker['matching_pattern'] = worker_settings['matching_pattern']
+    _worker['skip_list'] = worker_settings['skip_list']
+    _worker['mapping_dict'] = worker_settings['mapping_dict']
+    # Only get() is used by match_track, so a dict of records stands in for the match cache.
+    _worker['match_cache'] = {spotify_id: library_index.tracks[rating_key]
+                              for spotify_id, rating_key in worker_settings['cached_matches'].items()}
+
+def _match_chunk(spotify_tracks: list[SpotifyTrack]) -> list[tuple[int | str | None, str | None]]:
+    '''
+    Match a chunk of spotify tracks in a worker process.
+    Returns the ratingKey of the match ("Skipped" or None) and the source of the match for every track.
+    '''
+    library_index = _worker['library_index']
+
+    def match_item(spotify_track: SpotifyTrack,
+                   strategies: list[str],
+                   album_assignments: dict[tuple[str, str], TrackRecord | None] | None) -> tuple[TrackRecord | None | str, str | None]:
+        return match_track(library_index = library_index,
+                           spotify_track = spotify_track,
+                           skip_list = _worker['skip_list'],
+                           mapping_dict = _worker['mapping_dict'],
+                           matching_strength = strategies,
+                           match_cache = _worker['match_cache'], # type: ignore
+                           album_assignments = album_assignments)
+
+    results = [] # type: list[tuple[int | str | None, str | None]]
+    for _, (plex_track, strategy) in match_with_album_assignments(library_index, spotify_tracks, _worker['matching_pattern'], match_item,
+                                                                  batch_size = len(spotify_tracks)):
+        results.append((plex_track.ratingKey if isinstance(plex_track, TrackRecord) else plex_track, strategy))
+    return results
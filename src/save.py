@@ -1,120 +1,146 @@
 import csv
+from contextlib import ExitStack
+from typing import Callable
 from plexapi.audio import Track
 
-def handle_savetodisk(unmatched: list[dict[str,str | list]],
-                      matched: list[dict[str, str | list[str]]],
-                      plex_tracks: list[Track],
+from src.library import TrackRecord
+from src.metadata import TrackMetadata, track_metadata
+from src.spotify import SpotifyTrack
+
+UNMATCHED_CSV_HEADER = ["Artist", "Title", "Album", "Spotify ID"]
+MATCHED_CSV_HEADER = ["Spotify Artist", "Spotify Title", "Plex Artist", "Plex Title", "Spotify ID", "Plex ID", "Match_entry", "Skipped_entry"]
+
+class TrackFiles:
+    '''
+    The files that unmatched tracks, matched tracks and the hardcoded mapping are written to, based on the settings.
+    Every track is written as a row as soon as it is known, so the tracks don't need to be collected first.
+    Use as a context manager; the files are closed on exit.
+    nr_unmatched and nr_matched, if known in advance, only set the width of the numbering in .txt files.
+    '''
+    def __init__(self, settings: dict[str, str | list[str]], nr_unmatched: int = 0, nr_matched: int = 0):
+        self._files = ExitStack()
+        self.unmatched = None # type: _TrackFile | None
+        self.matched = None # type: _TrackFile | None
+        self.mapping = None
+        if settings['print_unmatched_to_file']:
+            self.unmatched = self._files.enter_context(_TrackFile(settings['unmatched_tracks_filename'], UNMATCHED_CSV_HEADER,
+                                                                  _unmatched_txt_line, _unmatched_csv_row, nr_unmatched))
+        if settings['print_matched_to_file']:
+            self.matched = self._files.enter_context(_TrackFile(settings['matched_tracks_filename'], MATCHED_CSV_HEADER,
+                                                                _matched_txt_line, _matched_csv_row, nr_matched))
+        if settings['create_hardcoded_mapping']:
+            self.mapping = self._files.enter_context(open(settings['mapping_file_savepath'], 'w', newline="", encoding = "utf-8"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._files.__exit__(*exc_info)
+
+    def write_unmatched(self, spotify_track: SpotifyTrack):
+        '''
+        Write an unmatched spotify track.
+        '''
+        if self.unmatched:
+            self.unmatched.write(spotify_track)
+
+    def write_matched(self, spotify_track: SpotifyTrack, plex_track: TrackMetadata):
+        '''
+        Write a matched spotify track and its plex track, to the matched tracks file and the hardcoded mapping.
+        '''
+        if self.matched:
+            self.matched.write(spotify_track, plex_track)
+        if self.mapping:
+            self.mapping.write(_mapping_line(spotify_track, plex_track))
+
+class _TrackFile:
+    '''
+    A .txt or .csv file that tracks are written to one row at a time. The file type is inferred from the filepath.
+    '''
+    def __init__(self, filepath: str, csv_header: list[str],
+                 txt_line: Callable[..., str], csv_row: Callable[..., tuple], nr_rows: int = 0):
+        if filepath.endswith('.txt'):
+            self.fh = open(filepath, 'w', encoding = "utf-8")
+            self.writer = None
+        elif filepath.endswith('.csv'):
+            self.fh = open(filepath, 'w', newline="", encoding = "utf-8")
+            self.writer = csv.writer(self.fh)
+            self.writer.writerow(csv_header)
+        else:
+            raise ValueError(f"{filepath} is not a .txt or .csv file.")
+        self.txt_line = txt_line
+        self.csv_row = csv_row
+        self.width = len(str(nr_rows))
+        self.nr = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.fh.close()
+
+    def write(self, *track):
+        '''
+        Write one row for the given track.
+        '''
+        self.nr += 1
+        if self.writer:
+            self.writer.writerow(self.csv_row(*track))
+        else:
+            self.fh.write(self.txt_line(self.nr, self.width, *track))
+
+def handle_savetodisk(unmatched: list[SpotifyTrack],
+                      matched: list[SpotifyTrack],
+                      plex_tracks: list[Track | TrackRecord],
                       settings: dict[str, str | list[str]]):
     '''
     Handle the saving to disk of unmatched tracks, matched tracks, and mapping dictionary, based on the settings.
     '''
-    if settings['print_unmatched_to_file']:
-        save_unmatched(unmatched = unmatched, settings = settings)
+    with TrackFiles(settings, nr_unmatched = len(unmatched), nr_matched = len(matched)) as track_files:
+        for spotify_track in unmatched:
+            track_files.write_unmatched(spotify_track)
+        if track_files.matched or track_files.mapping:
+            for spotify_track, plex_track in zip(matched, track_metadata(plex_tracks)):
+                track_files.write_matched(spotify_track, plex_track)
 
-    if settings['print_matched_to_file']:
-        save_matched(matched = matched,
-                    found = plex_tracks,
-                    settings = settings)
+def _unmatched_txt_line(nr: int, width: int, spotify_track: SpotifyTrack) -> str:
+    spotify_artist = spotify_track.artist
+    spotify_name = spotify_track.name
+    spotify_album = spotify_track.album
+    spotify_track_id = spotify_track.id
+    return f"{nr:>{width}}: {spotify_artist} -- {spotify_name} ({spotify_album}) [{spotify_track_id}]\n"
 
+def _unmatched_csv_row(spotify_track: SpotifyTrack) -> tuple:
+    return (
+        spotify_track.artist,
+        spotify_track.name,
+        spotify_track.album,
+        spotify_track.id,
+    )
 
-    if settings['create_hardcoded_mapping']:
-        save_hardcoded_matching(matched, plex_tracks, settings)
+def _matched_txt_line(nr: int, width: int, spotify_track: SpotifyTrack, plex_track: TrackMetadata) -> str:
+    spotify_artist = spotify_track.artist
+    spotify_name = spotify_track.name
+    spotify_album = spotify_track.album
+    spotify_track_id = spotify_track.id
+    plex_artist = plex_track.artist
+    plex_name = plex_track.title
+    plex_album = plex_track.album
+    plex_track_id = plex_track.ratingKey
+    return f"\n{nr:>{width}}: {spotify_name} -- {plex_name} ({spotify_artist} ({spotify_album}) -- {plex_artist} ({plex_album})) [{spotify_track_id} -- {plex_track_id}]\n"
 
-def save_unmatched(unmatched: list[dict[str,str | list]], settings: dict[str, str | list[str]]):
-    '''
-    Save the unmatched Spotify songs to file. The file type and path will be inferred from the given settings.
-    '''
-    if settings['unmatched_tracks_filename'].endswith('.txt'):
-        _save_unmatched_to_txt(unmatched, settings['unmatched_tracks_filename'])
-    elif settings['unmatched_tracks_filename'].endswith('.csv'):
-        _save_unmatched_to_csv(unmatched, settings['unmatched_tracks_filename'])
-    else:
-        raise ValueError(f"{settings['unmatched_tracks_filename']} is not a .txt or .csv file.")
-
-def _save_unmatched_to_txt(unmatched: list[dict[str,str | list]], filepath: str):
-    '''
-    Save the unmatched tracks to a .txt file.
-    '''
-    with open(filepath, 'w', encoding = "utf-8") as fh:
-        width = len(str(len(unmatched)))
-        for nr, element in enumerate(unmatched, start = 1):
-            spotify_artist = element['track']['artists'][0]['name']
-            spotify_name = element['track']['name']
-            spotify_album = element['track']['album']['name']
-            spotify_track_id = element["track"]['id']
-            fh.write(f"{nr:>{width}}: {spotify_artist} -- {spotify_name} ({spotify_album}) [{spotify_track_id}]\n")
-
-def _save_unmatched_to_csv(unmatched: list[dict[str,str | list]], filepath: str):
-    '''
-    Save the unmatched tracks to a .csv file.
-    '''
-    with open(filepath, 'w', newline="", encoding = "utf-8") as fh:
-        writer = csv.writer(fh)
-        writer.writerow(["Artist", "Title", "Album", "Spotify ID"])
-        writer.writerows([
-                (
-                    spotify_element["track"]["artists"][0]["name"],
-                    spotify_element["track"]["name"],
-                    spotify_element["track"]["album"]["name"],
-                    spotify_element["track"]["id"],
-                )
-                for spotify_element in unmatched
-                ])
-
-def save_matched(matched: list[dict[str, str | list[str]]], found: list[Track], settings: dict[str, str | list[str]]):
-    '''
-    Save the matched Spotify songs and their Plex tracks to file.
-    '''
-    if settings['matched_tracks_filename'].endswith('.txt'):
-        _save_matched_to_txt(matched, found, settings['matched_tracks_filename'])
-    elif settings['matched_tracks_filename'].endswith('.csv'):
-        _save_matched_to_csv(matched, found, settings['matched_tracks_filename'])
-    else:
-        raise ValueError(f"{settings['unmatched_tracks_filename']} is not a .txt or .csv file.")
-    
-def _save_matched_to_txt(matched: list[dict[str, str | list[str]]], found: list[Track], filepath: str):
-    '''
-    Save the matched tracks to a .txt file.
-    '''
-    with open(filepath, 'w', encoding = "utf-8") as fh:
-        width = len(str(len(matched)))
-        for nr, [spotify_element, plex_track] in enumerate(zip(matched, found), start = 1):
-            spotify_artist = spotify_element['track']['artists'][0]['name']
-            spotify_name = spotify_element['track']['name']
-            spotify_album = spotify_element['track']['album']['name']
-            spotify_track_id = spotify_element["track"]['id']
-            plex_artist = plex_track.artist().title
-            plex_name = plex_track.title
-            plex_album = plex_track.album().title
-            plex_track_id = plex_track.ratingKey
-            fh.write(f"\n{nr:>{width}}: {spotify_name} -- {plex_name} ({spotify_artist} ({spotify_album}) -- {plex_artist} ({plex_album})) [{spotify_track_id} -- {plex_track_id}]\n")
-
-def _save_matched_to_csv(matched: list[dict[str, str | list[str]]], found: list[Track], filepath: str):
-    '''
-    Save the matched tracks to a .csv file.
-    '''
-    with open(filepath, 'w', newline="", encoding = "utf-8") as fh:
-        writer = csv.writer(fh)
-        writer.writerow(["Spotify Artist", "Spotify Title", "Plex Artist", "Plex Title", "Spotify ID", "Plex ID", "Match_entry", "Skipped_entry"])
-        writer.writerows([
-                (
-                    spotify_element["track"]["artists"][0]["name"],
-                    spotify_element["track"]["name"],
-                    plex_track.artist().title,
-                    plex_track.title,
-                    spotify_element["track"]["id"],
-                    plex_track.ratingKey,
-                    f"{spotify_element["track"]["id"]}: {plex_track.ratingKey} # {plex_track.artist().title} - {plex_track.title}",
-                    f"{spotify_element["track"]["id"]} # {spotify_element["track"]["artists"][0]["name"]} - {
-                    spotify_element["track"]["name"]}"
-                )
-                for spotify_element, plex_track in zip(matched, found)
-                ])
-def save_hardcoded_matching(spotify_tracks: list[dict[str, str | list[str]]], plex_tracks: list[Track], settings: dict[str, str | list[str]]):
-    '''
-    Create a hardcoded matching file, that links specific spotify tracks to specific plex tracks by ID.
-    '''
-    with open(settings['mapping_file_savepath'], 'w', newline="", encoding = "utf-8") as fh:
-        for spotify_track, plex_track in zip(spotify_tracks, plex_tracks):
-            comment = f" # {plex_track.artist().title} — {plex_track.title}\n"
-            fh.write(f"{spotify_track['track']['id']}: {plex_track.ratingKey}{comment}")
\ No newline at end of file
+def _matched_csv_row(spotify_track: SpotifyTrack, plex_track: TrackMetadata) -> tuple:
+    return (
+        spotify_track.artist,
+        spotify_track.name,
+        plex_track.artist,
+        plex_track.title,
+        spotify_track.id,
+        plex_track.ratingKey,
+        f"{spotify_track.id}: {plex_track.ratingKey} # {plex_track.artist} - {plex_track.title}",
+        f"{spotify_track.id} # {spotify_track.artist} - {spotify_track.name}"
+    )
+
+def _mapping_line(spotify_track: SpotifyTrack, plex_track: TrackMetadata) -> str:
+    comment = f" # {plex_track.artist} — {plex_track.title}\n"
+    return f"{spotify_track.id}: {plex_track.ratingKey}{comment}"
@@ -0,0 +1,87 @@
+"""
+This module scores a cleaned Spotify title against many cleaned Plex titles at once, using rapidfuzz's batch functions.
+"""
+from typing import Sequence, TypeVar
+
+import numpy as np
+from rapidfuzz import fuzz, process
+
+# A candidate needs a fuzzy score (0-100) above this to count as a match.
+SCORE_CUTOFF = 80
+# Number of threads rapidfuzz uses for a single batch; -1 uses all cores.
+WORKERS = 1
+# Milliseconds the duration of a candidate may differ from the spotify track; None doesn't prune on duration.
+DURATION_TOLERANCE = None # type: int | None
+
+T = TypeVar('T')
+
+def configure_scoring(score_cutoff: float | None = None, workers: int | None = None, duration_tolerance: float | None = None):
+    '''
+    Set the score cutoff, the number of rapidfuzz threads and the duration tolerance (in seconds) used for all matching.
+    Values that are None are left unchanged.
+    '''
+    global SCORE_CUTOFF, WORKERS, DURATION_TOLERANCE
+    if score_cutoff is not None:
+        SCORE_CUTOFF = score_cutoff
+    if workers is not None:
+        WORKERS = workers
+    if duration_tolerance is not None:
+        DURATION_TOLERANCE = int(duration_tolerance*1000)
+
+def score_choices(query: str, choices: Sequence[str]) -> np.ndarray:
+    '''
+    Return the partial ratio of the query with every (already cleaned) choice, in a single native call.
+    '''
+    if not choices:
+        return np.zeros(0, dtype = np.float32)
+    return process.cdist([query], choices, scorer = fuzz.partial_ratio, processor = None, workers = WORKERS)[0]
+
+def best_index(scores: np.ndarray, minimum: float = 0, tie_breaker: np.ndarray | None = None) -> int | None:
+    '''
+    Return the index of the highest score if it is above minimum, otherwise None.
+    On ties the index with the lowest tie_breaker wins (e.g. the duration_distances), and otherwise the first index.
+    '''
+    if len(scores) == 0:
+        return None
+    index = int(np.argmax(scores))
+    if tie_breaker is not None:
+        tied = np.flatnonzero(scores == scores[index])
+        if len(tied) > 1:
+            index = int(tied[np.argmin(tie_breaker[tied])])
+    return index if scores[index] > minimum else None
+
+def above_cutoff(scores: np.ndarray, score_cutoff: float | None = None) -> np.ndarray:
+    '''
+    Return which scores are above the cutoff, which defaults to the configured SCORE_CUTOFF.
+    '''
+    return scores > (SCORE_CUTOFF if score_cutoff is None else score_cutoff)
+
+def best_choice(query: str, choices: Sequence[str], score_cutoff: float | None = None, tie_breaker: np.ndarray | None = None) -> int | None:
+    '''
+    Return the index of the (already cleaned) choice that best matches the query, if it scores above the cutoff.
+    The cutoff defaults to the configured SCORE_CUTOFF.
+    '''
+    return best_index(score_choices(query, choices), SCORE_CUTOFF if score_cutoff is None else score_cutoff, tie_breaker)
+
+def within_duration(duration_ms: int | None, candidates: list[T]) -> list[T]:
+    '''
+    Return the candidates (records with a duration in milliseconds) whose duration is within DURATION_TOLERANCE of duration_ms.
+    This is meant to run before any string scoring. Candidates with an unknown duration (0) are kept,
+    and nothing is pruned if the tolerance is not configured or duration_ms is unknown.
+    '''
+    if DURATION_TOLERANCE is None or not duration_ms:
+        return candidates
+    low, high = duration_ms - DURATION_TOLERANCE, duration_ms + DURATION_TOLERANCE
+    return [candidate for candidate in candidates if not candidate.duration or low <= candidate.duration <= high] # type: ignore
+
+def duration_distances(duration_ms: int | None, candidates: Sequence) -> np.ndarray:
+    '''
+    Return how many milliseconds the duration of every candidate differs from duration_ms, for breaking ties between equal scores.
+    Unknown durations count as infinitely far.
+    '''
+    durations = np.fromiter((candidate.duration for candidate in candidates), dtype = np.float64, count = len(candidates))
+    distances = np.abs(durations - (duration_ms or 0))
+    distances[durations == 0] = np.inf
+    if not duration_ms:
+        distances[:] = np.inf
+    return distances
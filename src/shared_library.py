@@ -0,0 +1,288 @@
+"""
+This module lays out a library index as flat numpy arrays in one shared memory block, so that worker processes
+match against the library in place instead of each building their own copy of it (see process_matching).
+Strings are stored as utf-8 in one buffer per column, with the start of every string in an offsets array.
+"""
+from bisect import bisect_left
+from collections.abc import Mapping
+from multiprocessing.shared_memory import SharedMemory
+from operator import itemgetter
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from src.candidates import CandidateIndex, KeyIndex, offsets
+from src.library import LibraryIndex, TrackRecord, AlbumRecord, ArtistRecord, external_id
+
+# Byte alignment of the arrays in the shared memory block.
+ALIGNMENT = 8
+# Number of decoded records kept per table in a worker process. Searches for common words return the same tracks over and over.
+RECORD_CACHE = 16384
+# Ends every stored string. Cleaned strings have no newlines.
+SEPARATOR = "\n"
+# Separates the fields of a stored record. Strings from the XML of the plex server cannot hold it.
+FIELD_SEPARATOR = "\x00"
+
+# Layout of a shared library: the numpy type, shape and offset of every array in the block, by name.
+Layout = dict[str, tuple[str, tuple[int, ...], int]]
+
+class SharedLibrary:
+    '''
+    The arrays of a library index (see library_arrays) in a shared memory block, which worker processes open with attach_library.
+    The block is removed when the shared library is closed.
+    '''
+    def __init__(self, library_index: LibraryIndex, with_candidates: bool = False):
+        arrays = library_arrays(library_index, with_candidates)
+        self.layout = {} # type: Layout
+        size = 0
+        for name, array in arrays.items():
+            size = -(-size//ALIGNMENT)*ALIGNMENT
+            self.layout[name] = (array.dtype.str, array.shape, size)
+            size += array.nbytes
+        self.size = size
+        self.shared_memory = SharedMemory(create = True, size = max(size, 1))
+        for name, array in arrays.items():
+            _view(self.shared_memory, self.layout[name])[...] = array
+        self.name = self.shared_memory.name
+
+    def close(self):
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+
+    def __enter__(self) -> "SharedLibrary":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class SharedLibraryIndex(LibraryIndex):
+    '''
+    Library index (without plex library) that reads a shared library in place.
+    It answers the lookups of matching like the library index it was made from, with the same results in the same order;
+    only the results of substring searches and up to RECORD_CACHE decoded records per table are kept per process. It cannot be added to.
+    '''
+    def __init__(self, shared_memory: SharedMemory, arrays: dict[str, np.ndarray]):
+        super().__init__()
+        # Kept open as long as the index, since all arrays are views on it.
+        self.shared_memory = shared_memory
+        self.tracks = _SharedRecords(TrackRecord, arrays, 'tracks') # type: ignore
+        self.albums = _SharedRecords(AlbumRecord, arrays, 'albums') # type: ignore
+        self.artists = _SharedRecords(ArtistRecord, arrays, 'artists') # type: ignore
+        self.tracks_by_title = _SharedKeyed(arrays, 'tracks_by_title') # type: ignore
+        self.albums_by_title = _SharedKeyed(arrays, 'albums_by_title') # type: ignore
+        self.artists_by_name = _SharedKeyed(arrays, 'artists_by_name') # type: ignore
+        self.tracks_by_album = _SharedGroups(arrays, 'tracks_by_album') # type: ignore
+        self.tracks_by_artist = _SharedGroups(arrays, 'tracks_by_artist') # type: ignore
+        self.tracks_by_external_id = _SharedKeyed(arrays, 'tracks_by_external_id') # type: ignore
+        if 'candidates.postings' in arrays:
+            self._candidate_index = CandidateIndex.from_arrays({name.removeprefix('candidates.'): array for name, array in arrays.items()
+                                                                if name.startswith('candidates.')})
+
+    def add_track(self, record: TrackRecord):
+        raise TypeError("A shared library index cannot be changed.")
+
+    def track_by_external_id(self, scheme: str, value: str) -> TrackRecord | None:
+        rating_keys = self.tracks_by_external_id.get(external_id(scheme, value), [])
+        return self.tracks[rating_keys[0]] if rating_keys else None
+
+    def _records(self, table: "_SharedRecords", rating_keys: list[int]) -> list: # type: ignore
+        return table.many(rating_keys)
+
+    def _search(self, keyed_name: str, value: str) -> list[int]:
+        cache_key = (keyed_name, value)
+        if cache_key not in self._search_cache:
+            self._search_cache[cache_key] = getattr(self, keyed_name).search(value)
+        return self._search_cache[cache_key]
+
+def attach_library(name: str, layout: Layout) -> SharedLibraryIndex:
+    '''
+    Open the shared library with the given name and layout (see SharedLibrary), e.g. in a worker process.
+    '''
+    shared_memory = SharedMemory(name = name)
+    return SharedLibraryIndex(shared_memory, {array_name: _view(shared_memory, array_layout) for array_name, array_layout in layout.items()})
+
+def library_arrays(library_index: LibraryIndex, with_candidates: bool = False) -> dict[str, np.ndarray]:
+    '''
+    Return the records and lookups of a library index as flat arrays, by name, with the trigram indexes of the keys that are searched.
+    With with_candidates, the arrays of its candidate index (see CandidateIndex) are included, so workers do not build their own.
+    '''
+    arrays = {} # type: dict[str, np.ndarray]
+    arrays.update(_record_arrays(TrackRecord, library_index.tracks.values(), 'tracks'))
+    arrays.update(_record_arrays(AlbumRecord, library_index.albums.values(), 'albums'))
+    arrays.update(_record_arrays(ArtistRecord, library_index.artists.values(), 'artists'))
+    for keyed_name in ('tracks_by_title', 'albums_by_title', 'artists_by_name'):
+        arrays.update(_keyed_arrays(getattr(library_index, keyed_name), keyed_name, library_index.key_index(keyed_name)))
+    arrays.update(_group_arrays(library_index.tracks_by_album, 'tracks_by_album'))
+    arrays.update(_group_arrays(library_index.tracks_by_artist, 'tracks_by_artist'))
+    arrays.update(_keyed_arrays({key: [rating_key] for key, rating_key in library_index.tracks_by_external_id.items()}, 'tracks_by_external_id'))
+    if with_candidates:
+        arrays.update({f"candidates.{name}": array for name, array in library_index.candidate_index().arrays().items()})
+    return arrays
+
+class _SharedStrings:
+    '''
+    Column of strings: string nr i is blob[starts[i]:starts[i + 1] - 1], the last byte being the separator.
+    '''
+    def __init__(self, arrays: dict[str, np.ndarray], prefix: str):
+        self.blob = memoryview(arrays[f"{prefix}.blob"]) # type: ignore
+        self.starts = arrays[f"{prefix}.starts"]
+
+    def __getitem__(self, nr: int) -> str:
+        return str(self.blob[self.starts[nr]:self.starts[nr + 1] - 1], 'utf-8')
+
+    def __len__(self) -> int:
+        return len(self.starts) - 1
+
+    def many(self, numbers: np.ndarray) -> list[str]:
+        '''
+        Return the strings with the given numbers, in order.
+        '''
+        return [str(self.blob[start:end - 1], 'utf-8') for start, end in zip(self.starts[numbers].tolist(), self.starts[numbers + 1].tolist())]
+
+class _SharedRecords(Mapping):
+    '''
+    Table of records by ratingKey, in the order of the dictionary it was made from.
+    The integer fields of a record are a row of one array, the string fields one string separated by FIELD_SEPARATOR,
+    so a record is decoded in one step.
+    '''
+    def __init__(self, record_type: type, arrays: dict[str, np.ndarray], prefix: str):
+        self.record_type = record_type
+        self.ints = arrays[f"{prefix}.ints"]
+        self.strings = _SharedStrings(arrays, f"{prefix}.strings")
+        self.rating_keys = arrays[f"{prefix}.rating_keys"]
+        self.sorted_keys = arrays[f"{prefix}.sorted_keys"]
+        self.order = arrays[f"{prefix}.order"]
+        self.cache = {} # type: dict[int, tuple]
+        # Picks the fields of a record, in order, from its integer fields followed by its string fields.
+        int_fields, str_fields = _fields(record_type)
+        self.fields = itemgetter(*(int_fields.index(field) if field in int_fields else len(int_fields) + str_fields.index(field)
+                                   for field in record_type._fields))
+
+    def __getitem__(self, rating_key: int):
+        if not isinstance(rating_key, (int, np.integer)):
+            raise KeyError(rating_key)
+        return self.many([rating_key])[0]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.rating_keys.tolist())
+
+    def __len__(self) -> int:
+        return len(self.rating_keys)
+
+    def many(self, rating_keys: list[int]) -> list:
+        '''
+        Return the records with the given ratingKeys, in order. Raises a KeyError if one of them is not in the table.
+        '''
+        keys = np.array(rating_keys, dtype = np.int64)
+        positions = np.minimum(np.searchsorted(self.sorted_keys, keys), max(len(self.sorted_keys) - 1, 0))
+        missing = keys[self.sorted_keys[positions] != keys] if len(self.sorted_keys) else keys
+        if len(missing):
+            raise KeyError(missing[0].item())
+        rows = self.order[positions].tolist()
+        missed = [row for row in dict.fromkeys(rows) if row not in self.cache]
+        if len(self.cache) + len(missed) > RECORD_CACHE:
+            self.cache.clear()
+            missed = list(dict.fromkeys(rows))
+        new, fields = tuple.__new__, self.fields
+        for row, ints, strings in zip(missed, self.ints[missed].tolist(), self.strings.many(np.array(missed, dtype = np.int64))):
+            self.cache[row] = new(self.record_type, fields(ints + strings.split(FIELD_SEPARATOR)))
+        return [self.cache[row] for row in rows]
+
+class _SharedKeyed:
+    '''
+    Lists of ratingKeys by string key, like the keyed dictionaries of a library index: exact lookups and substring searches over the keys.
+    Substring searches need the trigram index of the keys (see KeyIndex), which is only shared for the dictionaries that are searched.
+    '''
+    def __init__(self, arrays: dict[str, np.ndarray], prefix: str):
+        self.keys = _SharedStrings(arrays, f"{prefix}.keys")
+        self.order = arrays[f"{prefix}.order"]
+        self.values = _SharedGroups(arrays, prefix)
+        self.key_index = None # type: KeyIndex | None
+        if f"{prefix}.index.postings" in arrays:
+            self.key_index = KeyIndex.from_arrays({name.removeprefix(f"{prefix}.index."): array for name, array in arrays.items()
+                                                   if name.startswith(f"{prefix}.index.")}, self.keys)
+
+    def get(self, key: str, default: list[int] | None = None) -> list[int] | None:
+        position = bisect_left(range(len(self.order)), key, key = lambda position: self.keys[self.order[position]])
+        if position < len(self.order) and self.keys[self.order[position]] == key:
+            return self.values.group(int(self.order[position]))
+        return default
+
+    def search(self, value: str) -> list[int]:
+        '''
+        Return the ratingKeys of all keys that contain value, with the exact key first; the same as _search_keys on the dictionary.
+        '''
+        assert self.key_index is not None
+        found = list(self.get(value, []))
+        if not value:
+            return found
+        for nr in self.key_index.containing(value):
+            if self.keys[nr] != value:
+                found.extend(self.values.group(nr))
+        return found
+
+class _SharedGroups:
+    '''
+    Lists of ratingKeys, by number or by integer key (the ratingKey of an album or artist).
+    '''
+    def __init__(self, arrays: dict[str, np.ndarray], prefix: str):
+        self.keys = arrays.get(f"{prefix}.group_keys")
+        self.starts = arrays[f"{prefix}.value_starts"]
+        self.values = arrays[f"{prefix}.values"]
+
+    def group(self, nr: int) -> list[int]:
+        return self.values[self.starts[nr]:self.starts[nr + 1]].tolist()
+
+    def get(self, key: int, default: list[int] | None = None) -> list[int] | None:
+        assert self.keys is not None
+        position = int(np.searchsorted(self.keys, key))
+        if position < len(self.keys) and self.keys[position] == key:
+            return self.group(position)
+        return default
+
+def _view(shared_memory: SharedMemory, array_layout: tuple[str, tuple[int, ...], int]) -> np.ndarray:
+    dtype, shape, offset = array_layout
+    return np.ndarray(shape, dtype = dtype, buffer = shared_memory.buf, offset = offset)
+
+def _fields(record_type: type) -> tuple[list[str], list[str]]:
+    '''
+    Return the integer fields and the string fields of a record type.
+    '''
+    int_fields = [field for field, kind in record_type.__annotations__.items() if kind is int]
+    return int_fields, [field for field in record_type._fields if field not in int_fields]
+
+def _record_arrays(record_type: type, records: Iterable[tuple], prefix: str) -> dict[str, np.ndarray]:
+    records = list(records)
+    int_fields, str_fields = _fields(record_type)
+    arrays = _string_arrays((FIELD_SEPARATOR.join(getattr(record, field) for field in str_fields) for record in records), f"{prefix}.strings")
+    arrays[f"{prefix}.ints"] = np.array([[getattr(record, field) for field in int_fields] for record in records], dtype = np.int64).reshape(len(records), len(int_fields))
+    arrays[f"{prefix}.rating_keys"] = np.fromiter((record[0] for record in records), dtype = np.int64, count = len(records))
+    arrays[f"{prefix}.order"] = np.argsort(arrays[f"{prefix}.rating_keys"], kind = 'stable')
+    arrays[f"{prefix}.sorted_keys"] = arrays[f"{prefix}.rating_keys"][arrays[f"{prefix}.order"]]
+    return arrays
+
+def _keyed_arrays(keyed: dict[str, list[int]], prefix: str, key_index: KeyIndex | None = None) -> dict[str, np.ndarray]:
+    keys = list(keyed)
+    arrays = _string_arrays(keys, f"{prefix}.keys")
+    arrays[f"{prefix}.order"] = np.array(sorted(range(len(keys)), key = keys.__getitem__), dtype = np.int64)
+    arrays.update(_value_arrays(keyed.values(), prefix))
+    if key_index is not None:
+        arrays.update({f"{prefix}.index.{name}": array for name, array in key_index.arrays().items()})
+    return arrays
+
+def _group_arrays(groups: dict[int, list[int]], prefix: str) -> dict[str, np.ndarray]:
+    keys = sorted(groups)
+    arrays = {f"{prefix}.group_keys": np.array(keys, dtype = np.int64)}
+    arrays.update(_value_arrays((groups[key] for key in keys), prefix))
+    return arrays
+
+def _string_arrays(strings: Iterable[str], prefix: str) -> dict[str, np.ndarray]:
+    encoded = [(string + SEPARATOR).encode('utf-8') for string in strings]
+    return {f"{prefix}.blob": np.frombuffer(b"".join(encoded), dtype = np.uint8),
+            f"{prefix}.starts": offsets(len(data) for data in encoded)}
+
+def _value_arrays(groups: Iterable[list[int]], prefix: str) -> dict[str, np.ndarray]:
+    groups = list(groups)
+    starts = offsets(len(group) for group in groups)
+    return {f"{prefix}.value_starts": starts,
+            f"{prefix}.values": np.fromiter((value for group in groups for value in group), dtype = np.int64, count = starts[-1])}
@@ -1,42 +1,170 @@
 """
 This module handles all Spotify API interactions.
 """
+from functools import partial
+from typing import Iterator, NamedTuple
+
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 from spotipy.exceptions import SpotifyException
-from credentials.credentials import spotify as spcredentials
+from credentials.credentials import spotify_credentials
+from src import http_session
+from src.pool import cached_factory, ordered_map
+
+# Fields of playlist items that matching and reporting use; requesting only these keeps the responses small.
+PLAYLIST_ITEM_FIELDS = "total,items(added_at,track(id,name,duration_ms,external_ids(isrc),artists(name),album(id,name)))"
+# Number of playlist items per page (the maximum spotify allows), and number of pages fetched concurrently.
+PAGE_SIZE = 100
+PAGE_WORKERS = 4
+
+class SpotifyTrack(NamedTuple):
+    '''
+    Compact record of a track in a spotify playlist, with only the fields that matching and reporting use.
+    Records are built as soon as a page of playlist items arrives, so the response dicts are not kept around.
+    '''
+    # None for local files, which have no spotify id.
+    id: str | None
+    name: str
+    # Name of the first artist.
+    artist: str
+    album: str
+    album_id: str | None
+    # Length of the track in milliseconds, None if unknown.
+    duration_ms: int | None
+    isrc: str | None
+    # When the track was added to the playlist, as spotify gives it.
+    added_at: str | None
 
+    @classmethod
+    def from_item(cls, item: dict) -> "SpotifyTrack":
+        '''
+        Build the record of a playlist item of the spotify API. Items whose track is gone get empty fields.
+        '''
+        track = item.get('track') or {}
+        artists = track.get('artists') or [{}]
+        album = track.get('album') or {}
+        return cls(id = track.get('id'),
+                   name = track.get('name') or '',
+                   artist = artists[0].get('name') or '',
+                   album = album.get('name') or '',
+                   album_id = album.get('id'),
+                   duration_ms = track.get('duration_ms'),
+                   isrc = (track.get('external_ids') or {}).get('isrc'),
+                   added_at = item.get('added_at'))
 
-sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
-    client_id=spcredentials["client_id"],
-    client_secret=spcredentials["client_secret"],
-    redirect_uri=spcredentials["redirect_uri"],
-    scope=spcredentials["scope"],
-))
+@cached_factory
+def spotify_client() -> spotipy.Spotify:
+    '''
+    Create the spotify client from the credentials, on first use. Its requests go through the shared HTTP session.
+    '''
+    spcredentials = spotify_credentials()
+    return spotipy.Spotify(auth_manager=SpotifyOAuth(
+        client_id=spcredentials["client_id"],
+        client_secret=spcredentials["client_secret"],
+        redirect_uri=spcredentials["redirect_uri"],
+        scope=spcredentials["scope"],
+    ), requests_session = http_session.shared_session(), requests_timeout = http_session.TIMEOUT)
 
 def get_spotify_playlist_name(playlist_id: str) -> str:
     '''
     Retrieve the spotify playlist name from the id.
     '''
     try:
-        playlist = sp.playlist(playlist_id)
+        playlist = spotify_client().playlist(playlist_id)
         assert playlist is not None
         return playlist['name']
     except SpotifyException as exc:
         raise ValueError(f"Could not retrieve spotify playlist with id {playlist_id}, please check the settings.") from exc
 
-def tracks_from_spotify_playlist(playlist_id: str) -> list[dict[str, str|list[str]]]:
+def tracks_from_spotify_playlist(playlist_id: str, workers: int = PAGE_WORKERS) -> list[SpotifyTrack]:
     '''
     Get a list of all tracks in a Spotify playlist by id.
+    Only the fields needed for matching and reporting are requested.
+    '''
+    return list(iter_spotify_playlist(playlist_id, workers = workers))
+
+def iter_spotify_playlist(playlist_id: str, workers: int = PAGE_WORKERS) -> Iterator[SpotifyTrack]:
+    '''
+    Iterate over all tracks in a Spotify playlist by id, in playlist order.
+    After the first page, which tells the total number of tracks, the remaining pages are fetched concurrently by a bounded pool of workers.
+    Tracks are yielded as soon as their page (and all pages before it) arrived, so they can be matched while later pages are still being fetched.
+    The first page is fetched right away, by this call, so an unknown playlist fails here rather than on the first track.
+    '''
+    results = _fetch_page(playlist_id, 0)
+    return _iter_pages_after(playlist_id, results, 0, workers)
+
+def spotify_playlist_snapshot_id(playlist_id: str) -> str:
+    '''
+    Retrieve the snapshot id of a spotify playlist, which changes whenever the playlist changes.
+    '''
+    try:
+        playlist = spotify_client().playlist(playlist_id, fields = "snapshot_id")
+        assert playlist is not None
+        return playlist['snapshot_id']
+    except SpotifyException as exc:
+        raise ValueError(f"Could not retrieve spotify playlist with id {playlist_id}, please check the settings.") from exc
+
+def tracks_from_spotify_playlist_since(playlist_id: str, previous_tracks: list[SpotifyTrack], workers: int = PAGE_WORKERS) -> list[SpotifyTrack]:
     '''
-    tracks = []
-    results = sp.playlist_items(playlist_id, limit = 100) # type: dict[str, str | list] | None
+    Get a list of all tracks in a Spotify playlist, given the tracks it had at an earlier snapshot.
+    If the playlist only grew at the end since then, only the pages with the new tracks are fetched.
+    This is checked on the first page and on the position of the last earlier track; if either differs, the whole playlist is fetched.
+    '''
+    results = _fetch_page(playlist_id, 0)
+    nr_previous = len(previous_tracks)
+    first_items = [SpotifyTrack.from_item(item) for item in results["items"]]
+
+    if (not nr_previous or results["total"] < nr_previous
+            or not _same_items(first_items, previous_tracks[:len(first_items)])):
+        return list(_iter_pages_after(playlist_id, results, 0, workers))
+    if nr_previous <= len(first_items):
+        # All earlier tracks are on the first page.
+        return list(_iter_pages_after(playlist_id, results, 0, workers))
+
+    boundary = _fetch_page(playlist_id, nr_previous - 1, limit = 1)
+    if not _same_items([SpotifyTrack.from_item(item) for item in boundary["items"]], previous_tracks[-1:]):
+        return list(_iter_pages_after(playlist_id, results, 0, workers))
+
+    results = _fetch_page(playlist_id, nr_previous)
+    return list(previous_tracks) + list(_iter_pages_after(playlist_id, results, nr_previous, workers))
+
+def _iter_pages_after(playlist_id: str, results: dict, offset: int, workers: int) -> Iterator[SpotifyTrack]:
+    '''
+    Yield the tracks of a fetched page at the given offset, and then the tracks of all pages after it, in playlist order.
+    The pages after it are fetched concurrently, with at most twice the number of workers in flight.
+    '''
+    yield from map(SpotifyTrack.from_item, results["items"])
+    offsets = range(offset + PAGE_SIZE, results["total"], PAGE_SIZE)
+    for page in ordered_map(partial(_fetch_page, playlist_id), offsets, workers = workers):
+        yield from map(SpotifyTrack.from_item, page["items"])
+
+def _fetch_page(playlist_id: str, offset: int, limit: int = PAGE_SIZE) -> dict:
+    '''
+    Fetch one page of playlist items.
+    Rate limited responses (429) are retried by the shared HTTP session, which waits for as long as their Retry-After header says.
+    '''
+    results = spotify_client().playlist_items(playlist_id, limit = limit, offset = offset, fields = PLAYLIST_ITEM_FIELDS) # type: dict[str, str | list] | None
     assert results is not None
-    
-    tracks.extend(results["items"])
+    return results
+
+def _same_items(tracks: list[SpotifyTrack], other_tracks: list[SpotifyTrack]) -> bool:
+    '''
+    Check if two lists of playlist tracks hold the same tracks, added at the same times.
+    '''
+    return [(track.added_at, track.id) for track in tracks] == [(track.added_at, track.id) for track in other_tracks]
+
+def user_playlist_ids(user: str) -> list[str]:
+    '''
+    Get the ids of all public playlists of a Spotify user.
+    '''
+    playlist_ids = []
+    results = spotify_client().user_playlists(user, limit = 50) # type: dict[str, str | list] | None
+    assert results is not None
+
+    playlist_ids.extend(playlist['id'] for playlist in results["items"])
     while results["next"]:
-        results = sp.next(results)
+        results = spotify_client().next(results)
         assert results is not None
-        tracks.extend(results["items"])
-    
-    return tracks
\ No newline at end of file
+        playlist_ids.extend(playlist['id'] for playlist in results["items"])
+
+    return playlist_ids
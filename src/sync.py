@@ -1,57 +1,616 @@
 """
 This module contains the syncing functions.
 """
-from plexapi.server import PlexServer
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque
+from functools import partial
+from typing import Callable, Collection, Iterable, Iterator, Sized, TypeVar
+import time
+
 from plexapi.library import MusicSection
 from plexapi.playlist import Playlist
 from plexapi.audio import Track
-from plexapi.exceptions import NotFound
+from plexapi.exceptions import BadRequest, NotFound, Unauthorized
+from requests.exceptions import RequestException
+
+from src.album_matching import match_with_album_assignments
+from src.matching import match_track, MATCHING_STRATEGIES
+from src.match_cache import MatchCache
+from src.library import LibraryIndex, TrackRecord
+from src.http_session import configure_http
+from src.instrumentation import stage, timed_iter
+from src.library_cache import load_library_index
+from src.metadata import track_metadata
+from src.pool import in_background
+from src.process_matching import match_in_processes
+from src.scoring import configure_scoring
+from src.spotify import tracks_from_spotify_playlist, tracks_from_spotify_playlist_since, spotify_playlist_snapshot_id
+from src.spotify import iter_spotify_playlist, SpotifyTrack, PAGE_WORKERS
+from src.spotify import get_spotify_playlist_name, user_playlist_ids
+from src.playlist_state import load_playlist_state, save_playlist_state, load_resume_records, save_resume_records
+from src.plex import plex_library, get_plex_playlist_name
+from src.save import TrackFiles
 
-from src.matching import match_track
-from src.spotify import tracks_from_spotify_playlist
-from src.plex import server, library, get_plex_playlist_name
+# Number of matched tracks that are written to the plex playlist in one request while syncing.
+FLUSH_SIZE = 100
+SYNC_MODES = ('from_scratch', 'append', 'append_new', 'mirror')
+# Number of times a failed playlist write is retried, and the seconds to wait before the first retry.
+WRITE_RETRIES = 4
+RETRY_DELAY = 1
 
-def sync(settings: dict[str,str | list[str] | bool]):
+R = TypeVar('R')
+
+def sync(settings: dict[str,str | list[str] | bool]) -> tuple[int, int, int]:
     '''
     Sync/create playlist based on settings.
+    Matching runs on the local library index. The tracks stream through the whole sync: spotify pages are matched as they arrive,
+    matched tracks are written to the plex playlist in chunks of FLUSH_SIZE, and all tracks are written to the files in the settings right away.
+    Returns the number of matched, unmatched and skipped spotify tracks.
     '''
     # Check typing
     assert isinstance(settings['playlist_id'], str)
     assert isinstance(settings['matching_pattern'], (str, list))
     assert isinstance(settings['print_matching_status'], bool)
     assert isinstance(settings['mapping_dict'], dict)
-    assert isinstance(settings['skip_list'], list)
-
-    spotify_tracks = tracks_from_spotify_playlist(settings['playlist_id'])
-
-    matched, unmatched, plex_tracks, skipped = find_tracks(plexlibrary = library,
-                              spotify_tracks = spotify_tracks,
-                              matching_pattern = settings['matching_pattern'],
-                              print_status = settings['print_matching_status'],
-                              mapping_dict = settings['mapping_dict'],
-                              skip_list = settings['skip_list'],
-                              plexserver = server,
-                              )
-
-    playlist_name = get_plex_playlist_name()
-
-    if settings['dry_run']:
-        print("Dry run - no playlist created.")
-    elif settings['sync_mode'] == 'from_scratch':
-        create_playlist(plexlibrary = library,
-                        plex_tracks = plex_tracks,
-                        playlist_name = playlist_name)
-    elif settings['sync_mode'] == 'append':
-        append_playlist(plexlibrary = library,
-                        plex_tracks = plex_tracks,
-                        playlist_name = playlist_name)
-    elif settings['sync_mode'] == 'append_new':
-        append_playlist_newtracks_only(plexlibrary = library,
-                                       plex_tracks = plex_tracks,
-                                       playlist_name = playlist_name)
+    assert isinstance(settings['skip_list'], (frozenset, set, list))
+
+    configure_clients(settings)
+    # Connecting to plex and loading the library index happen in the background, while spotify is queried
+    # (the playlist changes, or the first page of the playlist).
+    preparing_matching = in_background(prepare_matching, settings)
+    playlist_state = None
+    if settings.get('playlist_state_file'):
+        playlist_state = load_playlist_state(settings['playlist_state_file'])
+        with stage('spotify_fetch'):
+            spotify_tracks = fetch_playlist_changes(settings['playlist_id'], playlist_state, settings['sync_mode'],
+                                                    workers = settings.get('spotify_workers', PAGE_WORKERS))
+    else:
+        # The first page is fetched now; the later pages lazily, so pages are matched while later pages are still being fetched.
+        with stage('spotify_fetch'):
+            spotify_pages = iter_spotify_playlist(settings['playlist_id'], workers = settings.get('spotify_workers', PAGE_WORKERS))
+        spotify_tracks = timed_iter('spotify_fetch', spotify_pages)
+
+    playlist_name = get_plex_playlist_name(settings)
+    library_index = preparing_matching.result()
+    playlist_writer = open_playlist_writer(settings, library_index, playlist_name)
+
+    counts = Counter() # type: Counter[str]
+    retry = [] # type: list[str | tuple]
+    with TrackFiles(settings) as track_files:
+        matches = match_tracks(library_index = library_index,
+                               spotify_tracks = spotify_tracks,
+                               matching_pattern = settings['matching_pattern'],
+                               print_status = settings['print_matching_status'],
+                               mapping_dict = settings['mapping_dict'],
+                               skip_list = settings['skip_list'],
+                               workers = settings.get('matching_workers', 1),
+                               processes = settings.get('matching_processes', 1),
+                               match_cache = open_match_cache(settings, library_index),
+                               )
+        for spotify_track, plex_track, _ in timed_iter('matching', matches):
+            if plex_track == 'Skipped':
+                counts['skipped'] += 1
+                retry.append(_spotify_track_key(spotify_track))
+            elif plex_track:
+                counts['matched'] += 1
+                with stage('save'):
+                    track_files.write_matched(spotify_track, track_metadata([plex_track])[0])
+                playlist_writer.add(plex_track)
+            else:
+                counts['unmatched'] += 1
+                retry.append(_spotify_track_key(spotify_track))
+                with stage('save'):
+                    track_files.write_unmatched(spotify_track)
+        playlist_writer.close()
+
+    if playlist_state is not None and not settings['dry_run']:
+        playlist_state[settings['playlist_id']]['retry'] = retry
+        save_playlist_state(settings['playlist_state_file'], playlist_state)
+    return counts['matched'], counts['unmatched'], counts['skipped']
+
+def sync_many(settings: dict[str,str | list[str] | bool]) -> dict[str, tuple[list[SpotifyTrack], list[SpotifyTrack], list[TrackRecord], list[SpotifyTrack]]]:
+    '''
+    Sync several spotify playlists in one run: those in settings['playlist_ids'] and/or all playlists of settings['spotify_user'].
+    The library index is loaded once, and every distinct spotify track is matched once, however many playlists it is in.
+    Every plex playlist is named after its spotify playlist.
+    Returns the matched, unmatched, found and skipped tracks per spotify playlist id, and prints a summary per playlist.
+    '''
+    assert isinstance(settings['matching_pattern'], (str, list))
+    assert isinstance(settings['print_matching_status'], bool)
+
+    configure_clients(settings)
+    # Connecting to plex and loading the library index happen in the background, while the spotify playlists are fetched.
+    preparing_matching = in_background(prepare_matching, settings)
+    playlist_ids = list(settings.get('playlist_ids') or [])
+    if settings.get('spotify_user'):
+        playlist_ids.extend(user_playlist_ids(settings['spotify_user']))
+    playlist_ids = list(dict.fromkeys(playlist_ids))
+
+    playlist_state = None
+    with stage('spotify_fetch'):
+        if settings.get('playlist_state_file'):
+            playlist_state = load_playlist_state(settings['playlist_state_file'])
+            playlists = {playlist_id: fetch_playlist_changes(playlist_id, playlist_state, settings['sync_mode'],
+                                                             workers = settings.get('spotify_workers', PAGE_WORKERS))
+                         for playlist_id in playlist_ids}
+        else:
+            playlists = {playlist_id: tracks_from_spotify_playlist(playlist_id, workers = settings.get('spotify_workers', PAGE_WORKERS))
+                         for playlist_id in playlist_ids}
+    unique_tracks = {} # type: dict[str | tuple, SpotifyTrack]
+    for spotify_tracks in playlists.values():
+        for spotify_track in spotify_tracks:
+            unique_tracks.setdefault(_spotify_track_key(spotify_track), spotify_track)
+    print(f"\t{len(playlists)} playlists with {len(unique_tracks)} distinct tracks.")
+
+    library_index = preparing_matching.result()
+
+    with stage('matching'):
+        matched, _, found, skipped = find_tracks(library_index = library_index,
+                                  spotify_tracks = list(unique_tracks.values()),
+                                  matching_pattern = settings['matching_pattern'],
+                                  print_status = settings['print_matching_status'],
+                                  mapping_dict = settings['mapping_dict'],
+                                  skip_list = settings['skip_list'],
+                                  workers = settings.get('matching_workers', 1),
+                                  processes = settings.get('matching_processes', 1),
+                                  match_cache = open_match_cache(settings, library_index),
+                                  )
+    found_by_key = {_spotify_track_key(spotify_track): plex_track for spotify_track, plex_track in zip(matched, found)}
+    skipped_keys = {_spotify_track_key(spotify_track) for spotify_track in skipped}
+
+    results = {}
+    for playlist_id, spotify_tracks in playlists.items():
+        result = _split_results(spotify_tracks, found_by_key, skipped_keys)
+        playlist_name = get_spotify_playlist_name(playlist_id)
+        write_playlist(library_index = library_index,
+                       found = result[2],
+                       playlist_name = playlist_name,
+                       settings = settings)
+        print(f"\t{playlist_name}: {len(result[0])} matched, {len(result[1])} unmatched and {len(result[3])} skipped tracks.")
+        results[playlist_id] = result
+        if playlist_state is not None:
+            playlist_state[playlist_id]['retry'] = [_spotify_track_key(spotify_track) for spotify_track in result[1] + result[3]]
+
+    if playlist_state is not None and not settings['dry_run']:
+        save_playlist_state(settings['playlist_state_file'], playlist_state)
+    return results
+
+def merge_sync_results(results: dict[str, tuple[list[SpotifyTrack], list[SpotifyTrack], list[TrackRecord], list[SpotifyTrack]]]
+                       ) -> tuple[list[SpotifyTrack], list[SpotifyTrack], list[TrackRecord], list[SpotifyTrack]]:
+    '''
+    Merge the results of sync_many into single matched, unmatched, found and skipped lists, with every spotify track only once.
+    '''
+    matched, unmatched, found, skipped = [], [], [], []
+    seen = set()
+    for playlist_matched, playlist_unmatched, playlist_found, playlist_skipped in results.values():
+        for spotify_track, plex_track in zip(playlist_matched, playlist_found):
+            if _spotify_track_key(spotify_track) not in seen:
+                seen.add(_spotify_track_key(spotify_track))
+                matched.append(spotify_track)
+                found.append(plex_track)
+        for playlist_tracks, merged in ((playlist_unmatched, unmatched), (playlist_skipped, skipped)):
+            for spotify_track in playlist_tracks:
+                if _spotify_track_key(spotify_track) not in seen:
+                    seen.add(_spotify_track_key(spotify_track))
+                    merged.append(spotify_track)
+    return matched, unmatched, found, skipped
+
+def _spotify_track_key(spotify_track: SpotifyTrack) -> str | tuple:
+    '''
+    Key that identifies a spotify track across playlists: the track id, or for local files (which have no id) the name, artist and album.
+    '''
+    if spotify_track.id:
+        return spotify_track.id
+    return (spotify_track.name, spotify_track.artist, spotify_track.album)
+
+def _split_results(spotify_tracks: list[SpotifyTrack],
+                   found_by_key: dict[str | tuple, TrackRecord],
+                   skipped_keys: set[str | tuple],
+                   ) -> tuple[list[SpotifyTrack], list[SpotifyTrack], list[TrackRecord], list[SpotifyTrack]]:
+    '''
+    Split the tracks of one playlist into matched, unmatched, found and skipped, using the results of matching all distinct tracks.
+    '''
+    matched, unmatched, found, skipped = [], [], [], []
+    for spotify_track in spotify_tracks:
+        key = _spotify_track_key(spotify_track)
+        if key in skipped_keys:
+            skipped.append(spotify_track)
+        elif key in found_by_key:
+            matched.append(spotify_track)
+            found.append(found_by_key[key])
+        else:
+            unmatched.append(spotify_track)
+    return matched, unmatched, found, skipped
+
+def fetch_playlist_changes(playlist_id: str, playlist_state: dict[str, dict], sync_mode: str, workers: int = PAGE_WORKERS) -> list[SpotifyTrack]:
+    '''
+    Fetch the tracks of a spotify playlist that need matching, using the stored state of the previous sync, and update that state.
+    The playlist is only fetched if its snapshot_id changed, and then only from the first changed page if it only grew at the end.
+    For the append sync modes only tracks that are new since the previous sync, or that were unmatched or skipped then, need matching.
+    For from_scratch and mirror all tracks need matching.
+    '''
+    previous = playlist_state.get(playlist_id)
+    snapshot_id = spotify_playlist_snapshot_id(playlist_id)
+    if previous and previous['snapshot_id'] == snapshot_id:
+        spotify_tracks = previous['items']
+    elif previous:
+        spotify_tracks = tracks_from_spotify_playlist_since(playlist_id, previous['items'], workers = workers)
     else:
-        raise ValueError(f"Sync mode {settings['sync_mode']} is not known, valid options are from_scratch, append, append_new. Please check settings.yaml.")
-    return matched, unmatched, plex_tracks, skipped
+        spotify_tracks = tracks_from_spotify_playlist(playlist_id, workers = workers)
+    playlist_state[playlist_id] = {'snapshot_id': snapshot_id,
+                                   'items': spotify_tracks,
+                                   'retry': previous['retry'] if previous else []}
+
+    if not previous or sync_mode in ('from_scratch', 'mirror'):
+        return spotify_tracks
+
+    previous_keys = {_spotify_track_key(spotify_track) for spotify_track in previous['items']}
+    current_keys = {_spotify_track_key(spotify_track) for spotify_track in spotify_tracks}
+    nr_removed = len(previous_keys - current_keys)
+    if nr_removed:
+        print(f"\t{nr_removed} tracks were removed from the spotify playlist since the previous sync.")
+    retry_keys = set(previous['retry'])
+    return [spotify_track for spotify_track in spotify_tracks
+            if _spotify_track_key(spotify_track) not in previous_keys or _spotify_track_key(spotify_track) in retry_keys]
+
+def configure_clients(settings: dict[str,str | list[str] | bool]):
+    '''
+    Configure the HTTP session of the plex and spotify clients, based on settings.
+    Unless set, the connection pool holds a connection for every thread that can make requests at the same time.
+    '''
+    configure_http(pool_size = settings.get('http_pool_size') or max(settings.get('matching_workers') or 1,
+                                                                    settings.get('spotify_workers') or PAGE_WORKERS) + 1,
+                   timeout = settings.get('http_timeout'),
+                   retries = settings.get('http_retries'))
+
+def prepare_matching(settings: dict[str,str | list[str] | bool]) -> LibraryIndex:
+    '''
+    Configure the fuzzy scoring and load the library index (from the cache file if one is set), based on settings.
+    '''
+    configure_scoring(score_cutoff = settings.get('fuzzy_score_cutoff'),
+                      workers = settings.get('fuzzy_workers'),
+                      duration_tolerance = settings.get('duration_tolerance'))
+
+    with stage('library_index'):
+        if settings.get('library_cache_file'):
+            return load_library_index(plex_library(settings['plex_library_name']), settings['library_cache_file'])
+        return LibraryIndex.build(plex_library(settings['plex_library_name']))
+
+def open_match_cache(settings: dict[str,str | list[str] | bool], library_index: LibraryIndex) -> MatchCache | None:
+    '''
+    Open the cache of earlier matches if settings['match_cache_file'] is set, otherwise return None.
+    '''
+    if not settings.get('match_cache_file'):
+        return None
+    return MatchCache(settings['match_cache_file'], library_index, settings['matching_pattern'])
+
+def open_playlist_writer(settings: dict[str,str | list[str] | bool], library_index: LibraryIndex, playlist_name: str) -> 'PlaylistWriter':
+    '''
+    Open a writer for the plex playlist with the given name, with the sync mode, chunk size and resume file from the settings.
+    '''
+    return PlaylistWriter(plexlibrary = plex_library(settings['plex_library_name']),
+                          library_index = library_index,
+                          playlist_name = playlist_name,
+                          sync_mode = settings['sync_mode'],
+                          dry_run = settings['dry_run'],
+                          chunk_size = settings.get('playlist_chunk_size') or FLUSH_SIZE,
+                          resume_file = settings.get('playlist_resume_file') or None)
+
+def write_playlist(library_index: LibraryIndex,
+                   found: list[TrackRecord],
+                   playlist_name: str,
+                   settings: dict[str,str | list[str] | bool]):
+    '''
+    Write the found tracks to the plex playlist with the given name, according to the sync mode in the settings.
+    '''
+    playlist_writer = open_playlist_writer(settings, library_index, playlist_name)
+    for plex_track in found:
+        playlist_writer.add(plex_track)
+    playlist_writer.close()
+
+class PlaylistWriter:
+    '''
+    Writes matched tracks to a plex playlist in chunks of chunk_size, according to the sync mode, while matching is still going on.
+    With from_scratch the playlist is created with the first chunk, append and append_new add every chunk to the existing playlist.
+    Only the tracks of one chunk are fetched from the server at a time, and every chunk is retried on its own if writing it fails.
+    With mirror, the playlist can only be compared once all tracks are known, so the tracks are collected and mirrored on close().
+
+    If a resume_file is given, the written chunks are recorded in it until the writer is closed.
+    A sync that was interrupted then continues on the same playlist, and skips the tracks it already wrote. If the tracks now come in
+    a different order, the tracks that were already written keep their place, and the other tracks are added behind them.
+    '''
+    def __init__(self,
+                 plexlibrary: MusicSection,
+                 library_index: LibraryIndex,
+                 playlist_name: str,
+                 sync_mode: str,
+                 dry_run: bool = False,
+                 chunk_size: int = FLUSH_SIZE,
+                 resume_file: str | None = None):
+        if sync_mode not in SYNC_MODES:
+            raise ValueError(f"Sync mode {sync_mode} is not known, valid options are {', '.join(SYNC_MODES)}. Please check settings.yaml.")
+        self.plexlibrary = plexlibrary
+        self.library_index = library_index
+        self.playlist_name = playlist_name
+        self.sync_mode = sync_mode
+        self.dry_run = dry_run
+        self.chunk_size = chunk_size
+        self.resume_file = resume_file if sync_mode != 'mirror' and not dry_run else None
+        self.playlist = None # type: Playlist | None
+        self.playlist_size = 0
+        self.current_track_ids = None # type: set[int] | None
+        self._pending = [] # type: list[TrackRecord]
+        self._written = [] # type: list[int]
+        # Number of times every track was written by an interrupted sync, and is still to be skipped.
+        self._resumed = Counter() # type: Counter[int]
+
+        self._resume_key = f"{sync_mode}:{playlist_name}"
+        record = load_resume_records(self.resume_file).get(self._resume_key) if self.resume_file else None
+        if record:
+            try:
+                self._use_playlist(plexlibrary._server.fetchItem(record['playlist']))
+                self._written = record['written']
+                self._resumed = Counter(self._written)
+                print(f"\tResuming the interrupted sync of playlist {playlist_name} after {len(self._written)} tracks.")
+            except NotFound:
+                pass
+
+    def add(self, plex_track: TrackRecord):
+        '''
+        Add a matched track to the playlist; it is written once a whole chunk is pending.
+        '''
+        if self._resumed[plex_track.ratingKey]:
+            # Already in the playlist, and in the resume record.
+            self._resumed[plex_track.ratingKey] -= 1
+            return
+        self._pending.append(plex_track)
+        if len(self._pending) >= self.chunk_size and self.sync_mode != 'mirror':
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the pending tracks to the playlist, and record them in the resume file.
+        '''
+        pending, self._pending = self._pending, []
+        if self.dry_run or not pending:
+            return
+        with stage('playlist_write'):
+            self._write(pending)
+
+    def _write(self, pending: list[TrackRecord]):
+        if self.playlist is None and self.sync_mode == 'from_scratch':
+            self.playlist = _create_playlist(self.plexlibrary, self.library_index.fetch_tracks(pending), self.playlist_name)
+            self.playlist_size = len(pending)
+        else:
+            if self.playlist is None:
+                self._use_playlist(_find_playlist(self.plexlibrary, self.playlist_name))
+            new_tracks = self._new_tracks(pending) if self.sync_mode == 'append_new' else pending
+            if new_tracks:
+                plex_tracks = self.library_index.fetch_tracks(new_tracks)
+                expected_size = self.playlist_size + len(plex_tracks)
+                _with_retries(partial(self.playlist.addItems, plex_tracks),
+                              was_applied = lambda: _playlist_size(self.playlist) == expected_size)
+                self.playlist_size = expected_size
+        if self.resume_file:
+            self._written.extend(plex_track.ratingKey for plex_track in pending)
+            self._save_resume_record({'playlist': self.playlist.ratingKey, 'written': self._written})
+
+    def _new_tracks(self, pending: list[TrackRecord]) -> list[TrackRecord]:
+        '''
+        Return the pending tracks that are not in the playlist yet, each once, and count them as in the playlist from now on.
+        The ratingKeys of the playlist items are fetched once, at the first chunk, so only the new tracks need to be fetched from the server.
+        '''
+        if self.current_track_ids is None:
+            self.current_track_ids = {rating_key for rating_key, _ in _playlist_items(self.playlist)}
+        new_tracks = []
+        for plex_track in pending:
+            if plex_track.ratingKey not in self.current_track_ids:
+                self.current_track_ids.add(plex_track.ratingKey)
+                new_tracks.append(plex_track)
+        return new_tracks
+
+    def close(self):
+        '''
+        Write the remaining pending tracks. The sync is complete, so its resume record is removed.
+        '''
+        if self.sync_mode == 'mirror' and not self.dry_run:
+            pending, self._pending = self._pending, []
+            with stage('playlist_write'):
+                mirror_playlist(plexlibrary = self.plexlibrary,
+                                library_index = self.library_index,
+                                found = pending,
+                                playlist_name = self.playlist_name,
+                                chunk_size = self.chunk_size)
+        self.flush()
+        self._save_resume_record(None)
+        if self.dry_run:
+            print("Dry run - no playlist created.")
+
+    def _use_playlist(self, playlist: Playlist):
+        self.playlist = playlist
+        self.playlist_size = _playlist_size(playlist)
+
+    def _save_resume_record(self, record: dict | None):
+        if not self.resume_file:
+            return
+        records = load_resume_records(self.resume_file)
+        if record is None and self._resume_key not in records:
+            return
+        if record is None:
+            del records[self._resume_key]
+        else:
+            records[self._resume_key] = record
+        save_resume_records(self.resume_file, records)
+
+def _with_retries(write: Callable[[], R], was_applied: Callable[[], bool] | None = None) -> R:
+    '''
+    Run a request that writes to a playlist, and retry it up to WRITE_RETRIES times, waiting twice as long before every retry.
+    A request that failed with a timeout may still have been carried out by the server; was_applied is checked before retrying, so it is not done twice.
+    '''
+    attempt = 0
+    while True:
+        try:
+            return write()
+        except (RequestException, BadRequest) as exc:
+            if isinstance(exc, Unauthorized) or attempt >= WRITE_RETRIES:
+                raise
+            print(f"\tWriting to the playlist failed ({exc}), retrying.")
+            time.sleep(RETRY_DELAY * 2**attempt)
+            attempt += 1
+            if was_applied and was_applied():
+                return None # type: ignore
+
+def _playlist_size(playlist: Playlist) -> int:
+    '''
+    Return the number of items in the playlist, without fetching them.
+    '''
+    container = playlist._server.query(f"{playlist.key}/items", headers = {'X-Plex-Container-Start': '0', 'X-Plex-Container-Size': '0'})
+    return int(container.attrib.get('totalSize', container.attrib.get('size', 0)))
+
+def mirror_playlist(plexlibrary: MusicSection,
+                    library_index: LibraryIndex,
+                    found: list[TrackRecord],
+                    playlist_name: str,
+                    chunk_size: int = FLUSH_SIZE):
+    '''
+    Make the plex playlist with the given name hold exactly the found tracks, in that order, by changing only what differs.
+    The playlist items are fetched once and compared with the found tracks by ratingKey. Items that are not wanted anymore are removed,
+    missing tracks are added in chunks, and only items that are out of order are moved: the most items that are already in order stay put
+    (see _match_items). Plex has no endpoint to remove or move several items at once, so every removed or moved item is a request of its own.
+    Creates the playlist if there is none with that name yet.
+    '''
+    try:
+        playlist = plexlibrary.playlist(playlist_name)
+    except NotFound:
+        playlist = None
+    if playlist is None:
+        if not found:
+            print(f"\tNo tracks to create playlist {playlist_name} with.")
+            return
+        for start in range(0, len(found), chunk_size):
+            plex_tracks = library_index.fetch_tracks(found[start:start + chunk_size])
+            if playlist is None:
+                playlist = _create_playlist(plexlibrary, plex_tracks, playlist_name)
+            else:
+                _with_retries(partial(playlist.addItems, plex_tracks),
+                              was_applied = lambda size = start + len(plex_tracks): _playlist_size(playlist) == size)
+        print(f"\tCreated playlist {playlist_name} with {len(found)} tracks.")
+        return
+
+    items = _playlist_items(playlist)
+    matched_items, removed_items, missing = _match_items([rating_key for rating_key, _ in items], [plex_track.ratingKey for plex_track in found])
+    kept = [(items[index][1], position) for index, position in matched_items]
+    removed = [items[index][1] for index in removed_items]
+
+    for item_id in removed:
+        playlist._server.query(f"{playlist.key}/items/{item_id}", method = playlist._server._session.delete)
+    if missing:
+        playlist_size = len(kept)
+        for start in range(0, len(missing), chunk_size):
+            plex_tracks = library_index.fetch_tracks([found[position] for position in missing[start:start + chunk_size]])
+            playlist_size += len(plex_tracks)
+            _with_retries(partial(playlist.addItems, plex_tracks),
+                          was_applied = lambda size = playlist_size: _playlist_size(playlist) == size)
+        # Added items end up behind the kept ones, in the order they were added.
+        added_ids = [item_id for _, item_id in _playlist_items(playlist)[len(kept):]]
+        kept.extend(zip(added_ids, missing))
+
+    item_ids = [0]*len(found)
+    for item_id, position in kept:
+        item_ids[position] = item_id
+    in_order = _longest_increasing_subsequence([position for _, position in kept])
+    moved = sorted(position for index, (_, position) in enumerate(kept) if index not in in_order)
+    # In ascending order, every moved item goes right behind its predecessor, which is in place by then.
+    for position in moved:
+        key = f"{playlist.key}/items/{item_ids[position]}/move"
+        if position:
+            key += f"?after={item_ids[position - 1]}"
+        playlist._server.query(key, method = playlist._server._session.put)
+    print(f"\tMirrored playlist {playlist_name}: {len(missing)} added, {len(removed)} removed and {len(moved)} moved tracks.")
+
+def _playlist_items(playlist: Playlist) -> list[tuple[int, int]]:
+    '''
+    Return the ratingKey and playlistItemID of every item in the playlist, in order, in one request.
+    '''
+    return [(int(element.attrib['ratingKey']), int(element.attrib['playlistItemID']))
+            for element in playlist._server.query(f"{playlist.key}/items")]
+
+def _match_items(current: list[int], wanted: list[int]) -> tuple[list[tuple[int, int]], list[int], list[int]]:
+    '''
+    Match the items of a playlist, given by ratingKey, with the positions of the wanted ratingKeys, so that as few items as possible have to be moved.
+    Items that stay put form an increasing run of wanted positions, with the positions of every item in descending order so that a run uses at most one of them,
+    followed by the added items, which end up behind all others in ascending order: the positions of a track beyond its number of items are added, and those
+    after the run are in order too. The run with the most items in order, counting those, is kept in place.
+    The other items of a track take its remaining positions from the front, and items beyond those are removed.
+    Returns the index and position of every kept item in playlist order, the indices of the removed items, and the positions that no item takes.
+    '''
+    wanted_positions = {} # type: dict[int, list[int]]
+    for position, rating_key in enumerate(wanted):
+        wanted_positions.setdefault(rating_key, []).append(position)
+    pairs = [(index, position) for index, rating_key in enumerate(current) for position in reversed(wanted_positions.get(rating_key, []))]
+    items_per_track = Counter(current)
+    added_positions = sorted(position for rating_key, positions in wanted_positions.items() for position in positions[items_per_track[rating_key]:])
+
+    lengths, previous = _increasing_subsequences([position for _, position in pairs])
+    # Number of items in order for the run that ends at every pair, or for no run at all (-1).
+    in_order_counts = {-1: len(added_positions)}
+    in_order_counts.update((nr, lengths[nr] + len(added_positions) - bisect_right(added_positions, position))
+                           for nr, (_, position) in enumerate(pairs))
+    in_order = dict(pairs[nr] for nr in _subsequence(previous, max(in_order_counts, key = in_order_counts.__getitem__)))
+    taken = set(in_order.values())
+    free_positions = {rating_key: deque(position for position in positions if position not in taken)
+                      for rating_key, positions in wanted_positions.items()}
+
+    kept = [] # type: list[tuple[int, int]]
+    removed = [] # type: list[int]
+    for index, rating_key in enumerate(current):
+        if index in in_order:
+            kept.append((index, in_order[index]))
+        elif free_positions.get(rating_key):
+            kept.append((index, free_positions[rating_key].popleft()))
+        else:
+            removed.append(index)
+    missing = sorted(position for positions in free_positions.values() for position in positions)
+    return kept, removed, missing
+
+def _longest_increasing_subsequence(values: list[int]) -> set[int]:
+    '''
+    Return the indices of a longest strictly increasing subsequence of values.
+    '''
+    lengths, previous = _increasing_subsequences(values)
+    return _subsequence(previous, max(range(len(values)), key = lengths.__getitem__, default = -1))
+
+def _increasing_subsequences(values: list[int]) -> tuple[list[int], list[int]]:
+    '''
+    Return for every index the length of the longest strictly increasing subsequence of values that ends there,
+    and the index before it in that subsequence (-1 for none).
+    '''
+    tails = [] # type: list[int]
+    tail_indices = [] # type: list[int]
+    lengths = [0]*len(values)
+    previous = [-1]*len(values)
+    for index, value in enumerate(values):
+        length = bisect_left(tails, value)
+        if length:
+            previous[index] = tail_indices[length - 1]
+        if length == len(tails):
+            tails.append(value)
+            tail_indices.append(index)
+        else:
+            tails[length] = value
+            tail_indices[length] = index
+        lengths[index] = length + 1
+    return lengths, previous
+
+def _subsequence(previous: list[int], index: int) -> set[int]:
+    '''
+    Return the indices of the subsequence that ends at index (none for -1), given the index before every index.
+    '''
+    indices = set()
+    while index >= 0:
+        indices.add(index)
+        index = previous[index]
+    return indices
 
 def create_playlist(plexlibrary: MusicSection, plex_tracks: list[Track], playlist_name: str):
     '''
@@ -63,82 +622,133 @@ def create_playlist(plexlibrary: MusicSection, plex_tracks: list[Track], playlis
                                smart = False,
                                )
 
-def append_playlist(plexlibrary: MusicSection,
-                    plex_tracks: list,
-                    playlist_name: str):
+def _create_playlist(plexlibrary: MusicSection, plex_tracks: list[Track], playlist_name: str) -> Playlist:
     '''
-    Append the given tracks to the given playlist. Raises ValueError if no such playlists exists.
+    Create a new playlist with create_playlist, retried like the other playlist writes.
+    A create that timed out may still have been carried out, so before a retry the playlists with the given name are checked
+    for one that was not there before; that one is used instead of creating another.
     '''
-    try:
-        playlist = plexlibrary.playlist(playlist_name)
-    except NotFound as exc:
-        raise ValueError(f"\tCan't find playlist named {playlist_name}, available playlists:\n{'\t\'n'.join([playlist.title for playlist in plexlibrary.playlists()])}") from exc
-    assert isinstance(playlist, Playlist)
-    playlist.addItems(plex_tracks)
+    def playlists() -> list[Playlist]:
+        return [playlist for playlist in plexlibrary.playlists(title = playlist_name) if playlist.title == playlist_name]
+
+    existing = {playlist.ratingKey for playlist in playlists()}
+    created = [] # type: list[Playlist]
+
+    def was_applied() -> bool:
+        created.extend(playlist for playlist in playlists() if playlist.ratingKey not in existing)
+        return bool(created)
 
-def append_playlist_newtracks_only(plexlibrary: MusicSection,
-                                   plex_tracks: list,
-                                   playlist_name: str):
+    playlist = _with_retries(partial(create_playlist, plexlibrary, plex_tracks, playlist_name), was_applied = was_applied)
+    return playlist if playlist is not None else created[0]
+
+def _find_playlist(plexlibrary: MusicSection, playlist_name: str) -> Playlist:
     '''
-    Append the given tracks to the given playlist, but only if the tracks are not in there yet. Raises ValueError if no such playlists exists.
+    Return the playlist with the given name. Raises ValueError if no such playlists exists.
     '''
     try:
         playlist = plexlibrary.playlist(playlist_name)
     except NotFound as exc:
-        raise ValueError(f"Can't find playlist named {playlist_name}, available playlists:\n{'\t\'n'.join([playlist.title for playlist in plexlibrary.playlists()])}") from exc
+        raise ValueError(f"\tCan't find playlist named {playlist_name}, available playlists:\n{'\t\'n'.join([playlist.title for playlist in plexlibrary.playlists()])}") from exc
     assert isinstance(playlist, Playlist)
-    current_track_ids = [track.ratingKey for track in playlist.items()]
-    new_tracks = []
-    for track in plex_tracks:
-        if not track.ratingKey in current_track_ids:
-            new_tracks.append(track)
-    playlist.addItems(new_tracks)
-
-def find_tracks(plexlibrary: MusicSection,
-                spotify_tracks: list[dict[str, str | list[str]]],
+    return playlist
+
+def find_tracks(library_index: LibraryIndex,
+                spotify_tracks: Iterable[SpotifyTrack],
                 matching_pattern: str | list[str],
                 print_status: bool = False,
-                mapping_dict: dict[str,str] | None = None,
-                skip_list: list[str] | None = None,
-                plexserver: PlexServer | None = None,
-                ) -> tuple[list[dict], list[dict], list[Track], list[dict]]:
+                mapping_dict: dict[str,int] | None = None,
+                skip_list: Collection[str] | None = None,
+                workers: int = 1,
+                processes: int = 1,
+                match_cache: MatchCache | None = None,
+                ) -> tuple[list[SpotifyTrack], list[SpotifyTrack], list[TrackRecord], list[SpotifyTrack]]:
     '''
-    Try to match all the tracks in the spotify_tracks list with songs in the plexlibrary music library.
+    Try to match all the tracks in spotify_tracks with songs in the indexed plex music library, see match_tracks.
+    Returns the matched, unmatched and skipped spotify tracks, and the records of the matched plex tracks.
     '''
     matched = []
     unmatched = []
     found = []
     skipped = []
+    for spotify_track, plex_track, _ in match_tracks(library_index = library_index,
+                                                     spotify_tracks = spotify_tracks,
+                                                     matching_pattern = matching_pattern,
+                                                     print_status = print_status,
+                                                     mapping_dict = mapping_dict,
+                                                     skip_list = skip_list,
+                                                     workers = workers,
+                                                     processes = processes,
+                                                     match_cache = match_cache):
+        if plex_track == 'Skipped':
+            skipped.append(spotify_track)
+        elif plex_track:
+            matched.append(spotify_track)
+            found.append(plex_track)
+        else:
+            unmatched.append(spotify_track)
+    return matched, unmatched, found, skipped
 
-    nr_spotify_tracks = len(spotify_tracks)
-    for nr, element in enumerate(spotify_tracks):
+def match_tracks(library_index: LibraryIndex,
+                 spotify_tracks: Iterable[SpotifyTrack],
+                 matching_pattern: str | list[str],
+                 print_status: bool = False,
+                 mapping_dict: dict[str,int] | None = None,
+                 skip_list: Collection[str] | None = None,
+                 workers: int = 1,
+                 processes: int = 1,
+                 match_cache: MatchCache | None = None,
+                 ) -> Iterator[tuple[SpotifyTrack, TrackRecord | None | str, str | None]]:
+    '''
+    Try to match all the tracks in spotify_tracks with songs in the indexed plex music library.
+    Yields every spotify track with its match (a track record, "Skipped" or None) and the source of the match, in order, as soon as it is matched.
+    spotify_tracks can be a list or an iterator; tracks from an iterator are matched as they come in.
+    With more than one worker, tracks are matched concurrently by a bounded thread pool; the results keep the playlist order.
+    With more than one process, tracks are matched in chunks by a pool of worker processes instead (see src.process_matching),
+    which scales with the number of cores where threads are held back by the GIL.
+    If a match cache is given, it is consulted before searching, and new search results are saved to it.
+    For the album strategies, the tracks of every album in a batch are matched together, see src.album_matching.
+    '''
+    def match_item(spotify_track: SpotifyTrack,
+                   strategies: list[str],
+                   album_assignments: dict[tuple[str, str], TrackRecord | None] | None) -> tuple[TrackRecord | None | str, str | None]:
+        return match_track(library_index = library_index,
+                           spotify_track = spotify_track,
+                           skip_list = skip_list,
+                           mapping_dict = mapping_dict,
+                           matching_strength = strategies,
+                           match_cache = match_cache,
+                           album_assignments = album_assignments)
+
+    nr_spotify_tracks = len(spotify_tracks) if isinstance(spotify_tracks, Sized) else '?'
+    strategy_counts = Counter() # type: Counter[str]
+    if processes > 1:
+        results = match_in_processes(library_index, spotify_tracks, matching_pattern, processes,
+                                     skip_list = skip_list,
+                                     mapping_dict = mapping_dict,
+                                     match_cache = match_cache)
+    else:
+        results = match_with_album_assignments(library_index, spotify_tracks, matching_pattern, match_item, workers = workers)
+    for nr, (spotify_track, (plex_track, strategy)) in enumerate(results):
         if print_status:
             print(f"At track nr {nr+1}/{nr_spotify_tracks}")
         
-        spotify_track = element['track'] # type: ignore
-        spotify_track_name = spotify_track['name'] # type: ignore
-        spotify_track_artist = spotify_track['artists'][0]['name'] # type: ignore
-        # Check typing
-        assert isinstance(spotify_track, dict)
-
-        plex_track = match_track(plexlibrary = plexlibrary,
-                                spotify_track = spotify_track,
-                                skip_list = skip_list,
-                                mapping_dict = mapping_dict,
-                                matching_strength=matching_pattern,
-                                plexserver = plexserver)
+        spotify_track_name = spotify_track.name
+        spotify_track_artist = spotify_track.artist
+
         if plex_track:
             if plex_track == 'Skipped':
-                skipped.append(element)
                 if print_status:
                     print(f"\tSkipped spotify track {spotify_track_name} ({spotify_track_artist})")
-                continue
-            if print_status:
-                print(f"\tMatched spotify track {spotify_track_name} ({spotify_track_artist}) as plex track {plex_track.title} ({plex_track.artist().title})") # type: ignore
-            matched.append(element)
-            found.append(plex_track)
-        else:
-            if print_status:
-                print(f"\tCould not find match for spotify track {spotify_track_name} ({spotify_track_artist})")
-            unmatched.append(element)
-    return matched, unmatched, found, skipped
+            else:
+                if print_status:
+                    print(f"\tMatched spotify track {spotify_track_name} ({spotify_track_artist}) as plex track {plex_track.title} ({plex_track.grandparentTitle}) [{strategy}]") # type: ignore
+                strategy_counts[strategy] += 1
+                if match_cache and strategy in MATCHING_STRATEGIES:
+                    match_cache.add(spotify_track, plex_track, strategy) # type: ignore
+        elif print_status:
+            print(f"\tCould not find match for spotify track {spotify_track_name} ({spotify_track_artist})")
+        yield spotify_track, plex_track, strategy
+    if match_cache:
+        match_cache.save()
+    if strategy_counts:
+        print("\tMatches per strategy: " + ", ".join(f"{strategy}: {count}" for strategy, count in strategy_counts.items()))